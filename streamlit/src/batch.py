@@ -0,0 +1,336 @@
+"""
+Headless batch runner for archived exams.
+
+Exams come from a JSONL manifest, one exam per line:
+    {"exam_id": "...", "patient": "...", "eye": "right", "exam_type": "oct_macula", "exam_date": "2024-05-01", "images": ["a.jpg", ...]}
+(image paths relative to the manifest; exam_id defaults to patient/exam_type/exam_date/eye, with
+the manifest line number standing in for a missing exam_date), or from a directory laid out as
+    <root>/<patient>/<exam_type>/<eye>/*.jpg
+
+Commands (run from the repository root):
+    python streamlit/src/batch.py run SOURCE --out results.jsonl [--concurrency 8] [--stub]
+    python streamlit/src/batch.py emit-describe SOURCE --out describe_requests.jsonl
+    python streamlit/src/batch.py emit-report SOURCE --descriptions describe_output.jsonl --out report_requests.jsonl
+    python streamlit/src/batch.py ingest SOURCE --descriptions describe_output.jsonl --reports report_output.jsonl --out results.jsonl
+    python streamlit/src/batch.py stub-batch REQUESTS --out OUTPUT
+
+`run` checkpoints every finished exam to --out and skips those on restart; failed
+exams go to <out>.errors.jsonl and are retried on the next run. The emit/ingest
+commands produce and consume the OpenAI/Azure Batch API JSONL format.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# Batch API calls are billed at half the standard rate
+BATCH_COST_FACTOR = 0.5
+
+
+def load_exams(source: str) -> list:
+    exams = []
+    if os.path.isfile(source):
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, encoding="utf-8") as f:
+            for number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                exam = json.loads(line)
+                exam["images"] = [os.path.join(base, p) for p in exam["images"]]
+                # The same patient, exam type and eye recur across exam dates: the id must tell them apart
+                when = exam.get("exam_date") or f"line{number}"
+                exam.setdefault("exam_id", f"{exam['patient']}/{exam['exam_type']}/{when}/{exam['eye']}")
+                exams.append(exam)
+        return exams
+
+    for dirpath, _, files in sorted(os.walk(source)):
+        images = sorted(f for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+        parts = os.path.relpath(dirpath, source).split(os.sep)
+        if not images or len(parts) < 3:
+            continue
+        patient, exam_type, eye = parts[-3:]
+        exams.append({
+            "exam_id": "/".join(parts),
+            "patient": patient,
+            "eye": eye,
+            "exam_type": exam_type,
+            "images": [os.path.join(dirpath, f) for f in images],
+        })
+    return exams
+
+
+def read_jsonl(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_jsonl(path: str, record: dict):
+    # One durable line per exam, so a crash loses at most the exams still in flight
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_jsonl(path: str, records):
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def add_costs(total: dict, costs: dict, factor: float = 1.0):
+    for k, v in costs.items():
+        total[k] = total.get(k, 0.0) + v * factor
+    return total
+
+
+def exam_meta(exam: dict) -> dict:
+    return {k: exam[k] for k in ("exam_id", "patient", "eye", "exam_type")}
+
+
+def use_stub(latency: float):
+    # Route every call to the local stub instead of Azure
+    os.environ.setdefault("AZURE_OPENAI_API_KEY", "stub")
+    import utils
+    from clients import async_registry
+    from stub import StubAsyncClient
+
+    async_registry.register(utils.config.AZURE_ENDPOINT, utils.config.AZURE_API_KEY, StubAsyncClient(latency))
+
+
+async def process_exam(exam: dict, args) -> dict:
+    import prompts
+    import telemetry
+    from loaders import get_layouts
+    from utils import analyze_image_async, synthesize_medical_report_async
+
+    start = time.monotonic()
+    # One trace per exam: its descriptions and report nest under this span
+    with telemetry.span("exam", exam_id=exam["exam_id"], eye=exam["eye"], exam_type=exam["exam_type"]):
+        results = await asyncio.gather(*(
+            analyze_image_async(path, exam["exam_type"], prompts.DEFAULT_EYE_PROMPT, model=args.description_model,
+                                use_cache=not args.no_cache)
+            for path in exam["images"]
+        ))
+        errors = [r["error"] for r in results if "error" in r]
+        if errors:
+            raise RuntimeError("; ".join(errors))
+
+        report = await synthesize_medical_report_async(
+            [r["output"] for r in results],
+            exam["exam_type"],
+            prompts.COMBINED_PROMPT,
+            model=args.reasoning_model,
+            estrutura=get_layouts().get(exam["exam_type"]),
+            use_cache=not args.no_cache,
+        )
+    total_costs = {}
+    for r in results + [report]:
+        add_costs(total_costs, r["costs"])
+    return {
+        **exam_meta(exam),
+        "images": exam["images"],
+        "descriptions": [r["output"] for r in results],
+        "report": report["output"],
+        "costs": total_costs,
+        "elapsed_seconds": round(time.monotonic() - start, 3),
+    }
+
+
+async def run_batch(exams: list, args) -> dict:
+    import telemetry
+
+    errors_path = args.out + ".errors.jsonl"
+    done = {r["exam_id"] for r in read_jsonl(args.out)}
+    pending = [e for e in exams if e["exam_id"] not in done]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    summary = {"exams": len(exams), "skipped": len(exams) - len(pending), "completed": 0, "failed": 0, "costs": {}}
+    print(f"{len(pending)} exams to process ({summary['skipped']} already done)", file=sys.stderr)
+
+    async def worker(exam):
+        async with semaphore:
+            try:
+                record = await process_exam(exam, args)
+            except Exception as e:
+                summary["failed"] += 1
+                append_jsonl(errors_path, {**exam_meta(exam), "error": str(e), "failed_at": time.time()})
+                return
+            summary["completed"] += 1
+            add_costs(summary["costs"], record["costs"])
+            append_jsonl(args.out, record)
+            telemetry.write_metrics()
+            print(f"[{summary['completed'] + summary['failed']}/{len(pending)}] {exam['exam_id']}", file=sys.stderr)
+
+    await asyncio.gather(*(worker(e) for e in pending))
+    return summary
+
+
+def describe_requests(exams: list, model: str):
+    from prompts import DEFAULT_EYE_PROMPT
+    from messages import image_messages
+    from utils import SAMPLING_PARAMS, encode_image, read_image
+
+    for exam in exams:
+        for index, path in enumerate(exam["images"]):
+            data, mime_type = read_image(path)
+            data_url, preprocessing = encode_image(data, mime_type, exam["exam_type"])
+            yield {
+                "custom_id": f"{exam['exam_id']}::{index}",
+                "method": "POST",
+                "url": "/chat/completions",
+                "body": {
+                    "model": model,
+                    "messages": image_messages(data_url, preprocessing["detail"], exam["exam_type"], DEFAULT_EYE_PROMPT),
+                    **SAMPLING_PARAMS,
+                },
+            }
+
+
+def ingest_output(path: str) -> dict:
+    """
+    Read a Batch API output file.
+    :return: custom_id -> {"output", "metadata", "costs"} or {"error"}.
+    """
+    from utils import completion_output, costs
+
+    results = {}
+    for line in read_jsonl(path):
+        response = line.get("response") or {}
+        if line.get("error") or response.get("status_code") != 200:
+            results[line["custom_id"]] = {"error": line.get("error") or response.get("body")}
+            continue
+        output_text, metadata = completion_output(response["body"])
+        results[line["custom_id"]] = {"output": output_text, "metadata": metadata, "costs": costs(metadata, model=response["body"].get("model"))}
+    return results
+
+
+def exam_descriptions(exam: dict, described: dict):
+    results = [described.get(f"{exam['exam_id']}::{i}") for i in range(len(exam["images"]))]
+    if any(r is None or "error" in r for r in results):
+        return None
+    return results
+
+
+def report_requests(exams: list, described: dict, model: str):
+    from prompts import COMBINED_PROMPT
+    from messages import report_messages
+    from loaders import get_layouts
+    from utils import SAMPLING_PARAMS
+
+    layouts = get_layouts()
+    for exam in exams:
+        results = exam_descriptions(exam, described)
+        if results is None:
+            print(f"skipping {exam['exam_id']}: missing or failed descriptions", file=sys.stderr)
+            continue
+        yield {
+            "custom_id": exam["exam_id"],
+            "method": "POST",
+            "url": "/chat/completions",
+            "body": {
+                "model": model,
+                "messages": report_messages([r["output"] for r in results], COMBINED_PROMPT, layouts.get(exam["exam_type"])),
+                **SAMPLING_PARAMS,
+                "response_format": {"type": "json_object"},
+            },
+        }
+
+
+def ingest_results(exams: list, described: dict, reported: dict):
+    for exam in exams:
+        results = exam_descriptions(exam, described)
+        report = reported.get(exam["exam_id"])
+        if results is None or report is None or "error" in report:
+            yield {**exam_meta(exam), "error": (report or {}).get("error", "missing or failed batch results")}
+            continue
+        try:
+            final_report = json.loads(report["output"])
+        except json.JSONDecodeError:
+            final_report = {"error": "Falha ao interpretar a resposta como JSON.", "raw_response": report["output"]}
+        total_costs = {}
+        for r in results + [report]:
+            add_costs(total_costs, r["costs"], BATCH_COST_FACTOR)
+        yield {
+            **exam_meta(exam),
+            "images": exam["images"],
+            "descriptions": [r["output"] for r in results],
+            "report": final_report,
+            "costs": total_costs,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch image -> report processing for archived exams.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="process exams live with bounded parallelism and checkpointing")
+    run.add_argument("source", help="JSONL manifest or exam directory")
+    run.add_argument("--out", required=True, help="results JSONL (also the resume checkpoint)")
+    run.add_argument("--concurrency", type=int, default=8, help="exams processed at once")
+    run.add_argument("--no-cache", action="store_true", help="ignore the result cache")
+    run.add_argument("--stub", action="store_true", help="answer locally instead of calling Azure")
+    run.add_argument("--stub-latency", type=float, default=0.0)
+
+    emit_describe = sub.add_parser("emit-describe", help="write Batch API requests for the image descriptions")
+    emit_describe.add_argument("source")
+    emit_describe.add_argument("--out", required=True)
+
+    emit_report = sub.add_parser("emit-report", help="ingest description results and write report requests")
+    emit_report.add_argument("source")
+    emit_report.add_argument("--descriptions", required=True, help="Batch API output of emit-describe")
+    emit_report.add_argument("--out", required=True)
+
+    ingest = sub.add_parser("ingest", help="combine Batch API outputs into results JSONL")
+    ingest.add_argument("source")
+    ingest.add_argument("--descriptions", required=True)
+    ingest.add_argument("--reports", required=True, help="Batch API output of emit-report")
+    ingest.add_argument("--out", required=True)
+
+    stub = sub.add_parser("stub-batch", help="answer a Batch API input file locally")
+    stub.add_argument("requests")
+    stub.add_argument("--out", required=True)
+
+    for p in (run, emit_describe, emit_report):
+        p.add_argument("--description-model", default="gpt-4o")
+        p.add_argument("--reasoning-model", default="o3-mini")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "stub-batch":
+        from stub import stub_batch
+        print(f"{stub_batch(args.requests, args.out)} requests answered", file=sys.stderr)
+        return
+
+    exams = load_exams(args.source)
+    if args.command == "run":
+        if args.stub:
+            use_stub(args.stub_latency)
+        from scheduler import scheduler
+        import telemetry
+        telemetry.start_exporter()
+        summary = scheduler.run(run_batch(exams, args))
+        summary["spans"] = telemetry.metrics.span_summary()
+        telemetry.write_metrics()
+        print(json.dumps(summary, indent=2))
+    elif args.command == "emit-describe":
+        count = write_jsonl(args.out, describe_requests(exams, args.description_model))
+        print(f"{count} description requests written to {args.out}", file=sys.stderr)
+    elif args.command == "emit-report":
+        count = write_jsonl(args.out, report_requests(exams, ingest_output(args.descriptions), args.reasoning_model))
+        print(f"{count} report requests written to {args.out}", file=sys.stderr)
+    elif args.command == "ingest":
+        records = ingest_results(exams, ingest_output(args.descriptions), ingest_output(args.reports))
+        count = write_jsonl(args.out, records)
+        print(f"{count} results written to {args.out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
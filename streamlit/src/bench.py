@@ -0,0 +1,268 @@
+"""
+Throughput/latency benchmarks against the local mock Azure server (mock_azure.py).
+
+Scenarios:
+    utils  drives analyze_image_async / synthesize_medical_report_async directly:
+           each session describes N images per eye and writes both eye reports.
+    app    drives the full main.py flow through Streamlit's AppTest, one AppTest per
+           concurrent session, with N images uploaded per eye; the report jobs run on
+           one in-process worker per session.
+
+Commands (run from the repository root):
+    python streamlit/src/bench.py utils --images 1,4,8 --sessions 1,4,16
+    python streamlit/src/bench.py app --images 2,4 --sessions 1,4
+    python streamlit/src/bench.py all --save-baseline
+    python streamlit/src/bench.py all --check          # exit 1 on regressions vs the baseline
+
+Each case reports sessions/second, p50/p95/p99 session latency, calls/second seen by the
+mock, and peak memory (Python heap via tracemalloc, process RSS). --save-baseline stores
+the results (default BENCH_BASELINE = .cache/bench_baseline.json); later runs are compared
+against it and a case regresses when p95 or peak heap grows, or throughput drops, by more
+than --tolerance.
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from mock_azure import MockAzureServer
+from settings import get_setting
+
+SAMPLES_DIR = "samples"
+EXAM_TYPE = "oct_macula"
+
+
+def percentile(values: list, q: float) -> float:
+    # Nearest-rank percentile; good enough for a few dozen sessions
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def sample_images(count: int) -> list:
+    samples = sorted(os.path.join(SAMPLES_DIR, f) for f in os.listdir(SAMPLES_DIR) if f.lower().endswith((".jpg", ".jpeg", ".png")))
+    return [samples[i % len(samples)] for i in range(count)]
+
+
+def connect(mock: MockAzureServer, unlimited_quota: bool):
+    # Point the shared clients at the mock; the key is never checked
+    os.environ.setdefault("AZURE_OPENAI_ENDPOINT", mock.url)
+    os.environ.setdefault("AZURE_OPENAI_API_KEY", "bench")
+    import utils
+    from ratelimit import rate_limiter
+
+    utils.config.AZURE_ENDPOINT = mock.url
+    utils.config.AZURE_API_KEY = "bench"
+    if unlimited_quota:
+        # Measure the pipeline, not our own RPM/TPM throttling
+        rate_limiter.quotas = {"default": {"rpm": 10 ** 6, "tpm": 10 ** 9}}
+
+
+async def utils_session(images: list, stream: bool) -> float:
+    import prompts
+    from loaders import get_layouts
+    from utils import analyze_image_async, synthesize_medical_report_async
+
+    on_delta = (lambda delta: None) if stream else None
+    start = time.monotonic()
+
+    async def eye():
+        results = await asyncio.gather(*(
+            analyze_image_async(path, EXAM_TYPE, prompts.DEFAULT_EYE_PROMPT, use_cache=False, on_delta=on_delta)
+            for path in images
+        ))
+        errors = [r["error"] for r in results if "error" in r]
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        await synthesize_medical_report_async(
+            [r["output"] for r in results], EXAM_TYPE, prompts.COMBINED_PROMPT,
+            estrutura=get_layouts()[EXAM_TYPE], use_cache=False, on_delta=on_delta,
+        )
+
+    await asyncio.gather(eye(), eye())
+    return time.monotonic() - start
+
+
+def run_utils_case(images: int, sessions: int, rounds: int, stream: bool) -> list:
+    from scheduler import scheduler
+
+    paths = sample_images(images)
+    latencies = []
+    for _ in range(rounds):
+        async def round_():
+            return await asyncio.gather(*(utils_session(paths, stream) for _ in range(sessions)))
+        latencies.extend(scheduler.run(round_()))
+    return latencies
+
+
+class _Upload(io.BytesIO):
+    # Stand-in for streamlit's UploadedFile (AppTest cannot drive st.file_uploader)
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            super().__init__(f.read())
+        self.name = os.path.basename(path)
+        self.size = len(self.getvalue())
+        self.type = "image/jpeg"
+
+
+def app_session(paths: list, timeout: float) -> float:
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"), default_timeout=timeout)
+    at.session_state["authentication_status"] = True
+    # Distinct owners, so no session reattaches to another one's running job
+    at.session_state["username"] = f"bench-{uuid.uuid4().hex[:8]}"
+    at.run()
+    for checkbox in at.checkbox:
+        if checkbox.label.startswith("Reuse cached"):
+            checkbox.uncheck()
+    at.button[0].click()
+    start = time.monotonic()
+    at.run()
+    elapsed = time.monotonic() - start
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    if not any("Final reports generated" in str(s.value) for s in at.success):
+        raise RuntimeError("app run finished without reports")
+    return elapsed
+
+
+_job_threads = []
+
+
+def serve_jobs(workers: int):
+    """
+    Run the app's report jobs on worker threads of this process instead of worker processes,
+    so they use the mock connection and quota set up by connect().
+    """
+    import jobs
+
+    jobs.start_workers = lambda count=None, api_key=None: len(_job_threads)
+    while len(_job_threads) < workers:
+        thread = threading.Thread(target=jobs.run_worker, args=(jobs.job_store, 0.05), daemon=True)
+        thread.start()
+        _job_threads.append(thread)
+
+
+def run_app_case(images: int, sessions: int, rounds: int, timeout: float) -> list:
+    import streamlit as st
+
+    paths = sample_images(images)
+    st.file_uploader = lambda label, *args, **kwargs: [_Upload(p) for p in paths]
+    serve_jobs(sessions)
+    latencies = []
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        for _ in range(rounds):
+            latencies.extend(pool.map(lambda _: app_session(paths, timeout), range(sessions)))
+    return latencies
+
+
+def measure(mock: MockAzureServer, sessions: int, rounds: int, run) -> dict:
+    tracemalloc.reset_peak()
+    requests_before = mock.stats["requests"]
+    throttled_before = mock.stats["throttled"]
+    start = time.monotonic()
+    latencies = run()
+    wall = time.monotonic() - start
+    _, peak_heap = tracemalloc.get_traced_memory()
+    return {
+        "sessions_per_second": round(sessions * rounds / wall, 3),
+        "calls_per_second": round((mock.stats["requests"] - requests_before) / wall, 2),
+        "throttled_by_mock": mock.stats["throttled"] - throttled_before,
+        "p50_seconds": round(percentile(latencies, 0.50), 3),
+        "p95_seconds": round(percentile(latencies, 0.95), 3),
+        "p99_seconds": round(percentile(latencies, 0.99), 3),
+        "wall_seconds": round(wall, 3),
+        "peak_heap_mb": round(peak_heap / 2 ** 20, 2),
+        # ru_maxrss is in KiB on Linux; it only ever grows, so it is the process peak so far
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for case, current in results.items():
+        base = baseline.get(case)
+        if not base:
+            continue
+        checks = (
+            ("p95_seconds", current["p95_seconds"] > base["p95_seconds"] * (1 + tolerance)),
+            ("sessions_per_second", current["sessions_per_second"] < base["sessions_per_second"] * (1 - tolerance)),
+            ("peak_heap_mb", current["peak_heap_mb"] > base["peak_heap_mb"] * (1 + tolerance)),
+        )
+        for metric, regressed in checks:
+            if regressed:
+                regressions.append(f"{case}: {metric} {base[metric]} -> {current[metric]}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the image -> report pipeline against a local mock Azure.")
+    parser.add_argument("scenario", choices=["utils", "app", "all"])
+    parser.add_argument("--images", default="1,4,8", help="images per eye, comma separated")
+    parser.add_argument("--sessions", default="1,4,16", help="concurrent sessions, comma separated")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--stream", action="store_true", help="stream completions (utils scenario)")
+    parser.add_argument("--ttft", default="lognormal:0.6,0.4", help="mock time-to-first-token distribution")
+    parser.add_argument("--tps", type=float, default=80.0, help="mock completion tokens per second")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of mock requests throttled")
+    parser.add_argument("--completion-tokens", type=int, default=300)
+    parser.add_argument("--unlimited-quota", action="store_true", help="lift the client-side RPM/TPM limiter")
+    parser.add_argument("--app-timeout", type=float, default=300.0)
+    parser.add_argument("--baseline", default=get_setting("BENCH_BASELINE", ".cache/bench_baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="exit 1 when a case regressed vs the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--out", help="also write the results JSON here")
+    args = parser.parse_args(argv)
+
+    images = [int(v) for v in args.images.split(",")]
+    sessions = [int(v) for v in args.sessions.split(",")]
+    scenarios = ["utils", "app"] if args.scenario == "all" else [args.scenario]
+
+    tracemalloc.start()
+    results = {}
+    with MockAzureServer(ttft=args.ttft, tps=args.tps, rate_429=args.rate_429,
+                         completion_tokens=args.completion_tokens) as mock:
+        connect(mock, args.unlimited_quota)
+        for scenario in scenarios:
+            for n in images:
+                for s in sessions:
+                    case = f"{scenario}/images={n}/sessions={s}" + ("/stream" if args.stream and scenario == "utils" else "")
+                    if scenario == "utils":
+                        run = lambda: run_utils_case(n, s, args.rounds, args.stream)
+                    else:
+                        run = lambda: run_app_case(n, s, args.rounds, args.app_timeout)
+                    results[case] = measure(mock, s, args.rounds, run)
+                    print(f"{case}: {json.dumps(results[case])}", file=sys.stderr)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    print(json.dumps({"results": results, "regressions": regressions}, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({**baseline, **results}, f, indent=2)
+        print(f"baseline saved to {args.baseline}", file=sys.stderr)
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
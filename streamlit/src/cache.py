@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from settings import get_setting
+
+DEFAULT_CACHE_PATH = ".cache/redcheck_cache.sqlite"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 30 * 24 * 3600
+
+
+def cache_key(*parts) -> str:
+    """
+    Content-addressed key: sha256 over the parts, with bytes hashed as-is and
+    everything else serialized as canonical JSON.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, (bytes, bytearray, memoryview)):
+            digest.update(b"b")
+            digest.update(hashlib.sha256(part).digest())
+        else:
+            digest.update(b"j")
+            digest.update(json.dumps(part, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent SQLite cache for model outputs, shared by every session in the process.
+    Entries expire after their TTL and the least recently used ones are evicted once
+    the stored values exceed `max_bytes`.
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES, ttl_seconds: float = DEFAULT_TTL_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = None
+        self._counters = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY, namespace TEXT NOT NULL, value TEXT NOT NULL,"
+                " size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL, expires REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self._conn = conn
+        return self._conn
+
+    def _count(self, namespace: str, name: str):
+        counters = self._counters.setdefault(namespace, {"hits": 0, "misses": 0, "writes": 0, "evictions": 0})
+        counters[name] += 1
+
+    def get(self, namespace: str, key: str):
+        """Return the cached value or None, counting a hit or a miss."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, expires FROM entries WHERE key = ? AND namespace = ?", (key, namespace)
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                if row is not None:
+                    conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    conn.commit()
+                self._count(namespace, "misses")
+                return None
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self._count(namespace, "hits")
+        return json.loads(row[0])
+
+    def put(self, namespace: str, key: str, value, ttl_seconds: float = None):
+        now = time.time()
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        payload = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, namespace, value, size, created, accessed, expires)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, namespace, payload, len(payload), now, now, now + ttl if ttl else None),
+            )
+            self._count(namespace, "writes")
+            self._evict(conn, now)
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM entries WHERE expires IS NOT NULL AND expires < ?", (now,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, namespace, size in conn.execute(
+            "SELECT key, namespace, size FROM entries ORDER BY accessed ASC"
+        ).fetchall():
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._count(namespace, "evictions")
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self) -> dict:
+        with self._lock:
+            conn = self._connect()
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            counters = {ns: dict(c) for ns, c in self._counters.items()}
+        for c in counters.values():
+            lookups = c["hits"] + c["misses"]
+            c["hit_ratio"] = round(c["hits"] / lookups, 3) if lookups else 0.0
+        return {"entries": entries, "bytes": size, "max_bytes": self.max_bytes, "namespaces": counters}
+
+
+result_cache = ResultCache(
+    get_setting("CACHE_PATH", DEFAULT_CACHE_PATH),
+    max_bytes=get_setting("CACHE_MAX_BYTES", DEFAULT_MAX_BYTES),
+    ttl_seconds=get_setting("CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS),
+)
@@ -0,0 +1,141 @@
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import httpx
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+
+from settings import get_setting
+
+DEFAULT_API_VERSION = "2024-05-01-preview"
+
+
+def pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=get_setting("AZURE_POOL_MAX_CONNECTIONS", 20),
+        max_keepalive_connections=get_setting("AZURE_POOL_MAX_KEEPALIVE", 10),
+        keepalive_expiry=get_setting("AZURE_POOL_KEEPALIVE_EXPIRY", 60.0),
+    )
+
+
+def pool_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        get_setting("AZURE_TIMEOUT_READ", 120.0),
+        connect=get_setting("AZURE_TIMEOUT_CONNECT", 10.0),
+        pool=get_setting("AZURE_TIMEOUT_POOL", 30.0),
+    )
+
+
+def _fingerprint(api_key: str) -> str:
+    # Never expose the key itself in stats, only a short stable hash
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:8]
+
+
+class ClientRegistry:
+    """
+    Process-wide registry of Azure OpenAI clients keyed by (endpoint, api_key, api_version).
+    Each client owns a keep-alive httpx connection pool shared by every caller that uses it.
+    """
+
+    def __init__(self, client_cls=AsyncAzureOpenAI, http_client_cls=DefaultAsyncHttpxClient):
+        self._client_cls = client_cls
+        self._http_client_cls = http_client_cls
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._stats = {}
+
+    def get(self, endpoint: str, api_key: str, api_version: str = DEFAULT_API_VERSION):
+        key = (endpoint, api_key, api_version)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                limits = pool_limits()
+                client = self._client_cls(
+                    azure_endpoint=endpoint,
+                    api_key=api_key,
+                    api_version=api_version,
+                    http_client=self._http_client_cls(limits=limits, timeout=pool_timeout()),
+                    # 429s and transient errors are retried by ratelimit.RateLimiter instead
+                    max_retries=get_setting("AZURE_SDK_MAX_RETRIES", 0),
+                )
+                self._clients[key] = client
+                self._stats[id(client)] = {
+                    "client": "async",
+                    "endpoint": endpoint,
+                    "api_version": api_version,
+                    "key_fingerprint": _fingerprint(api_key),
+                    "max_connections": limits.max_connections,
+                    "max_keepalive_connections": limits.max_keepalive_connections,
+                    "in_flight": 0,
+                    "peak_in_flight": 0,
+                    "total_requests": 0,
+                }
+            return client
+
+    def register(self, endpoint: str, api_key: str, client, api_version: str = DEFAULT_API_VERSION):
+        """Install a prebuilt client (e.g. the local stub) for a key, replacing any existing one."""
+        with self._lock:
+            self._clients[(endpoint, api_key, api_version)] = client
+            self._stats[id(client)] = {
+                "client": type(client).__name__,
+                "endpoint": endpoint,
+                "api_version": api_version,
+                "key_fingerprint": _fingerprint(api_key),
+                "max_connections": None,
+                "max_keepalive_connections": None,
+                "in_flight": 0,
+                "peak_in_flight": 0,
+                "total_requests": 0,
+            }
+        return client
+
+    @contextmanager
+    def track(self, client):
+        """Count a request as in flight on the client's pool for the duration of the block."""
+        with self._lock:
+            stats = self._stats.get(id(client))
+            if stats is not None:
+                stats["in_flight"] += 1
+                stats["total_requests"] += 1
+                stats["peak_in_flight"] = max(stats["peak_in_flight"], stats["in_flight"])
+        try:
+            yield client
+        finally:
+            with self._lock:
+                if stats is not None:
+                    stats["in_flight"] -= 1
+
+    def stats(self) -> list:
+        """
+        Pool utilization for every registered client.
+        :return: List of dicts with request counters and open/idle connection counts.
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            snapshot = [dict(self._stats[id(c)]) for c in clients]
+        for client, stats in zip(clients, snapshot):
+            connections = _pool_connections(client)
+            if connections is not None:
+                stats["open_connections"] = len(connections)
+                stats["idle_connections"] = sum(1 for c in connections if c.is_idle())
+            stats["utilization"] = round(stats["in_flight"] / max(stats["max_connections"] or 1, 1), 3)
+        return snapshot
+
+
+def _pool_connections(client):
+    # httpx does not expose its pool publicly; read the httpcore pool when it is available
+    transport = getattr(getattr(client, "_client", None), "_transport", None)
+    pool = getattr(transport, "_pool", None)
+    return getattr(pool, "connections", None)
+
+
+async_registry = ClientRegistry()
+
+
+def get_async_client(endpoint: str, api_key: str, api_version: str = DEFAULT_API_VERSION) -> AsyncAzureOpenAI:
+    # Async clients are bound to the scheduler's event loop, which is the only loop that uses them
+    return async_registry.get(endpoint, api_key, api_version)
+
+
+def pool_stats() -> list:
+    return async_registry.stats()
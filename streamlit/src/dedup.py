@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import io
+
+from estimator import ZERO_COSTS
+from settings import get_setting
+from tokens import text_tokens
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# dHash size: HASH_SIZE x HASH_SIZE bits, compared by Hamming distance. At 8x8 the OS and OD scans
+# of one patient (samples/sample_2.jpg, samples/sample_right_2.jpg) were only 4 bits apart; at 16x16
+# they are 24 apart, while re-encoded or resized copies of one image stay within 0-3.
+HASH_SIZE = 16
+# Largest perceptual distance ever accepted, whatever the configured threshold
+MAX_PERCEPTUAL_DISTANCE = 2
+
+
+def exact_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(data: bytes):
+    """
+    Difference hash (dHash) of the image content: stable across re-encoding, format
+    (PNG/JPEG) and resizing. Returns None when Pillow is missing or the image cannot be decoded.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img).convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+            pixels = list(img.getdata())
+    except Exception:
+        return None
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class Deduplicator:
+    """
+    Collapses repeated uploads before analysis: byte-identical files within and across eyes and,
+    when enabled, near-identical re-encodings within one eye. Perceptual matches never cross eyes,
+    since the OS and OD scans of one patient can look alike while their findings differ. The first
+    upload of each cluster is described; its copies reuse that description at no cost.
+    :param max_distance: Largest dHash Hamming distance (out of HASH_SIZE**2 bits) treated as the same image,
+                         capped at MAX_PERCEPTUAL_DISTANCE; negative (the default) matches exact bytes only.
+    :param across_groups: Also merge byte-identical images of different eyes (only valid when both eyes use the same prompt).
+    :param token: pipeline.CancelToken of the report; cancels the shared calls with it.
+    """
+
+    def __init__(self, max_distance=None, across_groups=True, token=None):
+        max_distance = get_setting("DEDUP_MAX_DISTANCE", -1) if max_distance is None else max_distance
+        self.max_distance = min(max_distance, MAX_PERCEPTUAL_DISTANCE)
+        self.across_groups = across_groups
+        self.token = token
+        self.representative = {}
+        self.matches = []
+        self._items = {}
+        self._tasks = {}
+
+    def plan(self, items_by_group: dict, read=lambda item: item.getbuffer()) -> list:
+        """
+        Hash every upload and map each one to the first upload it duplicates.
+        :return: Matches as {"image", "duplicate_of", "match": "exact" | "perceptual", "distance"}.
+        """
+        seen = []  # (key, exact, phash) of representatives, in upload order
+        for group, items in items_by_group.items():
+            for index, item in enumerate(items):
+                key = (group, index)
+                self._items[key] = item
+                data = read(item)
+                exact, phash = exact_hash(data), perceptual_hash(data)
+                match = None
+                for rep_key, rep_exact, rep_phash in seen:
+                    if rep_key[0] != group and not self.across_groups:
+                        continue
+                    if exact == rep_exact:
+                        match = (rep_key, "exact", 0)
+                        break
+                    if rep_key[0] != group:
+                        continue
+                    if phash is not None and rep_phash is not None and self.max_distance >= 0:
+                        distance = hamming(phash, rep_phash)
+                        if distance <= self.max_distance and (match is None or distance < match[2]):
+                            match = (rep_key, "perceptual", distance)
+                if match is None:
+                    self.representative[key] = key
+                    seen.append((key, exact, phash))
+                else:
+                    self.representative[key] = match[0]
+                    self.matches.append({
+                        "image": _label(key), "duplicate_of": _label(match[0]), "match": match[1], "distance": match[2],
+                    })
+        return self.matches
+
+    def is_duplicate(self, group, index) -> bool:
+        return self.representative.get((group, index), (group, index)) != (group, index)
+
+    def wrap(self, describe):
+        """
+        describe(group, index, item, on_delta) that only calls `describe` for representatives;
+        duplicates wait for their representative and return a zero-cost copy of its result.
+        """
+        async def deduplicated(group, index, item, on_delta=None):
+            rep = self.representative.get((group, index), (group, index))
+            task = self._tasks.get(rep)
+            if task is None:
+                # Whichever of the cluster runs first starts the representative's call
+                rep_delta = on_delta if rep == (group, index) else None
+                task = asyncio.ensure_future(describe(rep[0], rep[1], self._items.get(rep, item), rep_delta))
+                self._tasks[rep] = task
+                if self.token is not None:
+                    self.token.track(task)
+            result = await asyncio.shield(task)
+            if rep == (group, index) or "error" in result:
+                return result
+            return {
+                **{k: v for k, v in result.items() if k != "hedge"},
+                "metadata": {},
+                "costs": dict(ZERO_COSTS),
+                "dedup": {"duplicate_of": _label(rep), "saved_tokens": _result_tokens(result), "saved_cost": result.get("costs", {}).get("total_cost", 0.0)},
+            }
+        return deduplicated
+
+    def unique_outputs(self, group, results: list) -> list:
+        """Descriptions for one eye's synthesis, without repeats of an image already in the same eye."""
+        outputs, seen = [], set()
+        for index, result in enumerate(results):
+            rep = self.representative.get((group, index), (group, index))
+            if rep in seen:
+                continue
+            seen.add(rep)
+            outputs.append(result["output"])
+        return outputs
+
+    def savings(self, results_by_group: dict) -> dict:
+        copies = [r["dedup"] for results in results_by_group.values() for r in results if r and r.get("dedup")]
+        return {
+            "uploads": len(self.representative),
+            "unique_images": sum(1 for key, rep in self.representative.items() if key == rep),
+            "calls_saved": len(copies),
+            "tokens_saved": sum(c["saved_tokens"] for c in copies),
+            "cost_saved": round(sum(c["saved_cost"] for c in copies), 6),
+            "matches": self.matches,
+        }
+
+
+def _label(key) -> str:
+    return f"{key[0]} #{key[1] + 1}"
+
+
+def _result_tokens(result: dict) -> int:
+    # Real usage when the representative was a fresh single call; otherwise an estimate
+    total = (result.get("metadata") or {}).get("total_tokens")
+    if total and not result.get("packed"):
+        return total
+    image = (result.get("preprocessing") or {}).get("processed_tokens") or 0
+    return image + text_tokens(result.get("output") or "")
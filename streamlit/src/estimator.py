@@ -0,0 +1,256 @@
+"""
+Token, cost and latency estimates for a report, made before anything is sent to Azure.
+
+Prices come from a per-model table (MODEL_PRICING overrides DEFAULT_PRICING), so o3-mini
+calls are no longer billed at gpt-4o rates. The completion length and latency of every
+call are recorded per (model, exam_type, stage) in a small SQLite store shared by the app
+and the job workers. From those observations estimate_exam() predicts an exam's cost and
+duration, and max_tokens_for() sizes each request's max_tokens instead of a fixed 800.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from messages import image_messages, report_messages
+from preprocess import get_profile, processed_dimensions
+from settings import get_setting
+from tokens import UNKNOWN_IMAGE_TOKENS, estimate_request_tokens, image_dimensions, image_tokens
+
+DEFAULT_USAGE_PATH = ".cache/redcheck_usage.sqlite"
+
+# USD per 1M tokens: (input, cached input, output). Looked up by the longest matching prefix
+DEFAULT_PRICING = {
+    "gpt-4o": (2.5, 1.25, 10.0),
+    "gpt-4o-mini": (0.15, 0.075, 0.6),
+    "o3-mini": (1.1, 0.55, 4.4),
+}
+# Models missing from the table are priced like gpt-4o
+FALLBACK_MODEL = "gpt-4o"
+# Cost breakdown of a call that cost nothing (cache hits, dedup copies, timeouts)
+ZERO_COSTS = {"input_cost": 0.0, "cached_input_cost": 0.0, "output_cost": 0.0, "total_cost": 0.0}
+
+# Used until a (model, exam_type, stage) has MIN_SAMPLES observations
+DEFAULT_OUTPUT_TOKENS = {"describe": 400, "describe_packed": 400, "synthesize": 800}
+DEFAULT_SECONDS = {"describe": 10.0, "describe_packed": 15.0, "synthesize": 20.0}
+MIN_SAMPLES = 5
+
+# max_tokens = p95 of the observed completion tokens plus headroom, within these bounds
+DEFAULT_MAX_TOKENS = 800
+MIN_MAX_TOKENS = 256
+MAX_TOKENS_CEILING = 4096
+MAX_TOKENS_HEADROOM = 1.3
+
+
+def model_pricing(model: str) -> dict:
+    table = {**DEFAULT_PRICING, **get_setting("MODEL_PRICING", {})}
+    matches = [name for name in table if (model or "").startswith(name)]
+    rates = table[max(matches, key=len)] if matches else table[FALLBACK_MODEL]
+    return dict(zip(("input_rate", "cached_rate", "output_rate"), rates))
+
+
+def token_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0, rates=None) -> dict:
+    """
+    Cost breakdown in USD, unrounded so per-call costs can be summed exactly.
+    :param rates: Overrides of the model's input_rate/cached_rate/output_rate (USD per 1M tokens).
+    """
+    rates = {**model_pricing(model), **(rates or {})}
+    input_cost = max(prompt_tokens - cached_tokens, 0) / 1_000_000 * rates["input_rate"]
+    cached_input_cost = cached_tokens / 1_000_000 * rates["cached_rate"]
+    output_cost = completion_tokens / 1_000_000 * rates["output_rate"]
+    return {
+        "input_cost": input_cost,
+        "cached_input_cost": cached_input_cost,
+        "output_cost": output_cost,
+        "total_cost": input_cost + cached_input_cost + output_cost,
+    }
+
+
+class UsageStats:
+    """
+    Completion tokens and latency of recent calls per (model, exam_type, stage), persisted
+    so the app sees what the worker processes measured. Reads keep the last `window`
+    samples of a key in memory and reload them every `refresh_seconds`.
+    """
+
+    # Rows kept in the table; older ones are dropped now and then
+    MAX_ROWS = 50_000
+
+    def __init__(self, path: str, window: int = 200, refresh_seconds: float = 30.0):
+        self.path = path
+        self.window = window
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._conn = None
+        self._samples = {}
+        self._inserts = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS observations ("
+                " id INTEGER PRIMARY KEY, model TEXT NOT NULL, exam_type TEXT NOT NULL, stage TEXT NOT NULL,"
+                " completion_tokens INTEGER NOT NULL, seconds REAL NOT NULL, truncated INTEGER NOT NULL, created REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS observations_key ON observations (model, exam_type, stage, id)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def observe(self, model: str, exam_type: str, stage: str, completion_tokens: int, seconds: float, truncated: bool = False):
+        """Record one finished call (blocking: call it off the event loop)."""
+        sample = (completion_tokens, seconds, bool(truncated))
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO observations (model, exam_type, stage, completion_tokens, seconds, truncated, created)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (model, exam_type, stage, completion_tokens, seconds, int(truncated), time.time()),
+            )
+            self._inserts += 1
+            if self._inserts % 1000 == 0:
+                conn.execute("DELETE FROM observations WHERE id <= (SELECT MAX(id) FROM observations) - ?", (self.MAX_ROWS,))
+            conn.commit()
+            entry = self._samples.get((model, exam_type, stage))
+            if entry is not None:
+                entry[1].append(sample)
+                del entry[1][:-self.window]
+
+    def samples(self, model: str, exam_type: str, stage: str) -> list:
+        """Recent (completion_tokens, seconds, truncated) tuples, oldest first."""
+        key = (model, exam_type, stage)
+        with self._lock:
+            entry = self._samples.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.refresh_seconds:
+                rows = self._connect().execute(
+                    "SELECT completion_tokens, seconds, truncated FROM observations"
+                    " WHERE model = ? AND exam_type = ? AND stage = ? ORDER BY id DESC LIMIT ?",
+                    (*key, self.window),
+                ).fetchall()
+                entry = (time.monotonic(), [(tokens, seconds, bool(truncated)) for tokens, seconds, truncated in reversed(rows)])
+                self._samples[key] = entry
+            return list(entry[1])
+
+    def quantile(self, model: str, exam_type: str, stage: str, field: str, q: float):
+        """
+        :param field: "completion_tokens" or "seconds".
+        :return: The q-quantile over recent samples, or None with fewer than MIN_SAMPLES.
+        """
+        column = ("completion_tokens", "seconds").index(field)
+        values = sorted(sample[column] for sample in self.samples(model, exam_type, stage))
+        if len(values) < MIN_SAMPLES:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT model, exam_type, stage, COUNT(*), AVG(completion_tokens), MAX(completion_tokens),"
+                " AVG(seconds), SUM(truncated) FROM observations GROUP BY model, exam_type, stage"
+            ).fetchall()
+        return {
+            f"{model}/{exam_type}/{stage}": {
+                "samples": count,
+                "avg_completion_tokens": round(avg_tokens),
+                "max_completion_tokens": max_tokens,
+                "avg_seconds": round(avg_seconds, 2),
+                "truncated": truncated,
+            }
+            for model, exam_type, stage, count, avg_tokens, max_tokens, avg_seconds, truncated in rows
+        }
+
+
+usage_stats = UsageStats(get_setting("USAGE_STATS_PATH", DEFAULT_USAGE_PATH))
+
+
+def max_tokens_for(model: str, exam_type: str, stage: str, images: int = 1) -> int:
+    """
+    max_tokens for a request: the p95 completion length observed for this model, exam type
+    and stage (per image for packed requests) plus MAX_TOKENS_HEADROOM, or
+    DEFAULT_MAX_TOKENS until there are enough observations.
+    """
+    per_image = DEFAULT_MAX_TOKENS
+    if get_setting("ADAPTIVE_MAX_TOKENS", True):
+        observed = usage_stats.quantile(model, exam_type, stage, "completion_tokens", get_setting("MAX_TOKENS_QUANTILE", 0.95))
+        if observed is not None:
+            per_image = min(max(math.ceil(observed * MAX_TOKENS_HEADROOM), MIN_MAX_TOKENS), MAX_TOKENS_CEILING)
+    return min(per_image * images, MAX_TOKENS_CEILING)
+
+
+def expected_output_tokens(model: str, exam_type: str, stage: str) -> int:
+    observed = usage_stats.quantile(model, exam_type, stage, "completion_tokens", 0.5)
+    return observed if observed is not None else DEFAULT_OUTPUT_TOKENS[stage]
+
+
+def expected_seconds(model: str, exam_type: str, stage: str, q: float = 0.5) -> float:
+    observed = usage_stats.quantile(model, exam_type, stage, "seconds", q)
+    return observed if observed is not None else DEFAULT_SECONDS[stage]
+
+
+def upload_image_tokens(image, exam_type: str) -> int:
+    """Input tokens of one upload (anything with getbuffer()) once preprocessed for the exam type."""
+    detail = get_profile(exam_type)["detail"]
+    dims = image_dimensions(image.getbuffer())
+    if not dims:
+        return UNKNOWN_IMAGE_TOKENS
+    return image_tokens(*processed_dimensions(*dims, exam_type), detail=detail)
+
+
+def estimate_exam(options: dict, images_by_eye: dict) -> dict:
+    """
+    Predicted tokens, cost and duration of a report run, before any request is sent.
+    An upper bound on cost: every image is described (no cache hits or dedup) and no prompt
+    tokens are assumed cached. Eyes and their images run in parallel, so the duration is the
+    slowest eye's p90 description plus its median synthesis.
+    :param options: reports.DEFAULT_OPTIONS keys.
+    :param images_by_eye: eye -> uploads with getbuffer() (UploadedFile or jobs.StoredImage).
+    """
+    exam_type = options["exam_type"]
+    description_model, reasoning_model = options["description_model"], options["reasoning_model"]
+    detail = get_profile(exam_type)["detail"]
+    stages = {stage: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0} for stage in ("describe", "synthesize")}
+    eye_seconds = {}
+    describe_output = expected_output_tokens(description_model, exam_type, "describe")
+    synthesize_output = expected_output_tokens(reasoning_model, exam_type, "synthesize")
+
+    for eye, images in images_by_eye.items():
+        if not images:
+            continue
+        text = estimate_request_tokens(image_messages("", detail, exam_type, options["prompts"].get(eye, "")), images=False)
+        for image in images:
+            stages["describe"]["calls"] += 1
+            stages["describe"]["prompt_tokens"] += text + upload_image_tokens(image, exam_type)
+            stages["describe"]["completion_tokens"] += describe_output
+        # The report's input is the prompt and layout plus every description of the eye
+        stages["synthesize"]["calls"] += 1
+        stages["synthesize"]["prompt_tokens"] += (
+            estimate_request_tokens(report_messages([], options["reasoning_prompt"], options["layout"]))
+            + describe_output * len(images)
+        )
+        stages["synthesize"]["completion_tokens"] += synthesize_output
+        eye_seconds[eye] = (
+            expected_seconds(description_model, exam_type, "describe", 0.9)
+            + expected_seconds(reasoning_model, exam_type, "synthesize")
+        )
+
+    for stage, model in (("describe", description_model), ("synthesize", reasoning_model)):
+        s = stages[stage]
+        s["model"] = model
+        s["cost"] = token_cost(model, s["prompt_tokens"], s["completion_tokens"])["total_cost"]
+        s["max_tokens"] = max_tokens_for(model, exam_type, stage)
+        s["observed"] = len(usage_stats.samples(model, exam_type, stage))
+    return {
+        "stages": stages,
+        "total_cost": stages["describe"]["cost"] + stages["synthesize"]["cost"],
+        "seconds": round(max(eye_seconds.values(), default=0.0), 1),
+    }
+
+
+def over_budget(cost: float, max_cost: float) -> bool:
+    """max_cost is the report's budget in USD; 0 or None means no limit."""
+    return bool(max_cost) and cost > max_cost
@@ -0,0 +1,131 @@
+import asyncio
+import math
+import threading
+import time
+from collections import defaultdict, deque
+
+from settings import get_setting
+
+DEFAULT_DEADLINES = {"describe": 90.0, "synthesize": 180.0}
+
+
+def stage_deadline(stage: str) -> float:
+    """Seconds a whole stage call (queueing, retries, failover included) may take; STAGE_DEADLINES overrides."""
+    return {**DEFAULT_DEADLINES, **(get_setting("STAGE_DEADLINES") or {})}.get(stage)
+
+
+async def within_deadline(coro, stage: str, on_timeout):
+    """
+    Await `coro`, giving up after the stage deadline.
+    :param on_timeout: on_timeout(seconds) -> result returned instead when the deadline passes.
+    """
+    seconds = stage_deadline(stage)
+    if not seconds:
+        return await coro
+    try:
+        return await asyncio.wait_for(coro, seconds)
+    except asyncio.TimeoutError:
+        return on_timeout(seconds)
+
+
+class LatencyTracker:
+    """Recent latencies of uncached calls per (model, exam_type), for picking the hedge delay."""
+
+    def __init__(self, window=200, min_samples=10):
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+
+    def observe(self, model: str, exam_type: str, seconds: float):
+        with self._lock:
+            self._samples[(model, exam_type)].append(seconds)
+
+    def quantile(self, model: str, exam_type: str, q: float):
+        with self._lock:
+            samples = sorted(self._samples.get((model, exam_type), ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, max(0, math.ceil(q * len(samples)) - 1))]
+
+    def stats(self) -> dict:
+        with self._lock:
+            keys = list(self._samples)
+        return {
+            f"{model} / {exam_type}": {
+                "samples": len(self._samples[(model, exam_type)]),
+                "p50_seconds": self.quantile(model, exam_type, 0.5),
+                "p90_seconds": self.quantile(model, exam_type, 0.9),
+            }
+            for model, exam_type in keys
+        }
+
+
+class HedgeBudget:
+    """Caps how many duplicate requests one report may send."""
+
+    def __init__(self, max_hedges: int):
+        self.max_hedges = max_hedges
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.used >= self.max_hedges:
+                return False
+            self.used += 1
+            return True
+
+
+async def _timed(coro):
+    start = time.monotonic()
+    result = await coro
+    return result, time.monotonic() - start
+
+
+async def hedged(attempt, delay, budget):
+    """
+    Run attempt(primary=True); if it has not finished after `delay` seconds and the budget
+    allows, also run attempt(primary=False). The first successful answer wins and the other
+    is cancelled.
+    :param attempt: attempt(primary: bool) -> coroutine returning an analyze_image-style result.
+    :param delay: Seconds before hedging, or None to never hedge.
+    :return: (result, seconds since the primary started until the winning answer, info) where info
+             is None when no hedge was sent, else {"after_seconds", "winner": "primary" | "hedge"}.
+    """
+    primary = asyncio.ensure_future(_timed(attempt(True)))
+    if delay is None:
+        result, seconds = await primary
+        return result, seconds, None
+
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done or not budget.try_acquire():
+        result, seconds = await primary
+        return result, seconds, None
+
+    hedge = asyncio.ensure_future(_timed(attempt(False)))
+    info = {"after_seconds": round(delay, 3), "winner": None}
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    continue
+                result, seconds = task.result()
+                # An error result only wins if the other attempt fails too
+                if "error" in result and pending:
+                    continue
+                info["winner"] = "primary" if task is primary else "hedge"
+                return result, seconds if task is primary else delay + seconds, info
+        # Neither attempt succeeded: return an error result if there is one, else re-raise the primary's
+        task = hedge if primary.exception() is not None and hedge.exception() is None else primary
+        info["winner"] = "primary" if task is primary else "hedge"
+        result, seconds = task.result()
+        return result, seconds if task is primary else delay + seconds, info
+    finally:
+        for task in (primary, hedge):
+            if not task.done():
+                task.cancel()
+
+
+latency_tracker = LatencyTracker(min_samples=get_setting("HEDGE_MIN_SAMPLES", 10))
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from settings import get_setting
+
+DEFAULT_HISTORY_PATH = ".cache/redcheck_history.sqlite"
+
+# Cost keys summed per eye (hedged_requests is a count, kept apart)
+COST_KEYS = ("input_cost", "cached_input_cost", "output_cost", "hedge_cost_estimate", "total_cost")
+
+
+def fts_query(text: str) -> str:
+    """User text as an FTS5 query: every word must match, as a prefix; operators are taken literally."""
+    terms = [term.replace('"', '""') for term in text.split()]
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+class ReportHistory:
+    """
+    Persistent store of generated eye reports, one record per eye, so past exams can be
+    reopened and compared without calling Azure again. Records are indexed by patient,
+    exam type and exam date; re-generating the same exam adds a new version. The report's
+    description and diagnosis_description are full-text indexed with FTS5 (plain LIKE
+    search when the SQLite build lacks FTS5).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self.fts = True
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS reports ("
+                " id INTEGER PRIMARY KEY, job_id TEXT, owner TEXT, patient TEXT NOT NULL, exam_type TEXT NOT NULL,"
+                " exam_date TEXT NOT NULL, eye TEXT NOT NULL, version INTEGER NOT NULL, created REAL NOT NULL,"
+                " description_model TEXT, reasoning_model TEXT, diagnosis TEXT, image_hashes TEXT NOT NULL,"
+                " descriptions TEXT NOT NULL, report TEXT NOT NULL, costs TEXT NOT NULL, timings TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS reports_exam ON reports (patient, exam_type, exam_date, eye, version)")
+            conn.execute("CREATE INDEX IF NOT EXISTS reports_date ON reports (exam_date, created)")
+            try:
+                conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS reports_fts USING fts5(description, diagnosis_description)"
+                )
+            except sqlite3.OperationalError:
+                self.fts = False
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def save(self, record: dict) -> dict:
+        """
+        Store one eye's report as the next version of its (patient, exam_type, exam_date, eye).
+        :param record: patient, exam_type, exam_date, eye, image_hashes, descriptions, report, costs,
+                       and optionally job_id, owner, description_model, reasoning_model, timings.
+        :return: {"id", "version"}.
+        """
+        report = record["report"] if isinstance(record["report"], dict) else {"description": str(record["report"])}
+        with self._lock:
+            conn = self._connect()
+            # Versions are numbered per exam; hold the write lock so concurrent workers cannot collide
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute(
+                    "SELECT COALESCE(MAX(version), 0) + 1 FROM reports"
+                    " WHERE patient = ? AND exam_type = ? AND exam_date = ? AND eye = ?",
+                    (record["patient"], record["exam_type"], record["exam_date"], record["eye"]),
+                ).fetchone()[0]
+                cursor = conn.execute(
+                    "INSERT INTO reports (job_id, owner, patient, exam_type, exam_date, eye, version, created,"
+                    " description_model, reasoning_model, diagnosis, image_hashes, descriptions, report, costs, timings)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        record.get("job_id"), record.get("owner"), record["patient"], record["exam_type"],
+                        record["exam_date"], record["eye"], version, time.time(),
+                        record.get("description_model"), record.get("reasoning_model"), report.get("diagnosis"),
+                        json.dumps(record["image_hashes"]), json.dumps(record["descriptions"], ensure_ascii=False),
+                        json.dumps(report, ensure_ascii=False), json.dumps(record["costs"]),
+                        json.dumps(record.get("timings"), default=str),
+                    ),
+                )
+                if self.fts:
+                    conn.execute(
+                        "INSERT INTO reports_fts (rowid, description, diagnosis_description) VALUES (?, ?, ?)",
+                        (cursor.lastrowid, str(report.get("description") or ""), str(report.get("diagnosis_description") or "")),
+                    )
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+            report_id = cursor.lastrowid
+        return {"id": report_id, "version": version}
+
+    def get(self, report_id: int):
+        with self._lock:
+            row = self._connect().execute("SELECT * FROM reports WHERE id = ?", (report_id,)).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        for column in ("image_hashes", "descriptions", "report", "costs", "timings"):
+            record[column] = json.loads(record[column]) if record[column] is not None else None
+        return record
+
+    def search(self, text: str = "", patient: str = "", exam_type: str = None, date_from: str = None,
+               date_to: str = None, limit: int = 50) -> list:
+        """
+        Matching records, newest exam first, without their descriptions (load one with get()).
+        :param text: Words searched in the report's description and diagnosis_description.
+        :param patient: Patient id prefix.
+        :param date_from: ISO date (inclusive); date_to likewise.
+        """
+        with self._lock:
+            # Opening the database settles whether FTS5 is available
+            self._connect()
+        query = (
+            "SELECT r.id, r.patient, r.exam_type, r.exam_date, r.eye, r.version, r.diagnosis, r.created,"
+            " r.description_model, r.reasoning_model, json_extract(r.costs, '$.total_cost') AS total_cost"
+        )
+        where, params = [], []
+        if text.strip() and self.fts:
+            query += ", snippet(reports_fts, -1, '**', '**', '…', 12) AS snippet"
+            query += " FROM reports_fts JOIN reports r ON r.id = reports_fts.rowid"
+            where.append("reports_fts MATCH ?")
+            params.append(fts_query(text))
+        else:
+            query += ", NULL AS snippet FROM reports r"
+            if text.strip():
+                for term in text.split():
+                    where.append("(json_extract(r.report, '$.description') LIKE ? OR json_extract(r.report, '$.diagnosis_description') LIKE ?)")
+                    params += [f"%{term}%", f"%{term}%"]
+        if patient:
+            where.append("r.patient LIKE ?")
+            params.append(f"{patient}%")
+        if exam_type:
+            where.append("r.exam_type = ?")
+            params.append(exam_type)
+        if date_from:
+            where.append("r.exam_date >= ?")
+            params.append(date_from)
+        if date_to:
+            where.append("r.exam_date <= ?")
+            params.append(date_to)
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY r.exam_date DESC, r.patient, r.eye, r.version DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._connect().execute(query, params).fetchall()
+        return [dict(row) for row in rows]
+
+    def versions(self, patient: str, exam_type: str, exam_date: str, eye: str) -> list:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT id, version, created, diagnosis, description_model, reasoning_model FROM reports"
+                " WHERE patient = ? AND exam_type = ? AND exam_date = ? AND eye = ? ORDER BY version",
+                (patient, exam_type, exam_date, eye),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def stats(self) -> dict:
+        with self._lock:
+            conn = self._connect()
+            reports, patients = conn.execute("SELECT COUNT(*), COUNT(DISTINCT patient) FROM reports").fetchone()
+        return {"reports": reports, "patients": patients, "full_text_search": self.fts}
+
+
+def image_hashes(images: list) -> list:
+    """sha256 of each image (anything with getbuffer(), e.g. jobs.StoredImage)."""
+    return [hashlib.sha256(image.getbuffer()).hexdigest() for image in images]
+
+
+def result_records(options: dict, result: dict, hashes_by_eye: dict) -> list:
+    """
+    One history record per eye of a finished reports.ReportRun result.
+    Costs are that eye's descriptions plus its report; timings come from the critical path.
+    """
+    records = []
+    for eye, report in result["reports"].items():
+        if isinstance(report, dict) and "error" in report:
+            continue
+        descriptions = result["descriptions"][eye]
+        costs = {key: 0.0 for key in COST_KEYS}
+        for r in descriptions + [{"costs": result["report_costs"].get(eye, {})}]:
+            for key in COST_KEYS:
+                costs[key] += ((r or {}).get("costs") or {}).get(key, 0.0)
+        records.append({
+            "patient": options.get("patient") or "unknown",
+            "exam_type": options["exam_type"],
+            "exam_date": options.get("exam_date") or time.strftime("%Y-%m-%d"),
+            "eye": eye,
+            "description_model": options.get("description_model"),
+            "reasoning_model": options.get("reasoning_model"),
+            "image_hashes": hashes_by_eye.get(eye, []),
+            "descriptions": [(r or {}).get("output") for r in descriptions],
+            "report": report,
+            "costs": {key: round(value, 6) for key, value in costs.items()},
+            "timings": (result.get("critical_path") or {}).get("groups", {}).get(eye),
+        })
+    return records
+
+
+report_history = ReportHistory(get_setting("HISTORY_PATH", DEFAULT_HISTORY_PATH))
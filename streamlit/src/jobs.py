@@ -0,0 +1,498 @@
+"""
+Persistent queue of report-generation jobs, served by worker processes outside the
+Streamlit script run.
+
+The app submits a job (its options plus the uploaded images, saved under JOB_DIR) and
+polls the job's progress. Reruns, browser refreshes and second clicks reattach to the
+running job instead of abandoning it and starting over. Workers claim queued jobs from
+the shared SQLite queue, so every session, and every Streamlit process on the host,
+shares one bounded pool. A job whose worker stops heartbeating is requeued (up to
+JOB_MAX_ATTEMPTS runs) or failed. A job that stopped early keeps its partial result;
+retry() queues it again so that only the failed images are described anew.
+
+The app starts JOB_WORKERS workers itself (default 2); with JOB_WORKERS = 0 run a
+shared pool instead. Commands (run from the repository root):
+    python streamlit/src/jobs.py pool --workers 4
+    python streamlit/src/jobs.py worker
+    python streamlit/src/jobs.py list [--owner USER]
+    python streamlit/src/jobs.py cancel JOB_ID
+    python streamlit/src/jobs.py retry JOB_ID
+"""
+import argparse
+import json
+import mmap
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from history import image_hashes, report_history, result_records
+from settings import get_setting
+
+DEFAULT_JOB_DB_PATH = ".cache/redcheck_jobs.sqlite"
+DEFAULT_JOB_DIR = ".cache/jobs"
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# Columns holding JSON
+_JSON_COLUMNS = ("options", "images", "progress", "result")
+
+
+class StoredImage:
+    """
+    Uploaded image saved with its job, read like an upload. getbuffer() maps the file
+    once, so hashing, dedup, hedged attempts and encoding all share the same pages
+    instead of each reading their own copy.
+    """
+
+    def __init__(self, path: str, name: str):
+        self.path = path
+        self.name = name
+        self.size = os.path.getsize(path)
+        self._map = None
+
+    def getbuffer(self) -> memoryview:
+        if self.size == 0:
+            return memoryview(b"")
+        if self._map is None:
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)
+
+    def getvalue(self) -> bytes:
+        return bytes(self.getbuffer())
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # A view is still referenced somewhere; the map is freed with it
+                return
+            self._map = None
+
+
+class JobStore:
+    """
+    SQLite-backed job queue shared by the app and the workers (any number of processes).
+    :param stale_seconds: A running job without a heartbeat for this long lost its worker.
+    :param retention_seconds: Finished jobs (and their images) older than this are purged.
+    """
+
+    def __init__(self, path: str, job_dir: str, stale_seconds: float = 60.0, retention_seconds: float = 7 * 24 * 3600,
+                 max_attempts: int = 2):
+        self.path = path
+        self.job_dir = job_dir
+        self.stale_seconds = stale_seconds
+        self.retention_seconds = retention_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Autocommit; claims take the write lock explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, owner TEXT, status TEXT NOT NULL, options TEXT NOT NULL, images TEXT NOT NULL,"
+                " progress TEXT, result TEXT, error TEXT, cancel_requested INTEGER NOT NULL DEFAULT 0,"
+                " attempts INTEGER NOT NULL DEFAULT 0, worker TEXT,"
+                " created REAL NOT NULL, started REAL, heartbeat REAL, finished REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, created)")
+            self._conn = conn
+        return self._conn
+
+    def submit(self, owner: str, options: dict, images_by_group: dict) -> str:
+        """
+        Queue a job.
+        :param images_by_group: eye -> list of (file name, bytes-like, e.g. UploadedFile.getbuffer());
+                                saved under JOB_DIR/<job id>.
+        :return: The job id.
+        """
+        job_id = uuid.uuid4().hex
+        directory = os.path.join(self.job_dir, job_id)
+        os.makedirs(directory, exist_ok=True)
+        images = {}
+        for group, files in images_by_group.items():
+            images[group] = []
+            for index, (name, data) in enumerate(files):
+                # Keep the original extension; the mime type is guessed from it
+                path = os.path.join(directory, f"{group}_{index}_{os.path.basename(name)}")
+                with open(path, "wb") as f:
+                    f.write(data)
+                images[group].append({"name": name, "path": path})
+        return self._queue(job_id, owner, options, images)
+
+    def retry(self, job_id: str) -> str:
+        """
+        Queue a finished job again as a new job with the same images (hard-linked, so the old job can be
+        purged independently). Its successful descriptions and reports go along as options["previous"],
+        so only the images that failed or never ran, and the reports depending on them, are generated.
+        :return: The new job id.
+        """
+        job = self.get(job_id)
+        if job is None or job["status"] not in FINISHED:
+            raise ValueError(f"job {job_id} is not finished")
+        new_id = uuid.uuid4().hex
+        directory = os.path.join(self.job_dir, new_id)
+        os.makedirs(directory, exist_ok=True)
+        images = {}
+        for group, items in job["images"].items():
+            images[group] = []
+            for item in items:
+                path = os.path.join(directory, os.path.basename(item["path"]))
+                try:
+                    os.link(item["path"], path)
+                except OSError:
+                    shutil.copyfile(item["path"], path)
+                images[group].append({"name": item["name"], "path": path})
+        options = {**job["options"], "previous": reusable_results(job["result"])}
+        return self._queue(new_id, job["owner"], options, images)
+
+    def _queue(self, job_id: str, owner: str, options: dict, images: dict) -> str:
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO jobs (id, owner, status, options, images, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, owner, QUEUED, json.dumps(options, ensure_ascii=False), json.dumps(images), time.time()),
+            )
+        self.purge()
+        return job_id
+
+    def claim(self, worker: str):
+        """Take the oldest queued job for `worker`, requeueing jobs whose worker died first."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                stale = now - self.stale_seconds
+                conn.execute(
+                    "UPDATE jobs SET status = ?, finished = ? WHERE status = ? AND heartbeat < ? AND cancel_requested = 1",
+                    (CANCELLED, now, RUNNING, stale),
+                )
+                conn.execute(
+                    "UPDATE jobs SET status = ?, finished = ?, error = 'worker stopped responding'"
+                    " WHERE status = ? AND heartbeat < ? AND attempts >= ?",
+                    (FAILED, now, RUNNING, stale, self.max_attempts),
+                )
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND heartbeat < ?",
+                    (QUEUED, RUNNING, stale),
+                )
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE status = ? ORDER BY created LIMIT 1", (QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, started = ?, heartbeat = ?"
+                        " WHERE id = ?",
+                        (RUNNING, worker, now, now, row["id"]),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return self.get(row["id"]) if row is not None else None
+
+    def heartbeat(self, job_id: str, progress=None) -> bool:
+        """
+        Mark the job alive and store its latest progress.
+        :return: True when cancellation was requested.
+        """
+        with self._lock:
+            conn = self._connect()
+            if progress is None:
+                conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id))
+            else:
+                conn.execute(
+                    "UPDATE jobs SET heartbeat = ?, progress = ? WHERE id = ?",
+                    (time.time(), json.dumps(progress, ensure_ascii=False, default=str), job_id),
+                )
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def finish(self, job_id: str, status: str, result=None, error=None, progress=None):
+        with self._lock:
+            self._connect().execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, progress = COALESCE(?, progress), finished = ?"
+                " WHERE id = ?",
+                (
+                    status,
+                    json.dumps(result, ensure_ascii=False, default=str) if result is not None else None,
+                    error,
+                    json.dumps(progress, ensure_ascii=False, default=str) if progress is not None else None,
+                    time.time(),
+                    job_id,
+                ),
+            )
+
+    def cancel(self, job_id: str):
+        """Ask the worker to stop the job; a job still queued is cancelled right away."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?",
+                (CANCELLED, time.time(), job_id, QUEUED),
+            )
+
+    def get(self, job_id: str):
+        with self._lock:
+            row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job(row) if row is not None else None
+
+    def position(self, job_id: str) -> int:
+        """Number of queued jobs ahead of this one."""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND created < (SELECT created FROM jobs WHERE id = ?)",
+                (QUEUED, job_id),
+            ).fetchone()[0]
+
+    def active(self, owner: str):
+        """The owner's most recent queued or running job, if any."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT * FROM jobs WHERE owner = ? AND status IN (?, ?) ORDER BY created DESC LIMIT 1",
+                (owner, QUEUED, RUNNING),
+            ).fetchone()
+        return _job(row) if row is not None else None
+
+    def list(self, owner=None, limit: int = 20) -> list:
+        """Most recent jobs, without their (large) progress and result."""
+        query = "SELECT id, owner, status, error, attempts, worker, created, started, finished FROM jobs"
+        params = ()
+        if owner is not None:
+            query += " WHERE owner = ?"
+            params = (owner,)
+        with self._lock:
+            rows = self._connect().execute(query + " ORDER BY created DESC LIMIT ?", params + (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def purge(self):
+        cutoff = time.time() - self.retention_seconds
+        with self._lock:
+            conn = self._connect()
+            expired = [row["id"] for row in conn.execute(
+                f"SELECT id FROM jobs WHERE status IN ({','.join('?' * len(FINISHED))}) AND finished < ?",
+                FINISHED + (cutoff,),
+            )]
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in expired])
+        for job_id in expired:
+            shutil.rmtree(os.path.join(self.job_dir, job_id), ignore_errors=True)
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            oldest = conn.execute("SELECT MIN(created) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+            workers = conn.execute("SELECT COUNT(DISTINCT worker) FROM jobs WHERE status = ?", (RUNNING,)).fetchone()[0]
+        return {
+            "by_status": counts,
+            "queue_depth": counts.get(QUEUED, 0),
+            "oldest_queued_seconds": round(now - oldest, 1) if oldest else 0.0,
+            "busy_workers": workers,
+        }
+
+
+def _job(row) -> dict:
+    job = dict(row)
+    for column in _JSON_COLUMNS:
+        if job.get(column) is not None:
+            job[column] = json.loads(job[column])
+    job["cancel_requested"] = bool(job["cancel_requested"])
+    return job
+
+
+def reusable_results(result) -> dict:
+    """Successful descriptions (None where an image failed or never ran) and reports of a job's result."""
+    if not result:
+        return {}
+    return {
+        "descriptions": {
+            group: [r if r and "error" not in r else None for r in results]
+            for group, results in result["descriptions"].items()
+        },
+        "reports": {
+            group: report for group, report in result["reports"].items()
+            if not (isinstance(report, dict) and "error" in report)
+        },
+    }
+
+
+def retryable(job: dict) -> bool:
+    """A finished job missing some description or report, which retry() could complete."""
+    if job["status"] not in FINISHED:
+        return False
+    previous = reusable_results(job["result"])
+    if not previous:
+        return True
+    return len(previous["reports"]) < len(job["images"]) or any(
+        None in results for results in previous["descriptions"].values()
+    )
+
+
+def save_history(job: dict, result: dict, hashes_by_group: dict) -> list:
+    """Store each eye's finished report in the report history; a history failure does not fail the job."""
+    try:
+        return [
+            {"eye": record["eye"], **report_history.save({**record, "job_id": job["id"], "owner": job["owner"]})}
+            for record in result_records(job["options"], result, hashes_by_group)
+        ]
+    except sqlite3.Error as e:
+        print(f"job {job['id']}: report history not saved: {e}", file=sys.stderr)
+        return []
+
+
+def run_job(store: JobStore, job: dict, poll_seconds: float):
+    """Run one claimed job to completion, heartbeating its progress and honouring cancellation."""
+    from reports import ReportRun
+
+    images = {group: [StoredImage(i["path"], i["name"]) for i in items] for group, items in job["images"].items()}
+    run = ReportRun(job["options"], images)
+    stop = threading.Event()
+
+    def watch():
+        # Progress and liveness go out from here, so a slow model call never looks like a dead worker
+        while not stop.wait(poll_seconds):
+            if store.heartbeat(job["id"], run.progress()) and not run.cancelled:
+                # Cancels the report's pending and in-flight requests, including shared dedup/packing calls
+                run.cancel()
+
+    watcher = threading.Thread(target=watch, name=f"job-{job['id'][:8]}", daemon=True)
+    watcher.start()
+    try:
+        result = run.run()
+        if not result["cancelled"]:
+            result["history"] = save_history(job, result, {group: image_hashes(stored) for group, stored in images.items()})
+    except Exception as e:
+        store.finish(job["id"], FAILED, error=f"{type(e).__name__}: {e}", progress=run.progress())
+        return
+    finally:
+        stop.set()
+        watcher.join()
+        for stored in images.values():
+            for image in stored:
+                image.close()
+    aborted = result["aborted"] or {}
+    if aborted.get("reason") == "error":
+        # Stopped at the first failed call: the partial result stays for a retry
+        store.finish(job["id"], FAILED, result=result, error=aborted["detail"], progress=run.progress())
+    else:
+        store.finish(job["id"], CANCELLED if result["cancelled"] else DONE, result=result, progress=run.progress())
+
+
+def run_worker(store: JobStore, poll_seconds: float, parent_pid=None):
+    """Claim and run jobs one at a time; exits when the launching app process goes away."""
+    from loaders import lazy_import
+
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    # Pay the heavy imports (openai, httpx, PIL) while idle, not on the first job
+    start = time.monotonic()
+    lazy_import("reports")
+    print(f"worker {worker} ready in {time.monotonic() - start:.2f}s, polling {store.path}", file=sys.stderr)
+    while parent_pid is None or os.getppid() == parent_pid:
+        job = store.claim(worker)
+        if job is None:
+            time.sleep(poll_seconds)
+            continue
+        print(f"worker {worker} running job {job['id']}", file=sys.stderr)
+        run_job(store, job, poll_seconds)
+
+
+_workers = []
+_workers_lock = threading.Lock()
+
+
+def start_workers(count=None, api_key=None) -> int:
+    """
+    Keep `count` (default: JOB_WORKERS setting) worker processes running for this app process.
+    Safe to call on every Streamlit rerun; dead workers are replaced.
+    :param api_key: Azure key handed to the workers when config_azure and the environment have none.
+    :return: Number of live workers.
+    """
+    count = get_setting("JOB_WORKERS", 2) if count is None else count
+    env = dict(os.environ)
+    if api_key and not env.get("AZURE_OPENAI_API_KEY"):
+        env["AZURE_OPENAI_API_KEY"] = api_key
+    with _workers_lock:
+        _workers[:] = [p for p in _workers if p.poll() is None]
+        while len(_workers) < count:
+            _workers.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "worker", "--parent-pid", str(os.getpid())], env=env,
+            ))
+        return len(_workers)
+
+
+job_store = JobStore(
+    get_setting("JOB_DB_PATH", DEFAULT_JOB_DB_PATH),
+    get_setting("JOB_DIR", DEFAULT_JOB_DIR),
+    stale_seconds=get_setting("JOB_STALE_SECONDS", 60.0),
+    retention_seconds=get_setting("JOB_RETENTION_SECONDS", 7 * 24 * 3600),
+    max_attempts=get_setting("JOB_MAX_ATTEMPTS", 2),
+)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report-generation job queue and workers.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    worker = sub.add_parser("worker", help="run one worker process")
+    worker.add_argument("--parent-pid", type=int, help="exit when this process is no longer the parent")
+    pool = sub.add_parser("pool", help="run a pool of worker processes")
+    pool.add_argument("--workers", type=int, default=get_setting("JOB_WORKERS", 2) or 2)
+    listing = sub.add_parser("list", help="show recent jobs")
+    listing.add_argument("--owner")
+    listing.add_argument("--limit", type=int, default=20)
+    cancel = sub.add_parser("cancel", help="cancel a job")
+    cancel.add_argument("job_id")
+    retry = sub.add_parser("retry", help="queue a finished job again, redoing only what failed")
+    retry.add_argument("job_id")
+    args = parser.parse_args(argv)
+
+    poll_seconds = get_setting("JOB_POLL_SECONDS", 0.5)
+    if args.command == "worker":
+        run_worker(job_store, poll_seconds, args.parent_pid)
+    elif args.command == "pool":
+        processes = [
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), "worker", "--parent-pid", str(os.getpid())])
+            for _ in range(args.workers)
+        ]
+        try:
+            for process in processes:
+                process.wait()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+    elif args.command == "list":
+        print(json.dumps({"jobs": job_store.list(args.owner, args.limit), "stats": job_store.stats()}, indent=2))
+    elif args.command == "cancel":
+        job_store.cancel(args.job_id)
+        job = job_store.get(args.job_id)
+        print(f"{args.job_id}: {job['status'] if job else 'unknown job'}")
+    elif args.command == "retry":
+        try:
+            print(job_store.retry(args.job_id))
+        except ValueError as e:
+            sys.exit(str(e))
+
+
+if __name__ == "__main__":
+    main()
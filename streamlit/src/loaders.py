@@ -0,0 +1,125 @@
+"""
+Process-wide cache for the app's config files, plus lazy imports, for cheaper Streamlit reruns and cold start.
+
+Every rerun (each keystroke in a prompt box) used to re-read and re-parse auth.yaml and
+layouts.json. Here a file is parsed once per process and shared by every session, and it
+is parsed again only when its mtime or size changes. Heavy modules are imported on first
+use through lazy_import. Import, config-load and rerun times are tracked in telemetry
+(redcheck_import_seconds, redcheck_config_load_seconds, redcheck_rerun_seconds) and
+summarized by timings().
+"""
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+import telemetry
+
+AUTH_CONFIG_PATH = "streamlit/src/auth.yaml"
+LAYOUTS_PATH = "streamlit/src/layouts.json"
+
+telemetry.metrics.describe("redcheck_import_seconds", "First import of lazily loaded modules.")
+telemetry.metrics.describe("redcheck_config_load_seconds", "Parsing of config files (only on first use or change).")
+telemetry.metrics.describe("redcheck_rerun_seconds", "Streamlit script runs, from the top of main.py to the end.")
+
+
+def file_signature(path: str) -> tuple:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class FileCache:
+    """
+    Parsed config files keyed by path, re-parsed when the file's signature changes.
+    The values are shared: callers must copy them before mutating.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.counters = {"hits": 0, "loads": 0}
+
+    def load(self, path: str, parse):
+        """
+        :param parse: parse(text) -> value.
+        """
+        signature = file_signature(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self.counters["hits"] += 1
+                return entry[1]
+        start = time.monotonic()
+        with open(path, encoding="utf-8") as f:
+            value = parse(f.read())
+        seconds = time.monotonic() - start
+        telemetry.metrics.observe("redcheck_config_load_seconds", seconds, file=os.path.basename(path))
+        with self._lock:
+            self._entries[path] = (signature, value, round(seconds, 4))
+            self.counters["loads"] += 1
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            files = {path: {"parse_seconds": entry[2]} for path, entry in self._entries.items()}
+            return {**self.counters, "files": files}
+
+
+file_cache = FileCache()
+
+
+def _parse_yaml(text: str):
+    return lazy_import("yaml").safe_load(text)
+
+
+def get_auth_config() -> dict:
+    """Parsed auth.yaml, shared by every session; deep-copy it before handing it to stauth (which mutates it)."""
+    return file_cache.load(AUTH_CONFIG_PATH, _parse_yaml)
+
+
+def get_layouts() -> dict:
+    """Report layout per exam type from layouts.json."""
+    return file_cache.load(LAYOUTS_PATH, json.loads)
+
+
+_import_seconds = {}
+
+
+def lazy_import(name: str):
+    """Import `name` on first use, recording how long the first import took."""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    start = time.monotonic()
+    module = importlib.import_module(name)
+    seconds = time.monotonic() - start
+    _import_seconds.setdefault(name, round(seconds, 4))
+    telemetry.metrics.observe("redcheck_import_seconds", seconds, module=name)
+    return module
+
+
+_reruns = deque(maxlen=200)
+
+
+def record_rerun(seconds: float):
+    _reruns.append(seconds)
+    telemetry.metrics.observe("redcheck_rerun_seconds", seconds)
+
+
+def timings() -> dict:
+    reruns = sorted(_reruns)
+
+    def quantile(q):
+        return round(reruns[min(len(reruns) - 1, int(q * len(reruns)))], 4) if reruns else None
+
+    return {
+        "reruns": len(reruns),
+        "last_rerun_seconds": round(_reruns[-1], 4) if _reruns else None,
+        "p50_rerun_seconds": quantile(0.5),
+        "p95_rerun_seconds": quantile(0.95),
+        "first_imports_seconds": dict(_import_seconds),
+        "config_files": file_cache.stats(),
+    }
@@ -1,23 +1,59 @@
+import time
+
+RERUN_STARTED = time.monotonic()
+
 import streamlit as st
-import streamlit_authenticator as stauth
-import yaml
-import tempfile
-import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
+import json
 import prompts
+from loaders import AUTH_CONFIG_PATH, file_signature, get_auth_config, get_layouts, lazy_import, record_rerun, timings
 
 st.set_page_config(page_title="Eye Report Generator", layout="wide")
 
+EXAM_TYPES = ["oct_macula", "retinografia", "campimetria"]
+# The report options estimator.estimate_exam reads
+ESTIMATE_OPTIONS = ("exam_type", "description_model", "reasoning_model", "prompts", "reasoning_prompt", "layout")
+
 
 def get_config():
-    with open('streamlit/src/auth.yaml') as file:
-        config = yaml.safe_load(file)
-    return config
+    # Parsed once per process (re-parsed when auth.yaml changes); stauth mutates its credentials, so copy
+    return copy.deepcopy(get_auth_config())
+
+
+def get_authenticator():
+    """
+    The session's Authenticate, rebuilt only while logging in or when auth.yaml changed.
+    Not shared across sessions: it carries the session's login and cookie state.
+    """
+    signature = file_signature(AUTH_CONFIG_PATH)
+    cached = st.session_state.get("_authenticator")
+    if cached is None or cached[0] != signature or not st.session_state.get('authentication_status'):
+        stauth = lazy_import("streamlit_authenticator")
+        cached = (signature, stauth.Authenticate(credentials=get_config()['credentials']))
+        st.session_state["_authenticator"] = cached
+    return cached[1]
+
+
+def get_estimate(options: dict, images_by_eye: dict) -> dict:
+    """
+    The session's pre-flight estimate, recomputed only when the uploads (by file id) or the
+    options it depends on change, not on every rerun such as the job status polling.
+    """
+    from estimator import estimate_exam
+
+    signature = (
+        tuple((eye, tuple(f.file_id for f in images)) for eye, images in images_by_eye.items()),
+        tuple(options[name] for name in ESTIMATE_OPTIONS),
+    )
+    cached = st.session_state.get("_estimate")
+    if cached is None or cached[0] != signature:
+        cached = (signature, estimate_exam(options, images_by_eye))
+        st.session_state["_estimate"] = cached
+    return cached[1]
 
 
 def app():
-    config = get_config()
-    authenticator = stauth.Authenticate(credentials=config['credentials'])
+    authenticator = get_authenticator()
 
     try:
         status = authenticator.login()
@@ -31,32 +67,27 @@ def app():
             "This page allows you to upload left eye and right eye images, set custom prompts, and generate a combined report."
         )
 
-        from utils import analyze_image, synthesize_medical_report
-
-        # --------------------------------------------------
-        # Helper function to process a single image in parallel
-        # --------------------------------------------------
-        def process_single_image(file, exam_type, prompt, eye_key, model):
-            """
-            file: the uploaded file from st.file_uploader
-            exam_type: e.g. "oct_macula"
-            prompt: the text prompt to pass to analyze_image
-            eye_key: "right" or "left" so we know which eye it belongs to
-            """
-            with tempfile.NamedTemporaryFile(delete=False, suffix=file.name) as tmp:
-                tmp.write(file.read())
-                tmp_path = tmp.name
-
-            result = analyze_image(tmp_path, exam_type, prompt,  model=model)  # call your custom function
-            os.remove(tmp_path)
-
-            # Return both the eye_key (to sort results later) and the analysis result
-            return eye_key, result
-
-
+        from streaming import partial_json_string
+        from jobs import CANCELLED, DONE, FAILED, FINISHED, QUEUED, job_store, retryable, start_workers
+        from history import report_history
+        from estimator import over_budget, usage_stats
+        from settings import get_setting
+        import telemetry
+
+        # Prometheus endpoint, when METRICS_PORT is configured (started once per process)
+        telemetry.start_exporter()
+        # Reports run in worker processes shared by every session (no-op once they are up)
+        start_workers(api_key=st.session_state.get("token"))
+
+        # Patient and exam date index the report history
+        colP1, colP2 = st.columns(2)
+        with colP1:
+            patient_id = st.text_input("Patient ID", help="Stored with the report so it can be found in the history")
+        with colP2:
+            exam_date = st.date_input("Exam Date")
 
         # Select exam type
-        exam_type = st.selectbox("Exam Type", ["oct_macula", "retinografia", "campimetria"])
+        exam_type = st.selectbox("Exam Type", EXAM_TYPES)
         
         col1, col2 = st.columns(2)
         with col1:
@@ -90,140 +121,296 @@ def app():
             reasoning_prompt = st.text_area("Prompt for Combined Medical Report",
                                             value=(prompts.COMBINED_PROMPT), height=200)
 
-            with open('streamlit/src/layouts.json') as file:
-                layouts = yaml.safe_load(file)
+            layouts = get_layouts()
             st.write("Estrutura do Laudo:")
             layout_input = st.text_area("Layout (Default Layout Provided)", value=layouts[exam_type], height=300)
 
             description_model = st.selectbox("Model for Description (Azure)", options=["gpt-4o", "o3-mini"], index=0)
             reasoning_model   = st.selectbox("Model for Reasoning (Azure)", options=["o3-mini", "gpt-4o"], index=0)
+            use_cache = st.checkbox("Reuse cached descriptions and reports", value=True)
+            stream_tokens = st.checkbox("Stream descriptions and reports live", value=True)
+            pack_images = st.checkbox("Pack multiple images per request when beneficial", value=True)
+            hedge_requests = st.checkbox("Hedge slow image descriptions (duplicate request after the p90 latency)", value=False)
+            max_hedges = st.number_input("Max hedged requests per report", min_value=0, max_value=20, value=2)
+            dedup_images = st.checkbox("Analyze duplicate uploads only once", value=True)
+            near_duplicates = st.checkbox("Also treat re-encoded copies of an image (same eye only) as duplicates",
+                                          value=False, disabled=not dedup_images)
+            dedup_distance = 2 if near_duplicates else -1
+            abort_on_error = st.checkbox("Stop the whole report at the first failed call (finished work is kept for a retry)",
+                                         value=True)
+            max_cost = st.number_input("Max cost per report (U$, 0 = no limit)", min_value=0.0, value=0.0, step=0.01,
+                                       format="%.2f", help="Checked against the estimate before sending, then enforced while the report runs")
+
+        options = {
+            "patient": patient_id.strip() or "unknown",
+            "exam_date": exam_date.isoformat(),
+            "exam_type": exam_type,
+            "prompts": {"right": prompt_right, "left": prompt_left},
+            "reasoning_prompt": reasoning_prompt,
+            "layout": layout_input,
+            "description_model": description_model,
+            "reasoning_model": reasoning_model,
+            "use_cache": use_cache,
+            "stream": stream_tokens,
+            "pack_images": pack_images,
+            "hedge_requests": hedge_requests,
+            "max_hedges": max_hedges,
+            "dedup_images": dedup_images,
+            "dedup_distance": dedup_distance,
+            "max_cost": max_cost,
+            "abort_on_error": abort_on_error,
+        }
+
+        # Pre-flight estimate from the upload headers and the observed output lengths; nothing is sent yet
+        estimate = None
+        if right_eye_image or left_eye_image:
+            estimate = get_estimate(options, {"right": right_eye_image or [], "left": left_eye_image or []})
+            st.caption(
+                f"Estimated cost: up to U${estimate['total_cost']:.4f} · about {estimate['seconds']}s "
+                f"({estimate['stages']['describe']['calls']} descriptions, max_tokens "
+                f"{estimate['stages']['describe']['max_tokens']}/{estimate['stages']['synthesize']['max_tokens']})"
+            )
+
+        # The report job of this session; after a browser refresh, the user's job that is still running
+        owner = st.session_state.get("username") or "anonymous"
+        job_id = st.session_state.get("report_job")
+        if job_id is None:
+            active = job_store.active(owner)
+            job_id = active["id"] if active else None
+        job = job_store.get(job_id) if job_id else None
+        running = job is not None and job["status"] not in FINISHED
 
-        generate_button = st.button("Generate Medical Report")
+        generate_button = st.button("Generate Medical Report", disabled=running)
+        if running and st.button("Cancel Report"):
+            job_store.cancel(job_id)
+            job = job_store.get(job_id)
 
         if generate_button:
             if not right_eye_image or not left_eye_image:
                 st.error("Please upload images for both right and left eye.")
                 st.stop()
 
-            # Accumulate total costs from all calls
-            total_costs = {
-                "input_cost": 0.0,
-                "cached_input_cost": 0.0,
-                "output_cost": 0.0,
-                "total_cost": 0.0
-            }
-
-            # ----------------------------------------------------------
-            # 1. Analyze all images (right + left) in parallel
-            # ----------------------------------------------------------
-            right_descriptions = []
-            left_descriptions = []
-
-            st.markdown("<p style='color: blue;'><strong>## 1. Analyzing images in parallel...</strong></p>", 
-                        unsafe_allow_html=True)
-
-            with st.spinner("Analyzing images in parallel..."):
-                futures = []
-                with ThreadPoolExecutor() as executor:
-                    # Queue up Right Eye images
-                    for file in right_eye_image:
-                        futures.append(
-                            executor.submit(
-                                process_single_image, file, exam_type, prompt_right, "right", description_model
-                            )
-                        )
-                    # Queue up Left Eye images
-                    for file in left_eye_image:
-                        futures.append(
-                            executor.submit(
-                                process_single_image, file, exam_type, prompt_left, "left", description_model
-                            )
-                        )
+            if over_budget(estimate["total_cost"], max_cost):
+                st.error(f"The estimated cost (U${estimate['total_cost']:.4f}) is over the report budget (U${max_cost:.2f}).")
+                st.stop()
 
-                    # Gather results
-                    for f in as_completed(futures):
-                        eye_key, result = f.result()
-
-                        # Accumulate costs from each call
-                        for k in total_costs:
-                            total_costs[k] += result["costs"][k]
-
-                        if eye_key == "right":
-                            right_descriptions.append(result["output"])
-                        else:
-                            left_descriptions.append(result["output"])
-
-            st.success("All images analyzed!")
-
-            # Optional: Show the raw descriptions
-            with st.expander("Show Raw Descriptions", expanded=False):
-                st.markdown("<p style='color: blue; font-weight:bold;'> 🖼️ Descriptions of each image</p>", unsafe_allow_html=True)
-                colA, colB = st.columns(2)
-
-                with colA:
-                    st.markdown("**Right Eye Descriptions**")
-                    for idx, desc in enumerate(right_descriptions, start=1):
-                        st.write(f"**Image #{idx}**:")
-                        st.write(desc)
-
-                with colB:
-                    st.markdown("**Left Eye Descriptions**")
-                    for idx, desc in enumerate(left_descriptions, start=1):
-                        st.write(f"**Image #{idx}**:")
-                        st.write(desc)
-
-            # ----------------------------------------------------------
-            # 2. Generate final reports for each eye in parallel
-            # ----------------------------------------------------------
-            st.markdown("<p style='color: blue;'><strong>## 2. Generating final reports in parallel...</strong></p>", 
+            job_id = job_store.submit(owner, options, {
+                # Written straight from the upload buffers, without an intermediate bytes copy
+                "right": [(f.name, f.getbuffer()) for f in right_eye_image],
+                "left": [(f.name, f.getbuffer()) for f in left_eye_image],
+            })
+            st.session_state["report_job"] = job_id
+            job = job_store.get(job_id)
+
+        result = None
+        if job is not None:
+            st.session_state["report_job"] = job["id"]
+            st.markdown("<p style='color: blue;'><strong>## 1. Analyzing images and generating final reports in parallel...</strong></p>", 
                         unsafe_allow_html=True)
-
-            with st.spinner("Generating final reports in parallel..."):
-                with ThreadPoolExecutor() as executor:
-                    future_right = executor.submit(
-                        synthesize_medical_report,
-                        right_descriptions,
-                        exam_type,
-                        reasoning_prompt,
-                        model=reasoning_model,
-                        estrutura=layout_input
-                    )
-                    future_left = executor.submit(
-                        synthesize_medical_report,
-                        left_descriptions,
-                        exam_type,
-                        reasoning_prompt,
-                        model=reasoning_model,
-                        estrutura=layout_input
-                    )
-
-                    final_report_right = future_right.result()
-                    final_report_left  = future_left.result()
-
-                    # Accumulate costs
-                    for k in total_costs:
-                        total_costs[k] += final_report_right["costs"][k]
-                    for k in total_costs:
-                        total_costs[k] += final_report_left["costs"][k]
-
-            st.success("Final reports generated!")
-
-            # ----------------------------------------------------------
-            # Display final
-            # ----------------------------------------------------------
-            st.markdown("### Right Eye Final Report")
-            st.json(final_report_right["output"])
-
-            st.markdown("### Left Eye Final Report")
-            st.json(final_report_left["output"])
+            status_slot = st.empty()
+
+            # One panel per eye, filled in as the worker reports progress
+            panels = {}
+            colA, colB = st.columns(2)
+            for eye, title, col in (("right", "Right Eye", colA), ("left", "Left Eye", colB)):
+                with col:
+                    st.markdown(f"### {title} Final Report")
+                    report_slot = st.empty()
+                    report_slot.info("Analyzing images...")
+                    descriptions_box = st.expander(f"🖼️ {title} Descriptions", expanded=False)
+                panels[eye] = {"report": report_slot, "descriptions": descriptions_box}
+
+            # Live description slots, created on the first text of each image
+            description_slots = {}
+            shown = {}
+
+            def description_slot(eye, idx):
+                if (eye, idx) not in description_slots:
+                    with panels[eye]["descriptions"]:
+                        st.write(f"**Image #{idx + 1}**:")
+                        description_slots[(eye, idx)] = st.empty()
+                return description_slots[(eye, idx)]
+
+            def show(key, slot, draw, value):
+                # Redraw a slot only when its content changed since the last poll
+                if shown.get(key) != value:
+                    shown[key] = value
+                    draw(slot, value)
+
+            def show_progress(progress):
+                for eye, descriptions in progress["descriptions"].items():
+                    for idx, description in enumerate(descriptions):
+                        if description is None:
+                            continue
+                        text = description["text"]
+                        if description.get("duplicate_of"):
+                            text = f"_Same image as {description['duplicate_of']}, description reused._\n\n{text}"
+                        show(("describe", eye, idx), description_slot(eye, idx),
+                             (lambda slot, v: slot.write(v)) if description["done"] else (lambda slot, v: slot.markdown(v)), text)
+                    report = progress["reports"][eye]
+                    if report["output"] is not None:
+                        show(("report", eye), panels[eye]["report"], lambda slot, v: slot.json(v), report["output"])
+                    elif report["text"]:
+                        # The report is JSON; show its description field while it is still being written
+                        show(("report", eye), panels[eye]["report"], lambda slot, v: slot.markdown(v),
+                             partial_json_string(report["text"], "description"))
+                    elif all(d is not None and d["done"] for d in descriptions):
+                        show(("report", eye), panels[eye]["report"], lambda slot, v: slot.info(v),
+                             "All images analyzed, generating final report...")
+
+            # Poll the job; a rerun (widget change, refresh, second click) lands back here
+            while True:
+                if job["status"] == QUEUED:
+                    status_slot.info(f"Waiting for a free worker ({job_store.position(job['id'])} reports ahead)...")
+                elif job["status"] not in FINISHED:
+                    status_slot.info("Analyzing images and generating final reports in parallel...")
+                else:
+                    status_slot.empty()
+                if job["progress"]:
+                    show_progress(job["progress"])
+                if job["status"] in FINISHED:
+                    break
+                time.sleep(get_setting("JOB_POLL_SECONDS", 0.5))
+                job = job_store.get(job["id"])
+
+            result = job["result"]
+            if job["status"] == FAILED:
+                st.error(f"Report generation failed: {job['error']}")
+            elif job["status"] == CANCELLED and (result or {}).get("budget", {}).get("exceeded"):
+                st.warning(f"Report generation stopped: it passed its U${result['budget']['max_cost']:.2f} budget.")
+            elif job["status"] == CANCELLED:
+                st.warning("Report generation was cancelled.")
+            if job["status"] == DONE:
+                st.success("Final reports generated!")
+                if result.get("history"):
+                    st.caption("Saved to the report history: " + ", ".join(
+                        f"{h['eye']} eye v{h['version']} (#{h['id']})" for h in result["history"]
+                    ))
+            if (result or {}).get("reused"):
+                st.caption("Retry: reused " + ", ".join(f"{n} {eye} eye description(s)" for eye, n in result["reused"].items()))
+            # Descriptions that succeeded are kept; the retry only sends what failed or never ran
+            if retryable(job) and st.button("Retry Failed Images"):
+                st.session_state["report_job"] = job_store.retry(job["id"])
+                st.rerun()
+
+        if job is not None and result:
+            with st.expander("Image Preprocessing", expanded=False):
+                st.json(result["preprocessing"]["summary"])
+                st.json(result["preprocessing"]["images"])
+                st.markdown("**Memory (worker process, this exam)**")
+                st.json(result["memory"])
+
+            if result["dedup"]:
+                with st.expander("Duplicate Uploads", expanded=bool(result["dedup"]["matches"])):
+                    st.json(result["dedup"])
+
+            with st.expander("Stage Timings (critical path)", expanded=False):
+                st.json(result["critical_path"])
+                if result["streaming"]:
+                    st.markdown("**Time to first token per call**")
+                    st.json(result["streaming"])
+                    st.markdown("**Streaming latency per model (worker process)**")
+                    st.json(result["latency_summary"])
+                if result["hedging"]:
+                    st.markdown(f"**Hedging**: {result['hedging']['used']}/{result['hedging']['max_hedges']} hedges used")
+                    st.json(result["hedging"]["latency"])
+                if result["packing"]:
+                    st.markdown("**Image packing (image indices per request)**")
+                    st.json(result["packing"]["plans"])
+                    st.json(result["packing"]["policy"])
+
+            with st.expander("Trace", expanded=False):
+                st.write(f"Report trace: {result['trace']['seconds']}s, {result['trace']['spans']} spans")
+                st.dataframe(
+                    [{**row, "attributes": json.dumps(row["attributes"], default=str)} for row in result["trace"]["rows"]],
+                    use_container_width=True,
+                )
+                st.markdown("**Slowest spans of this report**")
+                st.json(result["span_summary"])
+                worker_metrics = telemetry.read_metrics()
+                if worker_metrics is not None:
+                    st.markdown("**Prometheus metrics (last worker snapshot, METRICS_FILE)**")
+                    st.code(worker_metrics, language="text")
 
             st.markdown("---")
             st.markdown("<p style='color: blue;'>**## 3. Total Costs 💰**</p>", unsafe_allow_html=True)
             st.write("Below is the sum of input, cached input, and output costs for **all** calls:")
-            st.json({k: f"U${round(v, 3)}" for k, v in total_costs.items()})
+            st.json({k: v if k == "hedged_requests" else f"U${round(v, 3)}" for k, v in result["total_costs"].items()})
+            if result.get("estimate"):
+                st.write(
+                    f"Estimated before sending: up to U${result['estimate']['total_cost']:.4f} in about "
+                    f"{result['estimate']['seconds']}s (took {result['trace']['seconds']}s)."
+                )
+                with st.expander("Cost Estimate and Observed Output Lengths", expanded=False):
+                    st.json(result["estimate"])
+                    st.json(usage_stats.stats())
+            st.write("Azure prompt-cache hits for this run (cached input is billed at the lower rate):")
+            st.json(result["prompt_cache"])
+
+            with st.expander("Connection Pool Stats", expanded=False):
+                process = result["process"]
+                st.json(process["pool"])
+                st.markdown("**Request Scheduler**")
+                st.json(process["scheduler"])
+                st.markdown("**Rate Limits (per deployment)**")
+                st.json(process["rate_limits"])
+                st.markdown("**Deployment Routing**")
+                st.json(process["routing"])
+                st.markdown("**Recent routing decisions**")
+                st.json(process["recent_decisions"])
+                st.markdown("**Result Cache**")
+                st.json(process["result_cache"])
+                st.markdown("**Report Jobs**")
+                st.json(job_store.stats())
+
+        with st.expander("📚 Report History", expanded=False):
+            colH1, colH2, colH3 = st.columns([2, 1, 1])
+            with colH1:
+                history_text = st.text_input("Search report descriptions and diagnoses", key="history_text")
+            with colH2:
+                history_patient = st.text_input("Patient ID", key="history_patient")
+            with colH3:
+                history_exam = st.selectbox("Exam Type", [""] + EXAM_TYPES, key="history_exam")
+            matches = report_history.search(history_text, history_patient, history_exam or None)
+            if not matches:
+                st.write("No stored reports match.")
+            else:
+                st.dataframe(matches, use_container_width=True)
+                labels = {
+                    m["id"]: f"#{m['id']} {m['patient']} · {m['exam_type']} · {m['exam_date']} · {m['eye']} eye · v{m['version']}"
+                    for m in matches
+                }
+                selected = st.multiselect("Open stored reports (pick two to compare them side by side)", list(labels),
+                                          format_func=labels.get, max_selections=2, key="history_open")
+                show_descriptions = st.checkbox("Show image descriptions", key="history_descriptions")
+                for report_id, col in zip(selected, st.columns(len(selected)) if selected else []):
+                    start = time.monotonic()
+                    record = report_history.get(report_id)
+                    elapsed_ms = (time.monotonic() - start) * 1000
+                    with col:
+                        st.markdown(f"**{labels[report_id]}**")
+                        versions = ", ".join(
+                            f"v{v['version']} (#{v['id']})"
+                            for v in report_history.versions(record["patient"], record["exam_type"], record["exam_date"], record["eye"])
+                        )
+                        st.caption(
+                            f"{record['description_model']} → {record['reasoning_model']} · "
+                            f"U${round(record['costs']['total_cost'], 3)} · "
+                            f"generated {time.strftime('%Y-%m-%d %H:%M', time.localtime(record['created']))} · "
+                            f"versions: {versions} · "
+                            f"loaded in {elapsed_ms:.1f} ms"
+                        )
+                        st.json(record["report"])
+                        if show_descriptions:
+                            for idx, description in enumerate(record["descriptions"], start=1):
+                                st.write(f"**Image #{idx}**:")
+                                st.write(description)
+            st.caption(json.dumps(report_history.stats()))
 
         st.sidebar.title("Navigation")
         authenticator.logout("Logout", "sidebar")
+        with st.sidebar.expander("App Timings", expanded=False):
+            st.json(timings())
 
     elif st.session_state.get('authentication_status') is False:
         st.write("Username/password is incorrect")
@@ -238,4 +425,8 @@ def app():
 
 
 if __name__ == "__main__":
-    app()
+    try:
+        app()
+    finally:
+        # Includes reruns cut short by st.stop() or a newer rerun
+        record_rerun(time.monotonic() - RERUN_STARTED)
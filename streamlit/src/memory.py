@@ -0,0 +1,126 @@
+"""
+Memory accounting for image ingestion: a per-process budget for images being decoded,
+encoded and sent, plus peak-RSS readings per exam.
+"""
+import asyncio
+import resource
+import time
+
+import telemetry
+from settings import get_setting
+from tokens import image_dimensions
+
+DEFAULT_BUDGET_BYTES = 512 * 1024 * 1024
+
+telemetry.metrics.describe("redcheck_memory_budget_waits_total", "Image encodes that waited for the memory budget.")
+
+
+def image_footprint(data) -> int:
+    """
+    Bytes one image holds while it is prepared and sent: the upload, its decoded RGB pixels
+    during preprocessing, and the base64 data URL (plus the SDK's serialized copy of it).
+    """
+    dims = image_dimensions(data)
+    pixels = dims[0] * dims[1] * 3 if dims else 0
+    return len(data) + pixels + 2 * 4 * ((len(data) + 2) // 3)
+
+
+class MemoryBudget:
+    """
+    Caps the bytes held by images in flight in this process (see image_footprint).
+    reserve() waits while the budget is used up, so bursts of large uploads queue
+    instead of growing the heap. An image larger than the whole budget still goes
+    through, alone.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.peak = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self._condition = None
+
+    def _fits(self, nbytes: int) -> bool:
+        return self.in_use == 0 or self.in_use + nbytes <= self.max_bytes
+
+    async def acquire(self, nbytes: int) -> float:
+        # Created on first use, on the loop that runs the analyze calls
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        start = time.monotonic()
+        async with self._condition:
+            if not self._fits(nbytes):
+                self.waits += 1
+                telemetry.metrics.inc("redcheck_memory_budget_waits_total")
+                await self._condition.wait_for(lambda: self._fits(nbytes))
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+        wait = time.monotonic() - start
+        self.wait_seconds += wait
+        return wait
+
+    async def release(self, nbytes: int):
+        async with self._condition:
+            self.in_use -= nbytes
+            self._condition.notify_all()
+
+    def reset_peak(self):
+        self.peak = self.in_use
+
+    def reserve(self, nbytes: int):
+        """async with budget.reserve(n): ... holds n bytes of the budget for the block."""
+        return _Reservation(self, nbytes)
+
+    def stats(self) -> dict:
+        return {
+            "max_mb": round(self.max_bytes / 2 ** 20, 1),
+            "in_use_mb": round(self.in_use / 2 ** 20, 1),
+            "peak_mb": round(self.peak / 2 ** 20, 1),
+            "waits": self.waits,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
+
+
+class _Reservation:
+    def __init__(self, budget: MemoryBudget, nbytes: int):
+        self.budget = budget
+        self.nbytes = nbytes
+
+    async def __aenter__(self):
+        wait = await self.budget.acquire(self.nbytes)
+        if wait > 0.001:
+            telemetry.record("memory_wait", wait, bytes=self.nbytes)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.budget.release(self.nbytes)
+
+
+def reset_peak_rss():
+    """Restart the kernel's peak-RSS counter (Linux); elsewhere the peak stays process-wide."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def rss_mb(field: str = "VmRSS") -> float:
+    """Current (VmRSS) or peak (VmHWM) resident set size in MB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux (bytes on macOS); only a peak is available
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def peak_rss_mb() -> float:
+    return rss_mb("VmHWM")
+
+
+memory_budget = MemoryBudget(get_setting("INGEST_MEMORY_BUDGET_BYTES", DEFAULT_BUDGET_BYTES))
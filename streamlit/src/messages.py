@@ -0,0 +1,169 @@
+from settings import get_setting
+from tokens import CHARS_PER_TOKEN, text_tokens
+
+# Azure only serves cached prompt tokens when the first 1024 tokens of a request are identical
+MIN_CACHEABLE_TOKENS = 1024
+# tokens.text_tokens is an estimate; aim a bit past the threshold so the real count clears it
+PAD_MARGIN = 1.15
+# Cached input is billed at cached_rate / input_rate of the normal price (1.25 / 2.5 for gpt-4o)
+CACHED_PRICE_RATIO = 0.5
+
+REPORT_INSTRUCTIONS = (
+    "3. Indique se o exame é 'Normal', 'Anormal' ou 'Não Avaliável' na chave diagnosis.\n"
+    "4. Se for 'Anormal', inclua na chave diagnosis_description as possíveis hipóteses clínicas associadas aos achados (como retinopatia diabética, edema de papila, oclusão venosa, etc.).\n\n"
+    "Retorne sua resposta no seguinte formato JSON:\n\n"
+    "{\n  \"description\": \"[insira o laudo formatado conforme acima]\",\n  \"diagnosis\": \"[normal | abnormal | non_available]\",\n  \"diagnosis_description\": \"[preencha apenas se o diagnóstico for 'abnormal']\"\n}"
+)
+
+
+# Cache padding is neutral filler, delimited and marked for the model to ignore: no clinical
+# content (such as other exam types' layouts) that could bias the description or report
+PADDING_START = "\n\n[PREENCHIMENTO TÉCNICO DE CACHE - ignore este bloco: não contém instruções nem dados do exame]\n"
+PADDING_END = "\n[FIM DO PREENCHIMENTO]"
+# About one token per word, i.e. tokens.CHARS_PER_TOKEN characters
+PADDING_WORD = " pad"
+
+
+def cache_padding(static_text: str) -> str:
+    """
+    Padding that lifts a static prefix past the minimum cacheable length: a delimited block of
+    neutral filler that the block itself tells the model to ignore.
+    Off unless enabled, since it adds tokens that carry no meaning to real prompts:
+    PROMPT_CACHE_PADDING = "never" (default) disables it, "auto" only pads when the padded
+    prefix, billed at the cached rate, costs no more than the unpadded one at full rate, and
+    "always" pads every short prefix.
+    :return: Text to append to the static prefix (possibly empty).
+    """
+    mode = get_setting("PROMPT_CACHE_PADDING", "never")
+    target = int(get_setting("PROMPT_CACHE_MIN_TOKENS", MIN_CACHEABLE_TOKENS) * PAD_MARGIN)
+    current = text_tokens(static_text)
+    if mode == "never" or current >= target:
+        return ""
+    if mode == "auto" and current < target * get_setting("PROMPT_CACHE_PRICE_RATIO", CACHED_PRICE_RATIO):
+        return ""
+    missing_chars = (target - current) * CHARS_PER_TOKEN - len(PADDING_START) - len(PADDING_END)
+    return PADDING_START + PADDING_WORD * max(1, -(-missing_chars // len(PADDING_WORD))) + PADDING_END
+
+
+def image_messages(data_url: str, detail: str, tipo_exame: str, prompt: str) -> list:
+    """
+    Messages for one image description, ordered for prompt caching:
+    the static prompt (plus padding) first, then the exam type, then the image.
+    """
+    system_text = prompt + cache_padding(prompt)
+    system_message = {
+        "role": "system",
+        "content": [
+            {
+                "type": "text",
+                "text": system_text
+            }
+        ]
+    }
+
+    user_message = {
+        "role": "user",
+        "content": [
+            {
+                "type": "text",
+                "text": f"Isto se trata de um exame do tipo {tipo_exame}."
+            },
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": data_url,
+                    "detail": detail
+                }
+            }
+        ]
+    }
+
+    return [system_message, user_message]
+
+
+def packed_image_messages(images: list, tipo_exame: str, prompt: str) -> list:
+    """
+    Messages describing several images of the same eye in one request.
+    Same static prefix as image_messages; the images are numbered and the model
+    is asked for one description per image in a JSON object.
+    :param images: List of (data_url, detail) tuples, in the order they should be numbered.
+    """
+    system_text = prompt + cache_padding(prompt)
+    system_message = {
+        "role": "system",
+        "content": [
+            {
+                "type": "text",
+                "text": system_text
+            }
+        ]
+    }
+
+    content = [
+        {
+            "type": "text",
+            "text": (
+                f"Isto se trata de um exame do tipo {tipo_exame}. "
+                f"Você receberá {len(images)} imagens do mesmo olho, numeradas na ordem de envio. "
+                "Descreva cada imagem separadamente e retorne um JSON no formato "
+                "{\"descriptions\": [{\"image\": 1, \"description\": \"...\"}, ...]}, "
+                "com exatamente uma descrição por imagem."
+            )
+        }
+    ]
+    for number, (data_url, detail) in enumerate(images, start=1):
+        content.append({"type": "text", "text": f"Imagem {number}:"})
+        content.append({"type": "image_url", "image_url": {"url": data_url, "detail": detail}})
+
+    return [system_message, {"role": "user", "content": content}]
+
+
+def report_messages(output_texts: list, prompt: str, estrutura=None) -> list:
+    """
+    Messages for one report synthesis, ordered for prompt caching: the prompt, layout and
+    fixed instructions first (static per exam type), then the descriptions, which are the
+    only per-call content.
+    """
+    # Concatena todas as descrições clínicas
+    combined_text = "\n\n".join(output_texts)
+
+    static_text = f"{prompt}\n\n{estrutura}\n\n{REPORT_INSTRUCTIONS}"
+    system_message = {
+        "role": "system",
+        "content": [
+            {
+                "type": "text",
+                "text": static_text + cache_padding(static_text)
+            }
+        ]
+    }
+
+    user_message = {
+        "role": "user",
+        "content": [
+            {
+                "type": "text",
+                "text": combined_text
+            }
+        ]
+    }
+
+    return [system_message, user_message]
+
+
+def prompt_cache_summary(metadatas: list) -> dict:
+    """
+    Prompt-cache hit ratio over a run's usage metadata (cache hits from our own
+    result cache carry empty metadata and are ignored).
+    """
+    prompt_tokens = sum(m.get("prompt_tokens", 0) for m in metadatas)
+    cached_tokens = sum((m.get("prompt_tokens_details") or {}).get("cached_tokens", 0) for m in metadatas)
+    calls = sum(1 for m in metadatas if m.get("prompt_tokens"))
+    hits = sum(1 for m in metadatas if (m.get("prompt_tokens_details") or {}).get("cached_tokens"))
+    return {
+        "calls": calls,
+        "calls_with_cache_hits": hits,
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "cache_hit_ratio": round(cached_tokens / prompt_tokens, 3) if prompt_tokens else 0.0,
+    }
@@ -0,0 +1,204 @@
+"""
+Local mock of the Azure OpenAI chat-completions endpoint, for benchmarks and load tests.
+
+Serves POST /openai/deployments/<deployment>/chat/completions (any path ending in
+/chat/completions), streamed or not, with responses built by stub.stub_completion.
+Latency is drawn per request: time to first token from --ttft, then completion tokens
+at --tps tokens/second. A fraction of requests (--rate-429) is answered with 429 and a
+retry-after-ms header, like a throttled Azure deployment.
+
+Run from the repository root:
+    python streamlit/src/mock_azure.py --port 8089 --ttft lognormal:0.6,0.4 --tps 80 --rate-429 0.02
+and point the app at it with AZURE_OPENAI_ENDPOINT=http://127.0.0.1:8089 (any API key).
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from stub import stub_completion
+from tokens import CHARS_PER_TOKEN
+
+
+def parse_distribution(spec: str):
+    """
+    Latency distribution from a spec string, in seconds:
+    "fixed:0.5", "uniform:0.2,1.0", "normal:0.8,0.2" (clipped at 0) or
+    "lognormal:0.6,0.4" (median, sigma of the underlying normal).
+    :return: Zero-argument callable returning one sample.
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class MockAzureServer:
+    """
+    Threaded HTTP server answering chat completions like an Azure deployment.
+    :param ttft: Distribution spec for time to first token (see parse_distribution).
+    :param tps: Generation speed in completion tokens per second (0 = instant).
+    :param rate_429: Probability of answering a request with 429.
+    :param retry_after_ms: retry-after-ms header sent with each 429.
+    :param completion_tokens: Pad generated texts to about this many tokens.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, ttft="fixed:0.0", tps=0.0, rate_429=0.0,
+                 retry_after_ms=500, completion_tokens=None):
+        self.ttft = parse_distribution(ttft)
+        self.tps = tps
+        self.rate_429 = rate_429
+        self.retry_after_ms = retry_after_ms
+        self.completion_tokens = completion_tokens
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "streamed": 0, "throttled": 0, "in_flight": 0, "peak_in_flight": 0}
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-azure", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _count(self, key, delta=1):
+        with self._lock:
+            self.stats[key] += delta
+            if key == "in_flight":
+                self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.stats["in_flight"])
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.split("?")[0].endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"code": "404", "message": "Resource not found"}})
+                    return
+                match = re.search(r"/deployments/([^/]+)/", self.path)
+                body.setdefault("model", match.group(1) if match else "mock")
+                mock._count("requests")
+                mock._count("in_flight")
+                try:
+                    if random.random() < mock.rate_429:
+                        mock._count("throttled")
+                        self._send_json(
+                            429,
+                            {"error": {"code": "429", "message": "Requests to the ChatCompletions_Create Operation have exceeded the rate limit."}},
+                            {"retry-after-ms": str(mock.retry_after_ms), "retry-after": str(max(1, mock.retry_after_ms // 1000))},
+                        )
+                        return
+                    completion = stub_completion(body, mock.completion_tokens)
+                    time.sleep(mock.ttft())
+                    if body.get("stream"):
+                        mock._count("streamed")
+                        self._stream(body, completion)
+                    else:
+                        tokens = completion["usage"]["completion_tokens"]
+                        if mock.tps:
+                            time.sleep(tokens / mock.tps)
+                        self._send_json(200, completion)
+                finally:
+                    mock._count("in_flight", -1)
+
+            def _send_json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("x-request-id", uuid.uuid4().hex)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, body, completion):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                base = {"id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"], "model": completion["model"]}
+                # Azure opens with a content-filter chunk that has no choices
+                self._event({**base, "choices": [], "prompt_filter_results": []})
+                content = completion["choices"][0]["message"]["content"]
+                step = 16
+                delay = (step / CHARS_PER_TOKEN) / mock.tps if mock.tps else 0.0
+                for i in range(0, len(content), step):
+                    self._event({**base, "choices": [{"index": 0, "delta": {"content": content[i:i + step]}, "finish_reason": None}]})
+                    if delay:
+                        time.sleep(delay)
+                self._event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    self._event({**base, "choices": [], "usage": completion["usage"]})
+                self._chunk(b"data: [DONE]\n\n")
+                self._chunk(b"")
+
+            def _event(self, payload):
+                self._chunk(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+            def _chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local mock of the Azure OpenAI chat-completions endpoint.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--ttft", default="lognormal:0.6,0.4", help="time-to-first-token distribution")
+    parser.add_argument("--tps", type=float, default=80.0, help="completion tokens per second")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of requests throttled")
+    parser.add_argument("--retry-after-ms", type=int, default=500)
+    parser.add_argument("--completion-tokens", type=int, default=None, help="pad answers to about N tokens")
+    args = parser.parse_args(argv)
+
+    server = MockAzureServer(args.host, args.port, args.ttft, args.tps, args.rate_429, args.retry_after_ms,
+                             args.completion_tokens)
+    print(f"Mock Azure OpenAI listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import math
+import threading
+import time
+
+from preprocess import get_profile
+from settings import get_setting
+
+# Image tokens assumed per image when budgeting a pack (a 768x1024 high-detail image)
+HIGH_DETAIL_IMAGE_TOKENS = 765
+LOW_DETAIL_IMAGE_TOKENS = 85
+
+
+def split_packed_output(output_text: str, count: int) -> list:
+    """
+    Split a packed response into per-image descriptions.
+    Expects {"descriptions": [{"image": 1, "description": "..."}, ...]}; entries are
+    matched by their image number, falling back to response order.
+    :return: List of `count` descriptions, with None for images the model skipped.
+    """
+    try:
+        entries = json.loads(output_text).get("descriptions", [])
+    except (json.JSONDecodeError, AttributeError):
+        return [None] * count
+    descriptions = [None] * count
+    for position, entry in enumerate(entries):
+        if isinstance(entry, str):
+            entry = {"description": entry}
+        if not isinstance(entry, dict) or not entry.get("description"):
+            continue
+        number = entry.get("image")
+        index = number - 1 if isinstance(number, int) and 1 <= number <= count else position
+        if index < count and descriptions[index] is None:
+            descriptions[index] = entry["description"]
+    return descriptions
+
+
+class PackingPolicy:
+    """
+    Chooses between one request per image (fan-out) and packing several images of
+    the same eye into one request. Packing saves the repeated prompt and per-request
+    overhead; it is used when there are enough images and a pack is expected to finish
+    within `latency_tolerance` of the fan-out wall time. Fan-out requests run in parallel,
+    so that wall time is about one single-image request; a packed request grows with the
+    images it carries, so its latency is tracked per image and scaled to the planned pack size.
+    """
+
+    def __init__(self, min_images=3, max_images=6, max_bytes=8 * 1024 * 1024, max_image_tokens=6000,
+                 latency_tolerance=1.5, exam_types=("campimetria", "oct_macula"), alpha=0.3):
+        self.min_images = min_images
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self.max_image_tokens = max_image_tokens
+        self.latency_tolerance = latency_tolerance
+        self.exam_types = set(exam_types)
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._latency = {}
+
+    def observe(self, mode: str, exam_type: str, model: str, seconds: float, images: int = 1):
+        """Fold one request's latency per image into the EWMA for ("fanout" | "pack", exam_type, model)."""
+        key = (mode, exam_type, model)
+        seconds /= max(images, 1)
+        with self._lock:
+            previous = self._latency.get(key)
+            self._latency[key] = seconds if previous is None else self.alpha * seconds + (1 - self.alpha) * previous
+
+    def should_pack(self, count: int, exam_type: str, model: str, pack_size: int = None) -> bool:
+        """
+        :param pack_size: Images per packed request (default: min(count, max_images)).
+        """
+        if count < self.min_images or exam_type not in self.exam_types:
+            return False
+        with self._lock:
+            fanout = self._latency.get(("fanout", exam_type, model))
+            pack = self._latency.get(("pack", exam_type, model))
+        if fanout is None or pack is None:
+            # Not enough observations yet: pack, which is the cheaper option
+            return True
+        return pack * (pack_size or min(count, self.max_images)) <= fanout * self.latency_tolerance
+
+    def plan(self, sizes: list, exam_type: str, model: str) -> list:
+        """
+        Group image indices into requests.
+        :param sizes: Byte size of each image, in order.
+        :return: List of index lists; single-element lists are sent on their own.
+        """
+        if not sizes:
+            return []
+        detail = get_profile(exam_type)["detail"]
+        per_image_tokens = LOW_DETAIL_IMAGE_TOKENS if detail == "low" else HIGH_DETAIL_IMAGE_TOKENS
+        per_pack = max(1, min(self.max_images, self.max_image_tokens // per_image_tokens))
+        # Even-sized packs, so no single request carries most of the latency
+        packs = math.ceil(len(sizes) / per_pack)
+        target = math.ceil(len(sizes) / packs)
+        if not self.should_pack(len(sizes), exam_type, model, pack_size=target):
+            return [[i] for i in range(len(sizes))]
+        chunks, current, current_bytes = [], [], 0
+        for index, size in enumerate(sizes):
+            # base64 inflates by 4/3 on the wire
+            encoded = size * 4 // 3
+            if current and (len(current) >= target or current_bytes + encoded > self.max_bytes):
+                chunks.append(current)
+                current, current_bytes = [], 0
+            current.append(index)
+            current_bytes += encoded
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def stats(self) -> dict:
+        with self._lock:
+            # Seconds per image: a fan-out request carries one, a pack scales with its size
+            return {" / ".join(key): round(value, 3) for key, value in self._latency.items()}
+
+
+class PackedDescriber:
+    """
+    Per-image describe() for ExamPipeline that transparently packs images.
+    Images planned into the same pack share one request; each image's coroutine
+    waits on that request and returns its own slice, so the pipeline and the
+    per-eye description lists see exactly the same per-image results as fan-out.
+    Packed requests are not streamed.
+    """
+
+    def __init__(self, describe_one, describe_pack, policy: PackingPolicy, exam_type: str, model: str, token=None):
+        """
+        :param describe_one: describe_one(group, index, item, on_delta) -> coroutine with one result.
+        :param describe_pack: describe_pack(group, items) -> coroutine with one result per item.
+        :param token: pipeline.CancelToken of the report; cancels the shared pack requests with it.
+        """
+        self.describe_one = describe_one
+        self.describe_pack = describe_pack
+        self.policy = policy
+        self.exam_type = exam_type
+        self.model = model
+        self.token = token
+        self.plans = {}
+        self._chunk_of = {}
+        self._items = {}
+        self._tasks = {}
+
+    def plan(self, items_by_group: dict, size=lambda item: item.size, skip=None) -> dict:
+        """
+        :param skip: skip(group, index) -> True for items that will never be described
+                     (e.g. duplicates), so they are left out of every pack.
+        """
+        for group, items in items_by_group.items():
+            self._items[group] = items
+            indices = [i for i in range(len(items)) if skip is None or not skip(group, i)]
+            chunks = self.policy.plan([size(items[i]) for i in indices], self.exam_type, self.model)
+            self.plans[group] = [[indices[i] for i in chunk] for chunk in chunks]
+            for chunk_id, chunk in enumerate(self.plans[group]):
+                for index in chunk:
+                    self._chunk_of[(group, index)] = (chunk_id, chunk)
+        return self.plans
+
+    async def __call__(self, group, index, item, on_delta=None):
+        chunk_id, chunk = self._chunk_of.get((group, index), (None, [index]))
+        start = time.monotonic()
+        if len(chunk) == 1:
+            result = await self.describe_one(group, index, item, on_delta)
+            if not result.get("cached") and "error" not in result:
+                self.policy.observe("fanout", self.exam_type, self.model, time.monotonic() - start)
+            return result
+
+        task = self._tasks.get((group, chunk_id))
+        if task is None:
+            task = asyncio.ensure_future(self._run_pack(group, chunk))
+            self._tasks[(group, chunk_id)] = task
+            if self.token is not None:
+                self.token.track(task)
+        results = await asyncio.shield(task)
+        return results[chunk.index(index)]
+
+    async def _run_pack(self, group, chunk):
+        start = time.monotonic()
+        results = await self.describe_pack(group, [self._items[group][i] for i in chunk])
+        if any(r.get("packed") and not r.get("cached") for r in results):
+            self.policy.observe("pack", self.exam_type, self.model, time.monotonic() - start, images=len(chunk))
+        return results
+
+
+packing_policy = PackingPolicy(
+    min_images=get_setting("PACK_MIN_IMAGES", 3),
+    max_images=get_setting("PACK_MAX_IMAGES", 6),
+    max_bytes=get_setting("PACK_MAX_BYTES", 8 * 1024 * 1024),
+    max_image_tokens=get_setting("PACK_MAX_IMAGE_TOKENS", 6000),
+    latency_tolerance=get_setting("PACK_LATENCY_TOLERANCE", 1.5),
+    exam_types=get_setting("PACK_EXAM_TYPES", ("campimetria", "oct_macula")),
+)
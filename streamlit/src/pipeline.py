@@ -0,0 +1,211 @@
+import asyncio
+import queue
+import threading
+import time
+
+from scheduler import scheduler
+
+
+async def _timed(coro):
+    start = time.monotonic()
+    try:
+        result = await coro
+    except Exception as e:
+        # A stage that raised is reported like one that returned an error; the other stages keep going
+        result = {"error": f"{type(e).__name__}: {e}"}
+    return result, start, time.monotonic()
+
+
+class CancelToken:
+    """
+    Cancellation of one report, shared by everything the report starts: the pipeline's stages and
+    the calls dedup and packing share between stages. cancel() can be called from any thread; it runs
+    the registered callbacks once, and callbacks registered afterwards run right away.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.reason = None
+        self.detail = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self, reason: str = "cancelled", detail: str = None) -> bool:
+        """
+        :param reason: "cancelled" (by the user), "error" or "budget"; only the first cancel's is kept.
+        :return: False when the token was already cancelled.
+        """
+        with self._lock:
+            if self.cancelled:
+                return False
+            self.cancelled, self.reason, self.detail = True, reason, detail
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+        return True
+
+    def on_cancel(self, callback):
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def track(self, task: asyncio.Task):
+        """Cancel an asyncio task (e.g. a shielded shared call) with the token; this aborts its HTTP request."""
+        loop = task.get_loop()
+        self.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel))
+
+
+class ExamPipeline:
+    """
+    Dependency-driven image -> report pipeline.
+    Every image is described concurrently, and each group's (eye's) synthesis is
+    submitted as soon as that group's own descriptions are complete, instead of
+    waiting for every image of every group.
+    """
+
+    def __init__(self, describe, synthesize, submit=scheduler.submit, stream=False, token=None):
+        """
+        :param describe: describe(group, index, item, on_delta) -> coroutine returning an analyze_image result.
+        :param synthesize: synthesize(group, results, on_delta) -> coroutine returning a synthesize_medical_report result.
+        :param submit: Schedules a coroutine and returns a concurrent.futures.Future.
+        :param stream: Pass an on_delta callback to each stage and emit "delta" events; otherwise on_delta is None.
+        :param token: CancelToken of the report; cancelling it cancels the pipeline.
+        A stage that raises yields a {"error"} result instead of ending the run.
+        """
+        self.describe = describe
+        self.synthesize = synthesize
+        self.submit = submit
+        self.stream = stream
+        self.results = {}
+        self.reports = {}
+        self.timings = {}
+        self.partials = {}
+        self.cancelled = False
+        self._futures = set()
+        self._lock = threading.Lock()
+        if token is not None:
+            token.on_cancel(self.cancel)
+
+    def run(self, items_by_group: dict):
+        """
+        Run the pipeline, yielding events as results arrive:
+        {"stage": "describe", "group", "index", "result", "elapsed"} and
+        {"stage": "synthesize", "group", "result", "elapsed"}, plus, when streaming,
+        {"stage": "delta", "of": "describe" | "synthesize", "group", "index", "delta", "text"}.
+        Descriptions in `self.results[group]` stay in input order.
+        """
+        events = queue.Queue()
+        self._t0 = time.monotonic()
+        remaining = {}
+        outstanding = 0
+
+        def delta_callback(stage, group, index):
+            if not self.stream:
+                return None
+            # Runs on the scheduler loop; the script thread picks deltas up from the queue
+            return lambda delta: events.put(("delta", stage, group, index, delta))
+
+        def enqueue(stage, group, index, coro):
+            with self._lock:
+                if self.cancelled:
+                    coro.close()
+                    return False
+                future = self.submit(_timed(coro))
+                self._futures.add(future)
+            future.add_done_callback(lambda f: events.put((stage, group, index, f)))
+            return True
+
+        for group, items in items_by_group.items():
+            self.results[group] = [None] * len(items)
+            self.timings[group] = {"images": [None] * len(items)}
+            remaining[group] = len(items)
+            for index, item in enumerate(items):
+                on_delta = delta_callback("describe", group, index)
+                if enqueue("describe", group, index, self.describe(group, index, item, on_delta)):
+                    outstanding += 1
+
+        while outstanding:
+            event = events.get()
+            if event[0] == "delta":
+                _, stage, group, index, delta = event
+                text = self.partials.get((stage, group, index), "") + delta
+                self.partials[(stage, group, index)] = text
+                yield {"stage": "delta", "of": stage, "group": group, "index": index, "delta": delta, "text": text}
+                continue
+
+            stage, group, index, future = event
+            outstanding -= 1
+            with self._lock:
+                self._futures.discard(future)
+            if future.cancelled():
+                continue
+            result, start, end = future.result()
+            elapsed = self._span(start, end)
+
+            if stage == "describe":
+                self.results[group][index] = result
+                self.timings[group]["images"][index] = elapsed
+                remaining[group] -= 1
+                yield {"stage": stage, "group": group, "index": index, "result": result, "elapsed": elapsed}
+                if remaining[group] == 0:
+                    # This group's inputs are ready; its synthesis does not wait for other groups
+                    on_delta = delta_callback("synthesize", group, None)
+                    if enqueue("synthesize", group, None, self.synthesize(group, self.results[group], on_delta)):
+                        outstanding += 1
+            else:
+                self.reports[group] = result
+                self.timings[group]["synthesis"] = elapsed
+                yield {"stage": stage, "group": group, "result": result, "elapsed": elapsed}
+
+    def cancel(self):
+        """
+        Stop the run from any thread: outstanding stages are cancelled and no new ones start.
+        run() returns once the cancelled stages have drained; their slots stay None.
+        """
+        with self._lock:
+            self.cancelled = True
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+    def _span(self, start: float, end: float) -> dict:
+        return {
+            "start": round(start - self._t0, 3),
+            "end": round(end - self._t0, 3),
+            "seconds": round(end - start, 3),
+        }
+
+    def critical_path(self) -> dict:
+        """
+        Per-stage timings and the chain that determined the wall-clock time,
+        plus how much the old all-images barrier would have added.
+        """
+        groups = {}
+        for group, timing in self.timings.items():
+            images = [t for t in timing["images"] if t]
+            synthesis = timing.get("synthesis")
+            slowest = max(images, key=lambda t: t["end"]) if images else None
+            groups[group] = {
+                "images": len(images),
+                "descriptions_done_at": slowest["end"] if slowest else 0.0,
+                "slowest_image_seconds": slowest["seconds"] if slowest else 0.0,
+                "synthesis_seconds": synthesis["seconds"] if synthesis else None,
+                "report_ready_at": synthesis["end"] if synthesis else None,
+            }
+        if not groups:
+            return {}
+        finished = {g: v for g, v in groups.items() if v["report_ready_at"] is not None}
+        critical = max(finished, key=lambda g: finished[g]["report_ready_at"]) if finished else None
+        wall = finished[critical]["report_ready_at"] if critical else None
+        # With a barrier every synthesis would start after the slowest image of any group
+        barrier = max(v["descriptions_done_at"] for v in groups.values())
+        barrier_wall = max((barrier + v["synthesis_seconds"] for v in finished.values()), default=None)
+        return {
+            "groups": groups,
+            "critical_group": critical,
+            "wall_seconds": wall,
+            "barrier_wall_seconds": round(barrier_wall, 3) if barrier_wall is not None else None,
+            "saved_vs_barrier_seconds": round(barrier_wall - wall, 3) if wall is not None else None,
+        }
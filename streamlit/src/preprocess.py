@@ -0,0 +1,118 @@
+import io
+
+from settings import get_setting
+from tokens import image_dimensions, image_tokens
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Per exam_type preprocessing. Sizes follow the gpt-4o tile grid: anything past
+# 2048 on the long side or 768 on the short side is downscaled by the service anyway.
+# crop_border is a fraction of each side (or a (left, top, right, bottom) tuple)
+# trimmed to drop the device UI around the exam.
+DEFAULT_PROFILES = {
+    "oct_macula": {"max_long_side": 2048, "max_short_side": 768, "crop_border": 0.0, "jpeg_quality": 85, "detail": "high"},
+    "retinografia": {"max_long_side": 2048, "max_short_side": 768, "crop_border": 0.0, "jpeg_quality": 88, "detail": "high"},
+    "campimetria": {"max_long_side": 2048, "max_short_side": 768, "crop_border": 0.0, "jpeg_quality": 85, "detail": "high"},
+    "default": {"max_long_side": 2048, "max_short_side": 768, "crop_border": 0.0, "jpeg_quality": 85, "detail": "high"},
+}
+
+
+def get_profile(exam_type: str) -> dict:
+    profiles = get_setting("IMAGE_PROFILES", DEFAULT_PROFILES)
+    return {**DEFAULT_PROFILES["default"], **profiles.get(exam_type, profiles.get("default", {}))}
+
+
+def _crop_box(width: int, height: int, crop_border):
+    if not crop_border:
+        return None
+    if isinstance(crop_border, (int, float)):
+        crop_border = (crop_border,) * 4
+    left, top, right, bottom = crop_border
+    return (
+        round(width * left),
+        round(height * top),
+        width - round(width * right),
+        height - round(height * bottom),
+    )
+
+
+def _target_size(width: int, height: int, max_long_side: int, max_short_side: int):
+    scale = min(1.0, max_long_side / max(width, height), max_short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def processed_dimensions(width: int, height: int, exam_type: str):
+    """Size an image of width x height will be sent at after preprocess_image (crop, then downscale)."""
+    profile = get_profile(exam_type)
+    box = _crop_box(width, height, profile["crop_border"])
+    if box:
+        width, height = box[2] - box[0], box[3] - box[1]
+    return _target_size(width, height, profile["max_long_side"], profile["max_short_side"])
+
+
+def preprocess_image(data: bytes, exam_type: str, mime_type: str = "image/jpeg"):
+    """
+    Crop, downsize and re-encode an uploaded exam image before it is base64-encoded.
+    :param data: Raw image bytes as uploaded.
+    :param exam_type: Selects the profile (sizes, crop, JPEG quality, detail level).
+    :param mime_type: MIME type of the original bytes, kept when the image is passed through.
+    :return: (bytes, mime_type, stats) where stats reports bytes and estimated tokens before and after.
+    """
+    profile = get_profile(exam_type)
+    detail = profile["detail"]
+    dims = image_dimensions(data)
+    stats = {
+        "exam_type": exam_type,
+        "detail": detail,
+        "original_bytes": len(data),
+        "original_size": list(dims) if dims else None,
+        # Before preprocessing every image was sent at full resolution with high detail
+        "original_tokens": image_tokens(*dims, detail="high") if dims else None,
+    }
+
+    out, out_mime = data, mime_type
+    if Image is not None:
+        with Image.open(io.BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img)
+            original_size = (img.width, img.height)
+            box = _crop_box(img.width, img.height, profile["crop_border"])
+            if box:
+                img = img.crop(box)
+            size = _target_size(img.width, img.height, profile["max_long_side"], profile["max_short_side"])
+            if size != (img.width, img.height):
+                img = img.resize(size, Image.LANCZOS)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            buffer = io.BytesIO()
+            img.save(buffer, format="JPEG", quality=profile["jpeg_quality"], optimize=True)
+            # Keep the original when re-encoding an untouched image would only make it bigger
+            if box or size != original_size or buffer.tell() < len(data):
+                out, out_mime = buffer.getvalue(), "image/jpeg"
+
+    dims = image_dimensions(out)
+    stats.update({
+        "processed_bytes": len(out),
+        "processed_size": list(dims) if dims else None,
+        "processed_tokens": image_tokens(*dims, detail=detail) if dims else None,
+    })
+    # base64 inflates by 4/3; report what actually goes over the wire
+    stats["original_b64_bytes"] = 4 * ((stats["original_bytes"] + 2) // 3)
+    stats["processed_b64_bytes"] = 4 * ((stats["processed_bytes"] + 2) // 3)
+    return out, out_mime, stats
+
+
+def summarize(stats_list: list) -> dict:
+    """Aggregate per-image preprocessing stats into per-exam savings."""
+    summary = {
+        "images": len(stats_list),
+        "original_bytes": sum(s["original_bytes"] for s in stats_list),
+        "processed_bytes": sum(s["processed_bytes"] for s in stats_list),
+        "original_tokens": sum(s["original_tokens"] or 0 for s in stats_list),
+        "processed_tokens": sum(s["processed_tokens"] or 0 for s in stats_list),
+    }
+    summary["bytes_saved"] = summary["original_bytes"] - summary["processed_bytes"]
+    summary["tokens_saved"] = summary["original_tokens"] - summary["processed_tokens"]
+    return summary
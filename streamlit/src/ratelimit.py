@@ -0,0 +1,221 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import openai
+
+import telemetry
+from settings import get_setting
+
+# Per-deployment Azure quotas (requests and tokens per minute); override with AZURE_QUOTAS
+DEFAULT_QUOTAS = {
+    "gpt-4o": {"rpm": 300, "tpm": 50_000},
+    "o3-mini": {"rpm": 100, "tpm": 100_000},
+}
+# Fraction of the quota we allow ourselves, to stay just under throttling
+DEFAULT_HEADROOM = 0.9
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class TokenBucket:
+    """
+    Async token bucket refilled continuously at `per_minute / 60` units per second.
+    Requests larger than the whole bucket are let through once it is full.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float) -> float:
+        """Take `amount` units, sleeping until they are available; returns seconds waited."""
+        start = time.monotonic()
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return time.monotonic() - start
+                await asyncio.sleep((amount - self._tokens) / self.rate)
+
+    def refund(self, amount: float):
+        """Give back (or, when negative, charge) units after the real usage is known."""
+        self._refill(time.monotonic())
+        self._tokens = min(self.capacity, self._tokens + amount)
+
+    def block_for(self, seconds: float):
+        """Stop handing out units for `seconds`, e.g. after a 429 with Retry-After."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    @property
+    def available(self) -> float:
+        self._refill(time.monotonic())
+        return self._tokens
+
+
+class DeploymentLimiter:
+    def __init__(self, name: str, rpm: int, tpm: int, headroom: float):
+        self.name = name
+        self.requests = TokenBucket(rpm * headroom)
+        self.tokens = TokenBucket(tpm * headroom)
+        self.stats = {
+            "requests": 0,
+            "throttled": 0,
+            "retries": 0,
+            "estimated_tokens": 0,
+            "actual_tokens": 0,
+            "limiter_wait_seconds": 0.0,
+            "backoff_seconds": 0.0,
+        }
+
+    async def acquire(self, estimated_tokens: int):
+        waited = await self.requests.acquire(1)
+        waited += await self.tokens.acquire(estimated_tokens)
+        self.stats["limiter_wait_seconds"] += waited
+        return waited
+
+    def block_for(self, seconds: float):
+        self.requests.block_for(seconds)
+        self.tokens.block_for(seconds)
+
+
+def retry_after_seconds(response):
+    """
+    Parse Azure's retry hints from a 429 response.
+    :return: Seconds to wait, or None when the response carries no hint.
+    """
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_seconds(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    # Full jitter: uniform in [0, min(cap, base * 2^attempt)]
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter:
+    """
+    Per-deployment RPM/TPM limiter placed in front of chat.completions.create.
+    Requests are charged their estimated token cost before they are sent, the
+    estimate is reconciled with the reported usage afterwards, and 429s pause the
+    deployment for the Retry-After period before retrying with jittered backoff.
+    """
+
+    def __init__(self, quotas: dict, headroom: float = DEFAULT_HEADROOM, max_retries: int = 5):
+        self.quotas = quotas
+        self.headroom = headroom
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    def set_quota(self, deployment: str, rpm: int, tpm: int):
+        """Quota for one deployment (e.g. a routed "gpt-4o@eastus"); takes effect before its first call."""
+        with self._lock:
+            self.quotas = {**self.quotas, deployment: {"rpm": rpm, "tpm": tpm}}
+
+    def for_deployment(self, deployment: str) -> DeploymentLimiter:
+        with self._lock:
+            limiter = self._limiters.get(deployment)
+            if limiter is None:
+                quota = self.quotas.get(deployment, self.quotas.get("default", DEFAULT_QUOTAS["gpt-4o"]))
+                limiter = DeploymentLimiter(deployment, quota["rpm"], quota["tpm"], self.headroom)
+                self._limiters[deployment] = limiter
+            return limiter
+
+    async def call(self, deployment: str, estimated_tokens: int, send, max_retries=None):
+        """
+        Run `send()` (a coroutine factory issuing one request) under the deployment's quota.
+        :param deployment: Azure deployment name, e.g. "gpt-4o".
+        :param estimated_tokens: Prompt estimate plus max_tokens, charged before sending.
+        :param send: Zero-argument callable returning the request coroutine.
+        :param max_retries: Override for this call; 0 leaves retrying (or failing over) to the caller.
+        :return: Whatever `send()` returns.
+        """
+        limiter = self.for_deployment(deployment)
+        max_retries = self.max_retries if max_retries is None else max_retries
+        for attempt in range(max_retries + 1):
+            waited = await limiter.acquire(estimated_tokens)
+            telemetry.record("rate_limit_wait", waited, attempt=attempt)
+            limiter.stats["requests"] += 1
+            limiter.stats["estimated_tokens"] += estimated_tokens
+            try:
+                result = await send()
+            except RETRYABLE_ERRORS as e:
+                hint = None
+                if isinstance(e, openai.RateLimitError):
+                    # Throttled requests are not billed against the quota, so give the estimate back
+                    limiter.stats["throttled"] += 1
+                    limiter.tokens.refund(estimated_tokens)
+                    hint = retry_after_seconds(e.response)
+                if hint is not None:
+                    # Honor the server hint, with a little jitter so waiters do not stampede
+                    delay = hint + random.uniform(0, 0.1 * hint + 0.05)
+                    limiter.block_for(delay)
+                else:
+                    delay = backoff_seconds(attempt)
+                if attempt == max_retries:
+                    raise
+                limiter.stats["retries"] += 1
+                limiter.stats["backoff_seconds"] += delay
+                with telemetry.span("retry_backoff", reason=type(e).__name__, server_hint=hint is not None):
+                    await asyncio.sleep(delay)
+                continue
+
+            usage = getattr(result, "usage", None)
+            actual = getattr(usage, "total_tokens", None)
+            if actual is not None:
+                limiter.stats["actual_tokens"] += actual
+                limiter.tokens.refund(estimated_tokens - actual)
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {
+            name: {
+                **{k: round(v, 3) if isinstance(v, float) else v for k, v in limiter.stats.items()},
+                "rpm_available": round(limiter.requests.available, 1),
+                "tpm_available": round(limiter.tokens.available),
+            }
+            for name, limiter in limiters.items()
+        }
+
+
+rate_limiter = RateLimiter(
+    get_setting("AZURE_QUOTAS", DEFAULT_QUOTAS),
+    headroom=get_setting("RATE_LIMIT_HEADROOM", DEFAULT_HEADROOM),
+    max_retries=get_setting("RATE_LIMIT_MAX_RETRIES", 5),
+)
@@ -0,0 +1,313 @@
+"""
+Generation of one exam's eye reports (right + left), as run by the job workers (jobs.py).
+
+The flow is the one the app used to run inside the Streamlit script: every image is
+described (deduplicated, packed and hedged per the options), each eye's report is
+synthesized as soon as its own descriptions are done, and costs, timings and the trace
+are collected into a JSON-ready result. progress() can be read from another thread
+while run() is working.
+
+A run stops early through its CancelToken: when the user cancels, at the first failed
+call (abort_on_error) or once its spend passes max_cost. Pending and in-flight requests
+are cancelled, and whatever finished is kept in the result. A retry of the run (see
+jobs.JobStore.retry) passes those results back as "previous", so only the images that
+failed or never ran are described again.
+"""
+import copy
+import threading
+
+import telemetry
+from cache import result_cache
+from clients import pool_stats
+from dedup import Deduplicator
+from estimator import ZERO_COSTS, estimate_exam, over_budget
+from hedging import HedgeBudget, latency_tracker, within_deadline
+from memory import memory_budget, peak_rss_mb, reset_peak_rss, rss_mb
+from messages import prompt_cache_summary
+from packing import PackedDescriber, packing_policy
+from pipeline import CancelToken, ExamPipeline
+from preprocess import summarize
+from ratelimit import rate_limiter
+from router import router
+from scheduler import scheduler
+from streaming import latency_summary
+from utils import analyze_image_hedged_async, analyze_images_packed_async, synthesize_medical_report_async
+
+# Options of a report run, with the app's defaults
+DEFAULT_OPTIONS = {
+    "exam_type": "oct_macula",
+    "prompts": {},                 # eye -> description prompt
+    "reasoning_prompt": "",
+    "layout": None,
+    "description_model": "gpt-4o",
+    "reasoning_model": "o3-mini",
+    "use_cache": True,
+    "stream": True,
+    "pack_images": True,
+    "hedge_requests": False,
+    "max_hedges": 2,
+    "dedup_images": True,
+    "dedup_distance": -1,          # perceptual near-duplicates within an eye (at most 2 bits); -1: exact bytes only
+    "max_cost": 0.0,               # report budget in USD; 0 means no limit
+    "abort_on_error": True,        # stop the whole report at the first failed call
+    "previous": None,              # {"descriptions", "reports"} kept from an earlier run (jobs.reusable_results)
+}
+
+
+class ReportRun:
+    """
+    One report generation.
+    :param options: DEFAULT_OPTIONS keys; missing ones take the defaults.
+    :param images_by_eye: eye -> images with .name, .size and getbuffer() (jobs.StoredImage).
+    """
+
+    def __init__(self, options: dict, images_by_eye: dict):
+        self.options = {**DEFAULT_OPTIONS, **options}
+        self.images_by_eye = images_by_eye
+        self.pipeline = None
+        self.token = CancelToken()
+        self._lock = threading.Lock()
+        self._progress = {
+            "images": {eye: len(items) for eye, items in images_by_eye.items()},
+            "descriptions": {eye: [None] * len(items) for eye, items in images_by_eye.items()},
+            "reports": {eye: {"text": "", "output": None} for eye in images_by_eye},
+        }
+
+    def progress(self) -> dict:
+        """
+        Snapshot for the UI: per eye, each description so far ({"text", "done", "duplicate_of", "error"}
+        or None) and the report being written ({"text"} while streaming, then {"output"}).
+        """
+        with self._lock:
+            return copy.deepcopy(self._progress)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.token.cancelled
+
+    def cancel(self, reason: str = "cancelled", detail: str = None):
+        """Stop the run from any thread; see CancelToken.cancel for the reasons."""
+        if self.token.cancel(reason, detail) and reason != "cancelled":
+            telemetry.metrics.inc("redcheck_report_aborts_total", exam_type=self.options["exam_type"], reason=reason)
+
+    def _describe_fn(self, budget):
+        options = self.options
+
+        async def describe_one(eye, idx, image, on_delta):
+            return await analyze_image_hedged_async(
+                image, options["exam_type"], options["prompts"][eye], model=options["description_model"],
+                use_cache=options["use_cache"], on_delta=on_delta, budget=budget,
+            )
+
+        async def describe_pack(eye, images):
+            # Same per-image results as describe_one, in the same order
+            return await analyze_images_packed_async(
+                images, options["exam_type"], options["prompts"][eye],
+                model=options["description_model"], use_cache=options["use_cache"],
+            )
+
+        return describe_one, describe_pack
+
+    def _reused(self, eye, idx):
+        # A description that succeeded in the run being retried, at no cost this time
+        previous = ((self.options["previous"] or {}).get("descriptions") or {}).get(eye) or []
+        result = previous[idx] if idx < len(previous) else None
+        if result is None:
+            return None
+        return {**result, "metadata": {}, "costs": dict(ZERO_COSTS), "reused": True}
+
+    def _reuse(self, describe):
+        async def describe_or_reuse(eye, idx, image, on_delta):
+            reused = self._reused(eye, idx)
+            return reused if reused is not None else await describe(eye, idx, image, on_delta)
+        return describe_or_reuse
+
+    async def _synthesize(self, eye, results, on_delta, deduplicator):
+        options = self.options
+        failed = [idx + 1 for idx, r in enumerate(results) if "error" in r]
+        if failed:
+            # A report from some of the images would look complete; leave it to the retry
+            return {
+                "output": {"error": f"Descriptions failed for image(s) {', '.join(map(str, failed))}; retry to describe them again"},
+                "metadata": {},
+                "costs": dict(ZERO_COSTS),
+            }
+        previous = ((options["previous"] or {}).get("reports") or {}).get(eye)
+        if previous is not None and all(r.get("reused") for r in results):
+            return {"output": previous, "metadata": {}, "costs": dict(ZERO_COSTS), "reused": True}
+        try:
+            return await within_deadline(
+                synthesize_medical_report_async(
+                    deduplicator.unique_outputs(eye, results) if deduplicator else [r["output"] for r in results],
+                    options["exam_type"],
+                    options["reasoning_prompt"],
+                    model=options["reasoning_model"],
+                    estrutura=options["layout"],
+                    use_cache=options["use_cache"],
+                    on_delta=on_delta,
+                ),
+                "synthesize",
+                lambda seconds: {
+                    "output": {"error": f"Report synthesis exceeded its {seconds}s deadline"},
+                    "metadata": {},
+                    "costs": dict(ZERO_COSTS),
+                },
+            )
+        except Exception as e:
+            # Reports are read as result["output"]; keep that shape when the call itself failed
+            return {"output": {"error": f"Report synthesis failed: {type(e).__name__}: {e}"}, "metadata": {}, "costs": dict(ZERO_COSTS)}
+
+    def run(self) -> dict:
+        options = self.options
+        exam_type = options["exam_type"]
+        prompts = options["prompts"]
+        hedge_budget = HedgeBudget(options["max_hedges"]) if options["hedge_requests"] else None
+        # Workers run one report at a time, so the process peaks below are this exam's
+        reset_peak_rss()
+        memory_budget.reset_peak()
+        rss_before = rss_mb()
+        # Pre-flight prediction, kept with the result to compare against what the run really cost
+        estimate = estimate_exam(options, self.images_by_eye)
+        describe_one, describe_pack = self._describe_fn(hedge_budget)
+
+        describe = describe_one
+        deduplicator = None
+        if options["dedup_images"]:
+            # Repeated uploads are described once; byte-identical ones across eyes only when both prompts match
+            deduplicator = Deduplicator(options["dedup_distance"], across_groups=len(set(prompts.values())) == 1, token=self.token)
+            deduplicator.plan(self.images_by_eye)
+        packer = None
+        if options["pack_images"]:
+            # Same per-image results as fan-out; the policy decides which images share a request
+            packer = PackedDescriber(describe_one, describe_pack, packing_policy, exam_type, options["description_model"], token=self.token)
+            packer.plan(
+                self.images_by_eye,
+                skip=lambda eye, idx: self._reused(eye, idx) is not None or bool(deduplicator and deduplicator.is_duplicate(eye, idx)),
+            )
+            describe = packer
+        # Descriptions kept from a retried run are not sent again (nor packed)
+        describe = self._reuse(describe)
+        if deduplicator:
+            describe = deduplicator.wrap(describe)
+
+        # Every call made for this report lands in one trace
+        report_trace = telemetry.start_trace("report", exam_type=exam_type)
+        self.pipeline = ExamPipeline(
+            describe=lambda eye, idx, image, on_delta: telemetry.within(
+                report_trace, describe(eye, idx, image, on_delta), "describe", eye=eye, image=idx + 1
+            ),
+            synthesize=lambda eye, results, on_delta: telemetry.within(
+                report_trace, self._synthesize(eye, results, on_delta, deduplicator), "synthesize", eye=eye
+            ),
+            stream=options["stream"],
+            token=self.token,
+        )
+
+        # Accumulate total costs from all calls
+        total_costs = {
+            "input_cost": 0.0,
+            "cached_input_cost": 0.0,
+            "output_cost": 0.0,
+            "hedge_cost_estimate": 0.0,
+            "total_cost": 0.0,
+            "hedged_requests": 0,
+        }
+        preprocessing_stats = []
+        usage_metadata = []
+
+        for event in self.pipeline.run(self.images_by_eye):
+            eye = event["group"]
+
+            if event["stage"] == "delta":
+                with self._lock:
+                    if event["of"] == "describe":
+                        self._progress["descriptions"][eye][event["index"]] = {"text": event["text"], "done": False}
+                    else:
+                        self._progress["reports"][eye]["text"] = event["text"]
+                continue
+
+            result = event["result"]
+            # Failed calls may carry no costs or metadata at all
+            for k in total_costs:
+                total_costs[k] += result.get("costs", {}).get(k, 0.0)
+            if result.get("hedge"):
+                total_costs["hedged_requests"] += 1
+            if result.get("metadata"):
+                usage_metadata.append(result["metadata"])
+            if "error" in result and options["abort_on_error"]:
+                where = f"{eye} image #{event['index'] + 1}" if event["stage"] == "describe" else f"{eye} report"
+                self.cancel("error", f"{where}: {result['error']}")
+            elif isinstance(result.get("output"), dict) and "error" in result["output"] and options["abort_on_error"]:
+                self.cancel("error", f"{eye} report: {result['output']['error']}")
+            if over_budget(total_costs["total_cost"], options["max_cost"]):
+                # Spend passed the report budget: stop the remaining calls, keep what is already done
+                self.cancel("budget", f"spent U${total_costs['total_cost']:.4f} of U${options['max_cost']:.2f}")
+
+            with self._lock:
+                if event["stage"] == "describe":
+                    if "preprocessing" in result and not result.get("dedup") and not result.get("reused"):
+                        preprocessing_stats.append(result["preprocessing"])
+                    self._progress["descriptions"][eye][event["index"]] = {
+                        "text": result.get("output") or f"⚠️ {result.get('error')}",
+                        "done": True,
+                        "error": result.get("error"),
+                        "duplicate_of": (result.get("dedup") or {}).get("duplicate_of"),
+                    }
+                else:
+                    self._progress["reports"][eye]["output"] = result["output"]
+
+        report_trace.finish()
+        telemetry.write_metrics()
+        memory = {"rss_before_mb": rss_before, "peak_rss_mb": peak_rss_mb(), "budget": memory_budget.stats()}
+        return self._result(report_trace, total_costs, preprocessing_stats, usage_metadata, deduplicator, packer, hedge_budget, memory, estimate)
+
+    def _result(self, report_trace, total_costs, preprocessing_stats, usage_metadata, deduplicator, packer, hedge_budget, memory, estimate) -> dict:
+        pipeline = self.pipeline
+        streaming = {}
+        for eye, results in pipeline.results.items():
+            for idx, r in enumerate(results, start=1):
+                streaming[f"{eye} image #{idx}"] = (r or {}).get("streaming", "cached")
+            streaming[f"{eye} report"] = pipeline.reports.get(eye, {}).get("streaming", "cached")
+        return {
+            "cancelled": pipeline.cancelled,
+            "descriptions": pipeline.results,
+            "reports": {eye: report["output"] for eye, report in pipeline.reports.items()},
+            "report_costs": {eye: report.get("costs", {}) for eye, report in pipeline.reports.items()},
+            "total_costs": total_costs,
+            "estimate": estimate,
+            "budget": {"max_cost": self.options["max_cost"], "exceeded": self.token.reason == "budget"},
+            "aborted": {"reason": self.token.reason, "detail": self.token.detail} if self.token.cancelled else None,
+            "reused": {
+                eye: sum(1 for r in results if r and r.get("reused")) for eye, results in pipeline.results.items()
+            } if self.options["previous"] else None,
+            "prompt_cache": prompt_cache_summary(usage_metadata),
+            "preprocessing": {"summary": summarize(preprocessing_stats), "images": preprocessing_stats},
+            "memory": memory,
+            "dedup": deduplicator.savings(pipeline.results) if deduplicator else None,
+            "critical_path": pipeline.critical_path(),
+            "streaming": streaming if self.options["stream"] else None,
+            "latency_summary": latency_summary(),
+            "hedging": {
+                "used": hedge_budget.used, "max_hedges": hedge_budget.max_hedges, "latency": latency_tracker.stats(),
+            } if hedge_budget else None,
+            "packing": {
+                "plans": {eye: [[i + 1 for i in chunk] for chunk in plan] for eye, plan in packer.plans.items()},
+                "policy": packing_policy.stats(),
+            } if packer else None,
+            "trace": {
+                "seconds": round(report_trace.seconds, 3),
+                "spans": len(report_trace.trace),
+                "rows": report_trace.rows(),
+            },
+            # This run only: process-wide metrics are exported by telemetry.write_metrics
+            "span_summary": report_trace.summary(),
+            # Snapshots of the worker process that ran the report
+            "process": {
+                "pool": pool_stats(),
+                "scheduler": scheduler.stats(),
+                "rate_limits": rate_limiter.stats(),
+                "routing": router.stats(),
+                "recent_decisions": router.recent_decisions(),
+                "result_cache": result_cache.stats(),
+            },
+        }
@@ -0,0 +1,225 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import openai
+
+import telemetry
+from clients import DEFAULT_API_VERSION, get_async_client
+from ratelimit import RETRYABLE_ERRORS, backoff_seconds, rate_limiter, retry_after_seconds
+from settings import get_setting
+
+# Weight of the newest latency sample in the per-deployment EWMA
+EWMA_ALPHA = 0.3
+# 429s older than this no longer count against a deployment
+THROTTLE_WINDOW_SECONDS = 60.0
+# Each recent 429 makes a deployment look this much slower to the router
+THROTTLE_PENALTY = 0.5
+
+
+class Deployment:
+    """
+    One Azure deployment serving a logical model, with its health, load and latency state.
+    :param name: Unique name, also the rate-limiter key (e.g. "gpt-4o@eastus").
+    :param deployment: Azure deployment name sent as `model` (e.g. "gpt-4o").
+    """
+
+    def __init__(self, name: str, model: str, endpoint: str, api_key: str, deployment: str,
+                 api_version: str = DEFAULT_API_VERSION, weight: float = 1.0):
+        self.name = name
+        self.model = model
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.deployment = deployment
+        self.api_version = api_version
+        self.weight = weight
+        self.in_flight = 0
+        self.ewma_seconds = None
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        self.throttles = deque(maxlen=50)
+        self.stats = {"requests": 0, "successes": 0, "failures": 0, "throttled": 0}
+
+    def client(self):
+        return get_async_client(self.endpoint, self.api_key, self.api_version)
+
+    @contextmanager
+    def track(self):
+        """Wrap the request itself: counts load and feeds the latency EWMA on success."""
+        self.in_flight += 1
+        start = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.in_flight -= 1
+        seconds = time.monotonic() - start
+        self.ewma_seconds = seconds if self.ewma_seconds is None else EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * self.ewma_seconds
+
+    def recent_throttles(self, now: float) -> int:
+        return sum(1 for t in self.throttles if now - t < THROTTLE_WINDOW_SECONDS)
+
+    def score(self, now: float, fallback_seconds: float) -> float:
+        # Expected wait: latency times queue length, inflated by recent 429s; lower is better
+        latency = self.ewma_seconds if self.ewma_seconds is not None else fallback_seconds
+        penalty = 1 + THROTTLE_PENALTY * self.recent_throttles(now)
+        return latency * (self.in_flight + 1) * penalty / self.weight
+
+    def snapshot(self, now: float) -> dict:
+        return {
+            "model": self.model,
+            "host": urlparse(self.endpoint).netloc or self.endpoint,
+            "deployment": self.deployment,
+            "in_flight": self.in_flight,
+            "ewma_seconds": round(self.ewma_seconds, 3) if self.ewma_seconds is not None else None,
+            "recent_429s": self.recent_throttles(now),
+            "healthy": now >= self.cooldown_until,
+            "cooldown_seconds": round(max(0.0, self.cooldown_until - now), 2),
+            **self.stats,
+        }
+
+
+class DeploymentRouter:
+    """
+    Routes each request for a logical model ("gpt-4o", "o3-mini") to one of its deployments.
+    Picks the healthy deployment with the lowest expected wait (EWMA latency x load, penalized
+    by recent 429s), puts deployments that throttle or fail in a cooldown and fails over to
+    the next one. With a single deployment it behaves like a plain rate_limiter.call.
+
+    Deployments come from AZURE_DEPLOYMENTS:
+        {"gpt-4o": [{"name": "gpt-4o@eastus", "endpoint": "...", "api_key": "...",
+                     "deployment": "gpt-4o", "api_version": "...", "rpm": 300, "tpm": 50000}, ...]}
+    Models without an entry use the default endpoint/key with deployment = model.
+    """
+
+    def __init__(self, deployments: dict, limiter=rate_limiter, max_attempts=None, history=200):
+        self.config = deployments or {}
+        self.limiter = limiter
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._pools = {}
+        self.decisions = deque(maxlen=history)
+
+    def pool(self, model: str, default=None) -> list:
+        """
+        :param default: (endpoint, api_key) used when `model` has no configured deployments.
+        """
+        with self._lock:
+            pool = self._pools.get(model)
+            if pool is None:
+                pool = []
+                for i, entry in enumerate(self.config.get(model) or []):
+                    name = entry.get("name") or f"{model}#{i + 1}"
+                    pool.append(Deployment(
+                        name, model, entry["endpoint"], entry["api_key"], entry.get("deployment", model),
+                        entry.get("api_version", DEFAULT_API_VERSION), entry.get("weight", 1.0),
+                    ))
+                    if "rpm" in entry and "tpm" in entry:
+                        self.limiter.set_quota(name, entry["rpm"], entry["tpm"])
+                if not pool:
+                    endpoint, api_key = default
+                    # Same limiter key as before routing existed, so AZURE_QUOTAS keeps applying
+                    pool.append(Deployment(model, model, endpoint, api_key, model))
+                self._pools[model] = pool
+            return pool
+
+    def choose(self, pool: list, exclude=()) -> tuple:
+        now = time.monotonic()
+        candidates = [d for d in pool if d.name not in exclude] or pool
+        healthy = [d for d in candidates if now >= d.cooldown_until]
+        known = [d.ewma_seconds for d in pool if d.ewma_seconds is not None]
+        # Unmeasured deployments look as fast as the best one, so they get tried
+        fallback = min(known) if known else 0.0
+        if healthy:
+            scores = {d.name: round(d.score(now, fallback), 3) for d in healthy}
+            return min(healthy, key=lambda d: (scores[d.name], d.in_flight)), "lowest_score", scores
+        # Everything is cooling down: take the one that recovers first
+        return min(candidates, key=lambda d: d.cooldown_until), "all_cooling_down", {}
+
+    async def call(self, model: str, estimated_tokens: int, send, default=None):
+        """
+        Send one request for `model` through the best deployment, failing over on 429s,
+        connection errors and 5xx.
+        :param send: send(deployment) -> coroutine issuing the request on that deployment.
+        :param default: (endpoint, api_key) for models without configured deployments.
+        """
+        pool = self.pool(model, default)
+        if len(pool) == 1:
+            deployment = pool[0]
+            self._record(model, deployment, "single", {}, 0, None)
+            return await self._attempt(deployment, estimated_tokens, send, None)
+
+        max_attempts = self.max_attempts or get_setting("ROUTER_MAX_ATTEMPTS", 2 * len(pool) + 1)
+        tried = set()
+        for attempt in range(max_attempts):
+            deployment, reason, scores = self.choose(pool, exclude=tried)
+            wait = deployment.cooldown_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            decision = self._record(model, deployment, reason, scores, attempt, tried)
+            try:
+                result = await self._attempt(deployment, estimated_tokens, send, 0)
+            except RETRYABLE_ERRORS as e:
+                decision["outcome"] = type(e).__name__
+                tried.add(deployment.name)
+                if len(tried) == len(pool):
+                    tried = set()
+                if attempt == max_attempts - 1:
+                    raise
+                continue
+            decision["outcome"] = "ok"
+            return result
+
+    async def _attempt(self, deployment: Deployment, estimated_tokens: int, send, max_retries):
+        span = telemetry.current_span()
+        if span is not None:
+            span.set(deployment=deployment.name)
+        deployment.stats["requests"] += 1
+        try:
+            result = await self.limiter.call(deployment.name, estimated_tokens, lambda: send(deployment), max_retries)
+        except RETRYABLE_ERRORS as e:
+            self._failed(deployment, e)
+            raise
+        deployment.stats["successes"] += 1
+        deployment.consecutive_failures = 0
+        return result
+
+    def _failed(self, deployment: Deployment, error: Exception):
+        now = time.monotonic()
+        deployment.stats["failures"] += 1
+        deployment.consecutive_failures += 1
+        hint = None
+        if isinstance(error, openai.RateLimitError):
+            deployment.stats["throttled"] += 1
+            deployment.throttles.append(now)
+            hint = retry_after_seconds(error.response)
+        cooldown = hint if hint is not None else backoff_seconds(deployment.consecutive_failures - 1, base=2.0)
+        deployment.cooldown_until = max(deployment.cooldown_until, now + cooldown)
+
+    def _record(self, model, deployment, reason, scores, attempt, tried) -> dict:
+        decision = {
+            "at": round(time.time(), 3),
+            "model": model,
+            "deployment": deployment.name,
+            "reason": reason,
+            "attempt": attempt,
+            "excluded": sorted(tried or ()),
+            "scores": scores,
+            "outcome": None,
+        }
+        self.decisions.append(decision)
+        return decision
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            pools = {model: list(pool) for model, pool in self._pools.items()}
+        return {model: {d.name: d.snapshot(now) for d in pool} for model, pool in pools.items()}
+
+    def recent_decisions(self, limit: int = 20) -> list:
+        return list(self.decisions)[-limit:]
+
+
+router = DeploymentRouter(get_setting("AZURE_DEPLOYMENTS", {}))
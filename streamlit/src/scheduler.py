@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from settings import get_setting
+
+
+class Scheduler:
+    """
+    Process-wide asyncio engine shared by every Streamlit session.
+    Coroutines run on a single background event loop, and `slot()` caps how many
+    Azure requests are in flight at once across all of them.
+    """
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._waiting = 0
+        self._in_flight = 0
+        self._peak_waiting = 0
+        self._completed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._recent_waits = deque(maxlen=200)
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._semaphore = asyncio.Semaphore(self.max_in_flight)
+                self._thread = threading.Thread(target=loop.run_forever, name="azure-scheduler", daemon=True)
+                self._thread.start()
+                self._loop = loop
+            return self._loop
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._ensure_loop()
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine on the shared loop from any thread.
+        :return: concurrent.futures.Future with the coroutine's result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the shared loop and block the calling thread until it finishes."""
+        return self.submit(coro).result(timeout)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Wait for one of the global in-flight request slots; yields the time spent queued."""
+        enqueued = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+            self._peak_waiting = max(self._peak_waiting, self._waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        wait = time.monotonic() - enqueued
+        with self._lock:
+            self._in_flight += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+            self._recent_waits.append(wait)
+        try:
+            yield wait
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._completed += 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        """Queue depth, in-flight count and wait-time figures for the whole process."""
+        with self._lock:
+            recent = sorted(self._recent_waits)
+            started = self._completed + self._in_flight
+            return {
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self._in_flight,
+                "queue_depth": self._waiting,
+                "peak_queue_depth": self._peak_waiting,
+                "completed": self._completed,
+                "avg_wait_seconds": round(self._total_wait / started, 3) if started else 0.0,
+                "p95_wait_seconds": round(recent[int(0.95 * (len(recent) - 1))], 3) if recent else 0.0,
+                "max_wait_seconds": round(self._max_wait, 3),
+            }
+
+
+scheduler = Scheduler(get_setting("MAX_IN_FLIGHT_REQUESTS", 16))
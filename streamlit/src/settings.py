@@ -0,0 +1,14 @@
+try:
+    import config_azure as config
+except ImportError:
+    config = None
+
+
+def get_setting(name, default=None):
+    """
+    Read an optional tuning value from config_azure.py.
+    :param name: Attribute name in config_azure (e.g. "AZURE_POOL_MAX_CONNECTIONS").
+    :param default: Value used when config_azure is missing or does not define it.
+    :return: The configured value or the default.
+    """
+    return getattr(config, name, default)
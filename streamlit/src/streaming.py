@@ -0,0 +1,148 @@
+import json
+import queue
+import re
+import threading
+import time
+from collections import defaultdict, deque
+
+_JSON_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", '"': '"', "\\": "\\", "/": "/"}
+_DONE = object()
+
+# Recent streaming samples per model, to compare time-to-first-token across deployments
+_latency_lock = threading.Lock()
+_latency = defaultdict(lambda: deque(maxlen=500))
+
+
+class StreamedCompletion:
+    """
+    Result of a streamed chat completion, shaped like a non-streamed one:
+    `to_json()` returns the same "choices"/"usage" layout the parsers already read.
+    """
+
+    def __init__(self, text: str, usage, started: float, first_token: float, finished: float, finish_reason: str = None):
+        self.text = text
+        self.finish_reason = finish_reason
+        self.usage = usage
+        self.started = started
+        self.first_token = first_token
+        self.finished = finished
+
+    def to_json(self) -> str:
+        usage = self.usage.model_dump(exclude_unset=True) if self.usage is not None else {}
+        return json.dumps({"choices": [{"message": {"role": "assistant", "content": self.text}, "finish_reason": self.finish_reason}], "usage": usage})
+
+    def timing(self) -> dict:
+        completion_tokens = getattr(self.usage, "completion_tokens", None) or 0
+        ttft = (self.first_token or self.finished) - self.started
+        generation = self.finished - (self.first_token or self.finished)
+        return {
+            "ttft_seconds": round(ttft, 3),
+            "total_seconds": round(self.finished - self.started, 3),
+            "completion_tokens": completion_tokens,
+            "tokens_per_second": round(completion_tokens / generation, 1) if generation > 0 else None,
+        }
+
+
+async def stream_completion(client, on_delta, **request) -> StreamedCompletion:
+    """
+    Issue a streamed chat completion and forward each text delta to `on_delta`.
+    :param client: AsyncAzureOpenAI client.
+    :param on_delta: Callable receiving each content delta (str) as it arrives.
+    :param request: Keyword arguments for chat.completions.create (without stream options).
+    """
+    started = time.monotonic()
+    first_token = None
+    usage = None
+    finish_reason = None
+    parts = []
+    stream = await client.chat.completions.create(
+        **request,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    async for chunk in stream:
+        # The final chunk carries usage and no choices; Azure may also send empty filter chunks
+        if getattr(chunk, "usage", None) is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+        delta = chunk.choices[0].delta.content
+        if delta:
+            if first_token is None:
+                first_token = time.monotonic()
+            parts.append(delta)
+            on_delta(delta)
+    return StreamedCompletion("".join(parts), usage, started, first_token, time.monotonic(), finish_reason)
+
+
+def record_latency(model: str, timing: dict):
+    with _latency_lock:
+        _latency[model].append(timing)
+
+
+def latency_summary() -> dict:
+    """Median and p95 time-to-first-token and median tokens/sec per model."""
+    with _latency_lock:
+        samples = {model: list(values) for model, values in _latency.items()}
+    summary = {}
+    for model, values in samples.items():
+        ttft = sorted(v["ttft_seconds"] for v in values)
+        tps = sorted(v["tokens_per_second"] for v in values if v["tokens_per_second"])
+        summary[model] = {
+            "calls": len(values),
+            "ttft_p50_seconds": ttft[len(ttft) // 2],
+            "ttft_p95_seconds": ttft[int(0.95 * (len(ttft) - 1))],
+            "tokens_per_second_p50": tps[len(tps) // 2] if tps else None,
+        }
+    return summary
+
+
+def iterate(submit, make_coro):
+    """
+    Bridge a streaming coroutine on the scheduler loop into a sync generator.
+    :param submit: Schedules a coroutine, returning a concurrent.futures.Future.
+    :param make_coro: make_coro(on_delta) -> coroutine that calls on_delta per text delta.
+    :return: Generator of {"delta": str} items followed by one {"result": dict}.
+    """
+    items = queue.Queue()
+    future = submit(make_coro(items.put))
+    future.add_done_callback(lambda f: items.put(_DONE))
+    while True:
+        item = items.get()
+        if item is _DONE:
+            break
+        yield {"delta": item}
+    yield {"result": future.result()}
+
+
+def partial_json_string(text: str, key: str) -> str:
+    """
+    Decode the (possibly unterminated) string value of `key` from partial JSON,
+    so a report's "description" can be shown while it is still being generated.
+    """
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), text)
+    if not match:
+        return ""
+    out = []
+    i = match.end()
+    while i < len(text):
+        char = text[i]
+        if char == '"':
+            break
+        if char == "\\":
+            if i + 1 >= len(text):
+                break
+            escape = text[i + 1]
+            if escape == "u":
+                if i + 6 > len(text):
+                    break
+                out.append(chr(int(text[i + 2:i + 6], 16)))
+                i += 6
+                continue
+            out.append(_JSON_ESCAPES.get(escape, escape))
+            i += 2
+            continue
+        out.append(char)
+        i += 1
+    return "".join(out)
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import time
+import uuid
+
+from tokens import CHARS_PER_TOKEN, estimate_request_tokens, text_tokens
+
+STUB_REPORT = {
+    "description": "[stub] Laudo simulado gerado localmente, sem chamada ao Azure.",
+    "diagnosis": "normal",
+    "diagnosis_description": "",
+}
+STUB_FILLER = "Sem alterações adicionais dignas de nota nesta região. "
+
+
+def _pad(text: str, completion_tokens: int) -> str:
+    # Filler up to roughly `completion_tokens` tokens (tokens.CHARS_PER_TOKEN chars each)
+    missing = completion_tokens * CHARS_PER_TOKEN - len(text)
+    if missing <= 0:
+        return text
+    return text + (" " + STUB_FILLER * (missing // len(STUB_FILLER) + 1))[:missing]
+
+
+def stub_completion(body: dict, completion_tokens=None) -> dict:
+    """
+    Build a chat.completion response for a request body without calling Azure.
+    Token usage is estimated from the request so costs and rate limits behave realistically.
+    :param completion_tokens: Pad each generated text to about this many tokens (JSON stays valid).
+    """
+    messages = body.get("messages", [])
+    images = sum(
+        1 for m in messages if isinstance(m.get("content"), list)
+        for part in m["content"] if part.get("type") == "image_url"
+    )
+    json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+    if json_mode and images:
+        # Packed image request: one description per numbered image
+        per_image = completion_tokens // images if completion_tokens else None
+        descriptions = [
+            {"image": n, "description": _pad(f"[stub] Descrição simulada da imagem {n}.", per_image or 0)}
+            for n in range(1, images + 1)
+        ]
+        content = json.dumps({"descriptions": descriptions}, ensure_ascii=False)
+    elif json_mode:
+        report = {**STUB_REPORT, "description": _pad(STUB_REPORT["description"], completion_tokens or 0)}
+        content = json.dumps(report, ensure_ascii=False)
+    else:
+        content = _pad(f"[stub] Descrição simulada de {images} imagem(ns).", completion_tokens or 0)
+    prompt_tokens = estimate_request_tokens(messages)
+    completion_tokens = text_tokens(content)
+    return {
+        "id": f"chatcmpl-stub-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        },
+    }
+
+
+class _Obj:
+    # Attribute access over a dict, enough to stand in for the SDK's response models
+    def __init__(self, data: dict):
+        self._data = data
+        for key, value in data.items():
+            setattr(self, key, _Obj(value) if isinstance(value, dict) else value)
+
+    def model_dump(self, exclude_unset=False) -> dict:
+        return self._data
+
+    def to_json(self) -> str:
+        return json.dumps(self._data)
+
+
+class _StubStream:
+    def __init__(self, body: dict):
+        self._body = body
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        content = self._body["choices"][0]["message"]["content"]
+        for i in range(0, len(content), 16):
+            delta = _Obj({"content": content[i:i + 16]})
+            yield _Obj({"choices": [_Obj({"delta": delta, "finish_reason": None})], "usage": None})
+        finish_reason = self._body["choices"][0]["finish_reason"]
+        yield _Obj({"choices": [_Obj({"delta": _Obj({"content": None}), "finish_reason": finish_reason})], "usage": None})
+        yield _Obj({"choices": [], "usage": self._body["usage"]})
+
+
+class StubAsyncClient:
+    """
+    Drop-in stand-in for AsyncAzureOpenAI's chat.completions.create, for tests and dry runs.
+    :param latency: Seconds each call sleeps before answering.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.chat = _Obj({})
+        self.chat.completions = self
+        self.calls = 0
+
+    async def create(self, **request):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        body = stub_completion(request)
+        if request.get("stream"):
+            return _StubStream(body)
+        return _Obj(body)
+
+
+def stub_batch(input_path: str, output_path: str) -> int:
+    """
+    Answer a Batch API input file locally, writing the Batch API output format.
+    :return: Number of requests answered.
+    """
+    count = 0
+    with open(input_path, encoding="utf-8") as src, open(output_path, "w", encoding="utf-8") as dst:
+        for line in src:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            response = {
+                "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": stub_completion(request["body"])},
+                "error": None,
+            }
+            dst.write(json.dumps(response, ensure_ascii=False) + "\n")
+            count += 1
+    return count
@@ -0,0 +1,355 @@
+"""
+Spans, counters and latency histograms for the image -> report pipeline.
+
+Spans nest through a context variable, so a coroutine started with `within(parent, ...)`
+and everything it awaits (rate limiting, queueing, the request itself, parsing) lands in
+the parent's trace. Every finished span also feeds the `redcheck_span_seconds` histogram,
+which is exported in Prometheus text format over HTTP (METRICS_PORT) and/or to a file
+(METRICS_FILE). Job workers write that file; the app's exporter serves it at /metrics/worker.
+"""
+import functools
+import inspect
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from settings import get_setting
+
+# Seconds; covers cache hits (ms) up to slow o3-mini syntheses
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+# Only these span attributes become metric labels; the rest stay on the trace
+METRIC_LABELS = ("model", "exam_type")
+
+_current = ContextVar("redcheck_span", default=None)
+_ids = itertools.count(1)
+
+
+class Span:
+    """One timed operation. Root spans own the trace list that their descendants append to."""
+
+    def __init__(self, name: str, parent=None, **attributes):
+        self.name = name
+        self.span_id = next(_ids)
+        self.parent = parent
+        self.attributes = attributes
+        self.trace = parent.trace if parent is not None else []
+        self.trace.append(self)
+        self.start = time.monotonic()
+        self.end = None
+
+    @property
+    def seconds(self) -> float:
+        return (self.end if self.end is not None else time.monotonic()) - self.start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def inherited(self, key, default=None):
+        # Attribute from this span or the closest ancestor that has it (e.g. eye, exam_type)
+        span = self
+        while span is not None:
+            if key in span.attributes:
+                return span.attributes[key]
+            span = span.parent
+        return default
+
+    def finish(self, end=None):
+        if self.end is not None:
+            return
+        self.end = end if end is not None else time.monotonic()
+        labels = {key: str(self.inherited(key, "")) for key in METRIC_LABELS}
+        labels["span"] = self.name
+        labels["status"] = "error" if "error" in self.attributes else "ok"
+        metrics.observe("redcheck_span_seconds", self.seconds, **labels)
+
+    def rows(self) -> list:
+        """Flat view of this span's trace, offsets relative to this span's start."""
+        children = {}
+        for span in self.trace:
+            children.setdefault(span.parent, []).append(span)
+
+        rows = []
+        stack = [(self, 0)]
+        while stack:
+            span, depth = stack.pop()
+            # Depth-first, siblings in start order
+            stack.extend((child, depth + 1) for child in sorted(children.get(span, []), key=lambda s: -s.start))
+            rows.append({
+                "span": "  " * depth + span.name,
+                "eye": span.inherited("eye"),
+                # 1-based image number, None on spans that are not about one image (one type per column)
+                "image": span.inherited("image"),
+                "start": round(span.start - self.start, 3),
+                "seconds": round(span.seconds, 3),
+                "attributes": {k: v for k, v in span.attributes.items() if k not in ("eye", "image")},
+            })
+        return rows
+
+    def summary(self) -> dict:
+        """Per span name in this trace: count, total and max seconds, slowest first."""
+        totals = {}
+        for span in self.trace:
+            entry = totals.setdefault(span.name, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            entry["count"] += 1
+            entry["total_seconds"] += span.seconds
+            entry["max_seconds"] = max(entry["max_seconds"], span.seconds)
+        summary = {
+            name: {**entry, "total_seconds": round(entry["total_seconds"], 3), "max_seconds": round(entry["max_seconds"], 3)}
+            for name, entry in totals.items()
+        }
+        return dict(sorted(summary.items(), key=lambda item: -item[1]["max_seconds"]))
+
+
+def current_span():
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a block as a child of the current span (or as a new root)."""
+    s = Span(name, _current.get(), **attributes)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.set(error=type(e).__name__)
+        raise
+    finally:
+        _current.reset(token)
+        s.finish()
+
+
+def record(name: str, seconds: float, **attributes):
+    """Add an already-measured interval (e.g. a queue wait) ending now, under the current span."""
+    now = time.monotonic()
+    s = Span(name, _current.get(), **attributes)
+    s.start = now - seconds
+    s.finish(now)
+    return s
+
+
+def start_trace(name: str, **attributes) -> Span:
+    """Open a root span; call .finish() on it when the traced work is done."""
+    return Span(name, None, **attributes)
+
+
+async def within(parent: Span, coro, name: str, **attributes):
+    """
+    Await `coro` inside a new child span of `parent`.
+    Needed for coroutines handed to the scheduler, which run in the loop thread's context.
+    """
+    token = _current.set(parent)
+    try:
+        with span(name, **attributes):
+            return await coro
+    finally:
+        _current.reset(token)
+
+
+def traced(name: str, **parameters):
+    """
+    Decorator running an async function inside a span.
+    :param parameters: Span attribute -> name of the function parameter holding its value,
+                       e.g. traced("analyze_image", model="model", exam_type="tipo_exame").
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            attributes = {attr: bound.arguments[param] for attr, param in parameters.items()}
+            with span(name, **attributes) as s:
+                result = await func(*args, **kwargs)
+                # Failures returned as {"error": ...} count as errors too
+                if isinstance(result, dict) and "error" in result:
+                    s.set(error=str(result["error"])[:200])
+                return result
+        return wrapper
+    return decorator
+
+
+def _label_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    """Process-wide counters and histograms, rendered in Prometheus text exposition format."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def quantile(self, name: str, q: float, **labels) -> float:
+        """Bucket upper bound holding the q-quantile, summed over every series matching `labels`."""
+        wanted = set(labels.items())
+        counts, total = [0] * len(self.buckets), 0
+        with self._lock:
+            for (metric, series), histogram in self._histograms.items():
+                if metric == name and wanted <= set(series):
+                    counts = [a + b for a, b in zip(counts, histogram["counts"])]
+                    total += histogram["count"]
+        for bound, count in zip(self.buckets, counts):
+            if total and count >= q * total:
+                return bound
+        return float("inf") if total else 0.0
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_label_text(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+            for bound, count in zip(self.buckets, histogram["counts"]):
+                lines.append(f"{name}_bucket{_label_text(labels + (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{_label_text(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{name}_sum{_label_text(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{_label_text(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def span_summary(self) -> dict:
+        """Per span name: count, total seconds and p50/p95 bucket bounds, slowest p95 first."""
+        with self._lock:
+            names = {dict(series)["span"] for metric, series in self._histograms if metric == "redcheck_span_seconds"}
+            totals = {}
+            for (metric, series), histogram in self._histograms.items():
+                if metric == "redcheck_span_seconds":
+                    entry = totals.setdefault(dict(series)["span"], [0, 0.0])
+                    entry[0] += histogram["count"]
+                    entry[1] += histogram["sum"]
+        summary = {
+            name: {
+                "count": totals[name][0],
+                "total_seconds": round(totals[name][1], 3),
+                "p50_le": self.quantile("redcheck_span_seconds", 0.5, span=name),
+                "p95_le": self.quantile("redcheck_span_seconds", 0.95, span=name),
+            }
+            for name in names
+        }
+        return dict(sorted(summary.items(), key=lambda item: -item[1]["p95_le"]))
+
+
+metrics = Metrics()
+metrics.describe("redcheck_span_seconds", "Duration of pipeline spans (queue wait, encode, request, parse, ...).")
+metrics.describe("redcheck_requests_total", "Model calls by outcome (ok, cached, error).")
+metrics.describe("redcheck_tokens_total", "Tokens billed by kind (prompt, cached, completion).")
+metrics.describe("redcheck_cost_usd_total", "Estimated spend in USD.")
+metrics.describe("redcheck_hedges_total", "Duplicate (hedged) image descriptions sent, by winner.")
+metrics.describe("redcheck_truncation_retries_total", "Completions cut off by max_tokens and asked again with more room.")
+metrics.describe("redcheck_truncated_total", "Completions still cut off by max_tokens after the retry.")
+metrics.describe("redcheck_report_aborts_total", "Reports stopped early by their abort policy, by reason (error, budget).")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # /metrics: this process; /metrics/worker: the last snapshot a job worker wrote with write_metrics
+        path = self.path.rstrip("/")
+        if path in ("", "/metrics"):
+            text = metrics.render()
+        elif path == "/metrics/worker" and (text := read_metrics()) is not None:
+            pass
+        else:
+            self.send_error(404)
+            return
+        body = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise flood the Streamlit server log
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_exporter(port=None):
+    """
+    Serve /metrics on localhost:`port` (default: METRICS_PORT setting) from a daemon thread.
+    Safe to call on every Streamlit rerun; only the first call starts the server.
+    :return: The port being served, or None when no port is configured.
+    """
+    global _server
+    port = port if port is not None else get_setting("METRICS_PORT")
+    if port is None:
+        return None
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((get_setting("METRICS_HOST", "127.0.0.1"), int(port)), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="redcheck-metrics", daemon=True).start()
+    return _server.server_address[1]
+
+
+def write_metrics(path=None):
+    """Write the Prometheus text snapshot to `path` (default: METRICS_FILE setting), atomically."""
+    path = path or get_setting("METRICS_FILE")
+    if not path:
+        return None
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(metrics.render())
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_metrics(path=None):
+    """The last snapshot written by write_metrics (possibly by another process), or None."""
+    path = path or get_setting("METRICS_FILE")
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return f.read()
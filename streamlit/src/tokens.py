@@ -0,0 +1,102 @@
+import base64
+import math
+import struct
+
+# Rough average for Portuguese/English prose with the o200k tokenizer
+CHARS_PER_TOKEN = 4
+# Per-message framing tokens added by the chat format
+MESSAGE_OVERHEAD_TOKENS = 4
+# Tokens charged for an image we cannot measure (a 1024x1024 high-detail image)
+UNKNOWN_IMAGE_TOKENS = 765
+# Enough of a base64 payload to reach the JPEG SOF marker past typical EXIF blocks
+_HEADER_B64_CHARS = 128 * 1024
+
+
+def text_tokens(text: str) -> int:
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def image_dimensions(data: bytes):
+    """
+    Read width and height from a PNG, GIF or JPEG header without decoding the image.
+    :return: (width, height) or None when the format is not recognized.
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return struct.unpack("<HH", data[6:10])
+    if data[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                i += 1
+                continue
+            marker = data[i + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                i += 1 if marker == 0xFF else 2
+                continue
+            length = struct.unpack(">H", data[i + 2:i + 4])[0]
+            # SOF0..SOF15, excluding DHT (C4), JPG (C8) and DAC (CC)
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                return width, height
+            i += 2 + length
+    return None
+
+
+def image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """
+    Image input tokens for gpt-4o class models.
+    High detail fits the image in 2048x2048, scales the short side to 768 and
+    charges 170 tokens per 512px tile plus a base of 85.
+    """
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+def data_url_image_tokens(url: str, detail: str = "high") -> int:
+    if detail == "low":
+        return 85
+    if not url.startswith("data:") or "," not in url:
+        return UNKNOWN_IMAGE_TOKENS
+    payload = url.split(",", 1)[1][:_HEADER_B64_CHARS]
+    payload = payload[: len(payload) - len(payload) % 4]
+    try:
+        dims = image_dimensions(base64.b64decode(payload))
+    except ValueError:
+        dims = None
+    if not dims:
+        return UNKNOWN_IMAGE_TOKENS
+    return image_tokens(*dims, detail=detail)
+
+
+def estimate_request_tokens(messages: list, max_tokens: int = 0, images: bool = True) -> int:
+    """
+    Estimate the tokens Azure will count against TPM for a chat request.
+    :param messages: Chat messages in the same shape passed to chat.completions.create.
+    :param max_tokens: Completion budget; Azure reserves it up front for quota purposes.
+    :param images: Count image parts; False leaves them out, for callers that size images themselves.
+    :return: Estimated prompt tokens plus max_tokens.
+    """
+    total = 0
+    for message in messages:
+        total += MESSAGE_OVERHEAD_TOKENS
+        content = message.get("content")
+        if isinstance(content, str):
+            total += text_tokens(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                total += text_tokens(part.get("text", ""))
+            elif part.get("type") == "image_url" and images:
+                image_url = part.get("image_url", {})
+                total += data_url_image_tokens(image_url.get("url", ""), image_url.get("detail", "high"))
+    return total + (max_tokens or 0)
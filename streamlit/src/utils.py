@@ -1,148 +1,97 @@
+import asyncio
 import base64
 from mimetypes import guess_type
-from openai import AzureOpenAI
 import json
+import os
 import time
-from icecream import ic
 import streamlit as st
+from clients import async_registry
+from scheduler import scheduler
+from router import router
+from tokens import estimate_request_tokens
+from preprocess import get_profile, preprocess_image
+from cache import cache_key, result_cache
+from streaming import iterate, record_latency, stream_completion
+from messages import image_messages, packed_image_messages, report_messages
+from packing import split_packed_output
+import telemetry
+from hedging import hedged, latency_tracker, within_deadline
+from memory import image_footprint, memory_budget
+from estimator import MAX_TOKENS_CEILING, ZERO_COSTS, max_tokens_for, token_cost, usage_stats
+from settings import get_setting
 
 try:
     import config_azure as config
 except ImportError:
     class Config:
-        AZURE_ENDPOINT = 'https://redcheckllm.openai.azure.com/openai/deployments/gpt-4o/chat/completions?api-version=2024-02-15-preview'
-        AZURE_API_KEY = st.session_state.token
+        # Headless runs (batch.py) read the environment; the app falls back to the session token
+        AZURE_ENDPOINT = os.environ.get('AZURE_OPENAI_ENDPOINT') or 'https://redcheckllm.openai.azure.com/openai/deployments/gpt-4o/chat/completions?api-version=2024-02-15-preview'
+        AZURE_API_KEY = os.environ.get('AZURE_OPENAI_API_KEY') or st.session_state.token
     config = Config()
 
-# Load layouts.json
-with open("streamlit/src/layouts.json", "r") as f:
-    layouts = json.load(f)
-
-# Decorator to measure execution time of a function
-def measure_time(func):
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        execution_time_seconds = round(end_time - start_time, 2)
-
-        ic(func.__name__)
-        ic(execution_time_seconds)
-        
-        return result
-    return wrapper
+# Sampling parameters shared by both calls (also part of the cache keys); max_tokens is only the
+# default: complete() sizes it per exam type from observed completion lengths
+SAMPLING_PARAMS = {
+    "max_tokens": 800,
+    "temperature": 0.2,
+    "top_p": 0.95,
+    "frequency_penalty": 0,
+    "presence_penalty": 0,
+    "stop": None,
+}
+
 
-def costs(metadata, input_rate=2.5, cached_rate=1.25, output_rate=10.0):
+def costs(metadata, input_rate=None, cached_rate=None, output_rate=None, model="gpt-4o"):
     """
-    Calculate the costs based on the metadata provided.
+    Calculate the costs based on the metadata provided (priced by estimator.token_cost).
     :param metadata: Dictionary containing token usage details.
-    :param input_rate: Cost per million input tokens.
+    :param input_rate: Cost per million input tokens (default: the model's, see estimator.model_pricing).
     :param cached_rate: Cost per million cached tokens.
     :param output_rate: Cost per million output tokens.
-    :return: Dictionary with cost breakdown.
+    :param model: Logical model that served the call; selects the pricing.
+    :return: Dictionary with cost breakdown, unrounded (round only for display).
     """
+    overrides = {"input_rate": input_rate, "cached_rate": cached_rate, "output_rate": output_rate}
+    return token_cost(
+        model,
+        metadata.get("prompt_tokens", 0),
+        metadata.get("completion_tokens", 0),
+        (metadata.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+        rates={name: rate for name, rate in overrides.items() if rate is not None},
+    )
 
-    prompt_tokens = metadata.get("prompt_tokens", 0)
-    cached_tokens = metadata.get("prompt_tokens_details", {}).get("cached_tokens", 0)
-    completion_tokens = metadata.get("completion_tokens", 0)
-
-    non_cached_prompt_tokens = max(prompt_tokens - cached_tokens, 0)
-
-    input_cost = non_cached_prompt_tokens / 1_000_000 * input_rate
-    cached_input_cost = cached_tokens / 1_000_000 * cached_rate
-    output_cost = completion_tokens / 1_000_000 * output_rate
-
-    total_cost = input_cost + cached_input_cost + output_cost
 
+def merge_usage(first: dict, second: dict) -> dict:
+    # Usage of a call that was retried: both attempts are billed
+    cached = sum((m.get("prompt_tokens_details") or {}).get("cached_tokens", 0) for m in (first, second))
     return {
-        "input_cost": round(input_cost, 3),
-        "cached_input_cost": round(cached_input_cost, 3),
-        "output_cost": round(output_cost, 3),
-        "total_cost": round(total_cost, 3)
+        **second,
+        **{k: first.get(k, 0) + second.get(k, 0) for k in ("prompt_tokens", "completion_tokens", "total_tokens")},
+        "prompt_tokens_details": {**(second.get("prompt_tokens_details") or {}), "cached_tokens": cached},
     }
 
-# Function to encode a local image into a data URL 
-def local_image_to_data_url(image_path):
-    # Guess the MIME type based on the file extension
-    mime_type, _ = guess_type(image_path)
+# Function to read an image and its MIME type: a local path, or an upload (anything with
+# getbuffer() and name, e.g. UploadedFile or jobs.StoredImage) whose buffer is used without copying
+def read_image(image_path):
+    name = image_path if isinstance(image_path, str) else image_path.name
+    mime_type, _ = guess_type(name)
     if mime_type is None:
         mime_type = 'application/octet-stream'
-    # Read and encode the image file
+    if not isinstance(image_path, str):
+        return image_path.getbuffer(), mime_type
     with open(image_path, "rb") as image_file:
-        base64_encoded_data = base64.b64encode(image_file.read()).decode('utf-8')
-    return f"data:{mime_type};base64,{base64_encoded_data}"
-
-
-@measure_time
-def analyze_image(image_path: str, tipo_exame: str, prompt: str, model="gpt-4o") -> dict:
-    # Load API configuration from config.py
-    endpoint = config.AZURE_ENDPOINT  # e.g., "https://redcheckllm.openai.azure.com/"
-    deployment = model
-    subscription_key = config.AZURE_API_KEY  # Your key
+        return image_file.read(), mime_type
 
-    # Initialize the Azure OpenAI client
-    client = AzureOpenAI(
-        azure_endpoint=endpoint,
-        api_key=subscription_key,
-        api_version="2024-05-01-preview",
-    )
 
-    # Read and encode image using the helper function
-    try:
-        data_url = local_image_to_data_url(image_path)
-    except Exception as e:
-        return {"error": f"Failed to read and encode image: {e}"}
+# Function to preprocess image bytes for the exam type and encode them into a data URL
+def encode_image(data, mime_type, tipo_exame):
+    data, mime_type, stats = preprocess_image(data, tipo_exame, mime_type)
+    # Build the URL as bytes and decode once: a single str copy of the base64 payload
+    return (f"data:{mime_type};base64,".encode("ascii") + base64.b64encode(data)).decode("ascii"), stats
 
-    # Prepare chat prompt with system message and user message containing the image data.
-    system_message = {
-        "role": "system",
-        "content": [
-            {
-                "type": "text",
-                "text": (prompt)
-            }
-        ]
-    }
-
-    user_message = {
-        "role": "user",
-        "content": [
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": data_url
-                }
-            }
-        ]
-    }
-    assistant_placeholder = {
-        "role": "assistant",
-        "content": [
-            {
-                "type": "text",
-                "text": f"Isto se trata de um exame do tipo {tipo_exame}."
-            }
-        ]
-    }
-
-    messages = [system_message, user_message, assistant_placeholder]
-
-    # Call the service to generate the completion
-    completion = client.chat.completions.create(
-        model=deployment,
-        messages=messages,
-        max_tokens=800,
-        temperature=0.2,
-        top_p=0.95,
-        frequency_penalty=0,
-        presence_penalty=0,
-        stop=None,
-        stream=False
-    )
 
+def completion_output(result_dict: dict):
     # Parse the output. It is assumed the response JSON has a "choices" list with a "message" field.
-    result_json = completion.to_json()
-    result_dict = json.loads(result_json)
     try:
         output_text = result_dict["choices"][0]["message"]["content"]
     except (IndexError, KeyError):
@@ -150,85 +99,331 @@ def analyze_image(image_path: str, tipo_exame: str, prompt: str, model="gpt-4o")
 
     # Also return metadata (e.g., token usage) if available.
     metadata = result_dict.get("usage", {})
-    costs_values = costs(metadata)
+    return output_text, metadata
 
-    return {"output": output_text, "metadata": metadata, "costs": costs_values}
 
+def finish_reason(result_dict: dict):
+    try:
+        return result_dict["choices"][0].get("finish_reason")
+    except (IndexError, KeyError):
+        return None
 
-@measure_time
-def synthesize_medical_report(output_texts: list, tipo_exame: str, prompt: str, model="o3-mini", estrutura=None) -> dict:
-    
-    # Concatena todas as descrições clínicas
-    combined_text = "\n\n".join(output_texts)
-
-    # Define as mensagens para o chat, incluindo o prompt detalhado e o texto agregado
-    system_message = {
-        "role": "system",
-        "content": [
-            {
-                "type": "text",
-                "text": (
-                    f"{prompt}\n\n"
-                    f"{estrutura}\n\n"
-                    "3. Indique se o exame é 'Normal', 'Anormal' ou 'Não Avaliável' na chave diagnosis.\n"
-                    "4. Se for 'Anormal', inclua na chave diagnosis_description as possíveis hipóteses clínicas associadas aos achados (como retinopatia diabética, edema de papila, oclusão venosa, etc.).\n\n"
-                    "Retorne sua resposta no seguinte formato JSON:\n\n"
-                    "{\n  \"description\": \"[insira o laudo formatado conforme acima]\",\n  \"diagnosis\": \"[normal | abnormal | non_available]\",\n  \"diagnosis_description\": \"[preencha apenas se o diagnóstico for 'abnormal']\"\n}"
-                )
-            }
-        ]
+
+def cached_result(result: dict, model: str) -> dict:
+    # A cache hit costs nothing: zero the costs so total_costs only counts real calls
+    telemetry.metrics.inc("redcheck_requests_total", model=model, outcome="cached")
+    return {**result, "metadata": {}, "costs": dict(ZERO_COSTS), "cached": True}
+
+
+def description_timed_out(seconds) -> dict:
+    return {"error": f"Image description exceeded its {seconds}s deadline", "metadata": {}, "costs": dict(ZERO_COSTS)}
+
+
+def record_usage(model: str, exam_type: str, metadata: dict, costs_values: dict):
+    # Token counts and cost go on the current span and into the Prometheus counters
+    tokens = {
+        "prompt": metadata.get("prompt_tokens", 0),
+        "cached": (metadata.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+        "completion": metadata.get("completion_tokens", 0),
     }
+    span = telemetry.current_span()
+    if span is not None:
+        span.set(**{f"{kind}_tokens": count for kind, count in tokens.items()}, cost=costs_values["total_cost"])
+    for kind, count in tokens.items():
+        telemetry.metrics.inc("redcheck_tokens_total", count, model=model, exam_type=exam_type, kind=kind)
+    telemetry.metrics.inc("redcheck_cost_usd_total", costs_values["total_cost"], model=model, exam_type=exam_type)
+
+
+async def complete(model: str, messages: list, on_delta=None, observe=None, **params):
+    """
+    Send one chat completion for the logical `model` to the deployment the router picks, within that
+    deployment's quota and the global in-flight limit.
+    With on_delta the completion is streamed and each text delta is forwarded as it arrives.
+    An answer cut off by max_tokens is asked again once with twice the room (not streamed to on_delta);
+    if that is cut off too, metadata carries "truncated": True.
+    :param observe: (exam_type, stage, images) to size max_tokens from the observed completion lengths
+                    (estimator.max_tokens_for) and record this call's length and latency.
+    :param params: Overrides/extra request parameters on top of SAMPLING_PARAMS (e.g. response_format).
+    :return: (output_text, metadata, completion)
+    """
+    # Load API configuration from config.py; used when AZURE_DEPLOYMENTS has no pool for this model
+    endpoint = config.AZURE_ENDPOINT  # e.g., "https://redcheckllm.openai.azure.com/"
+    subscription_key = config.AZURE_API_KEY  # Your key
+    request = {**SAMPLING_PARAMS, **params}
+    if observe is not None and "max_tokens" not in params:
+        request["max_tokens"] = await asyncio.to_thread(max_tokens_for, model, *observe)
+
+    async def attempt(request, on_delta):
+        async def send(deployment):
+            # Reuse the shared, pooled Azure OpenAI client of the deployment the router picked
+            client = deployment.client()
+            async with scheduler.slot() as waited:
+                telemetry.record("queue_wait", waited)
+                with async_registry.track(client), deployment.track(), \
+                        telemetry.span("request", deployment=deployment.name, streamed=on_delta is not None) as span:
+                    if on_delta is not None:
+                        completion = await stream_completion(client, on_delta, model=deployment.deployment, messages=messages, **request)
+                        # Time to first token is the model's own processing time; the rest is generation
+                        span.set(**completion.timing())
+                        return completion
+                    return await client.chat.completions.create(model=deployment.deployment, messages=messages, **request, stream=False)
+
+        try:
+            completion = await router.call(
+                model, estimate_request_tokens(messages, request["max_tokens"]), send, default=(endpoint, subscription_key)
+            )
+        except Exception:
+            telemetry.metrics.inc("redcheck_requests_total", model=model, outcome="error")
+            raise
+        telemetry.metrics.inc("redcheck_requests_total", model=model, outcome="ok")
+        with telemetry.span("parse"):
+            result_dict = json.loads(completion.to_json())
+            output_text, metadata = completion_output(result_dict)
+        return output_text, metadata, completion, finish_reason(result_dict) == "length"
+
+    start = time.monotonic()
+    output_text, metadata, completion, truncated = await attempt(request, on_delta)
+    final_tokens = metadata.get("completion_tokens", 0)
+    if truncated and request["max_tokens"] < MAX_TOKENS_CEILING:
+        telemetry.metrics.inc("redcheck_truncation_retries_total", model=model)
+        retry = {**request, "max_tokens": min(2 * request["max_tokens"], MAX_TOKENS_CEILING)}
+        # The partial text already went to on_delta; the retry streams into nothing so timing() stays available
+        output_text, retry_metadata, completion, truncated = await attempt(retry, (lambda delta: None) if on_delta else None)
+        final_tokens = retry_metadata.get("completion_tokens", 0)
+        metadata = merge_usage(metadata, retry_metadata)
+    if truncated:
+        telemetry.metrics.inc("redcheck_truncated_total", model=model)
+        metadata = {**metadata, "truncated": True}
+    if observe is not None:
+        exam_type, stage, images = observe
+        await asyncio.to_thread(
+            usage_stats.observe, model, exam_type, stage, final_tokens // max(images, 1), time.monotonic() - start, truncated
+        )
+    return output_text, metadata, completion
+
+
+@telemetry.traced("analyze_image", model="model", exam_type="tipo_exame")
+async def analyze_image_async(image_path: str, tipo_exame: str, prompt: str, model="gpt-4o", use_cache=True, on_delta=None) -> dict:
+    # Read the image off the event loop; its bytes address the cache entry
+    try:
+        data, mime_type = await asyncio.to_thread(read_image, image_path)
+    except Exception as e:
+        return {"error": f"Failed to read and encode image: {e}"}
 
-    user_message = {
-        "role": "user",
-        "content": [
-            {
-                "type": "text",
-                "text": combined_text
+    key = cache_key("analyze_image", data, prompt, tipo_exame, model, SAMPLING_PARAMS, get_profile(tipo_exame))
+    if use_cache:
+        with telemetry.span("cache_lookup") as span:
+            cached = await asyncio.to_thread(result_cache.get, "analyze_image", key)
+            span.set(hit=cached is not None)
+        if cached is not None:
+            return cached_result(cached, model)
+
+    # The decoded image and its data URL count against the process memory budget until sent
+    async with memory_budget.reserve(image_footprint(data)):
+        # Downsize and encode image using the helper function
+        try:
+            with telemetry.span("encode") as span:
+                data_url, preprocessing = await asyncio.to_thread(encode_image, data, mime_type, tipo_exame)
+                span.set(bytes_in=preprocessing["original_bytes"], bytes_out=preprocessing["processed_bytes"])
+        except Exception as e:
+            return {"error": f"Failed to read and encode image: {e}"}
+        # Only the data URL is needed from here on; free the raw bytes before the request
+        del data
+
+        messages = image_messages(data_url, preprocessing["detail"], tipo_exame, prompt)
+
+        # Call the service to generate the completion
+        output_text, metadata, completion = await complete(model, messages, on_delta, observe=(tipo_exame, "describe", 1))
+    costs_values = costs(metadata, model=model)
+    record_usage(model, tipo_exame, metadata, costs_values)
+
+    result = {"output": output_text, "metadata": metadata, "costs": costs_values, "preprocessing": preprocessing}
+    if on_delta is not None:
+        result["streaming"] = completion.timing()
+        record_latency(model, result["streaming"])
+    if use_cache and output_text and not metadata.get("truncated"):
+        await asyncio.to_thread(result_cache.put, "analyze_image", key, result)
+    return result
+
+
+@telemetry.traced("analyze_images_packed", model="model", exam_type="tipo_exame")
+async def analyze_images_packed_async(image_paths: list, tipo_exame: str, prompt: str, model="gpt-4o", use_cache=True) -> list:
+    """
+    Describe several images of the same eye in a single request.
+    Each image keeps its own cache entry (shared with analyze_image_async), so only the
+    uncached images are packed; descriptions the model leaves out are retried one by one.
+    Every request runs under the "describe" stage deadline; past it, every image a packed
+    request carried gets a timeout error. Truncated responses are not cached.
+    :return: One analyze_image result per path, in input order. Packed results carry
+             "packed": {"size", "position"}; the request's usage metadata is on the first one
+             and its full cost is split evenly among the descriptions it returned (charged to
+             the first retry when it returned none).
+    """
+    results = [None] * len(image_paths)
+    pending = []
+    for index, image_path in enumerate(image_paths):
+        try:
+            data, mime_type = await asyncio.to_thread(read_image, image_path)
+        except Exception as e:
+            results[index] = {"error": f"Failed to read and encode image: {e}"}
+            continue
+        key = cache_key("analyze_image", data, prompt, tipo_exame, model, SAMPLING_PARAMS, get_profile(tipo_exame))
+        cached = await asyncio.to_thread(result_cache.get, "analyze_image", key) if use_cache else None
+        if cached is not None:
+            results[index] = cached_result(cached, model)
+        else:
+            pending.append((index, key, data, mime_type))
+
+    if len(pending) == 1:
+        index = pending[0][0]
+        results[index] = await within_deadline(
+            analyze_image_async(image_paths[index], tipo_exame, prompt, model=model, use_cache=use_cache),
+            "describe", description_timed_out,
+        )
+        pending = []
+
+    encoded = []
+    async with memory_budget.reserve(sum(image_footprint(data) for _, _, data, _ in pending)):
+        for index, key, data, mime_type in pending:
+            try:
+                with telemetry.span("encode", image=index + 1):
+                    encoded.append((index, key, *await asyncio.to_thread(encode_image, data, mime_type, tipo_exame)))
+            except Exception as e:
+                results[index] = {"error": f"Failed to read and encode image: {e}"}
+        pending = []
+
+        if encoded:
+            messages = packed_image_messages([(url, stats["detail"]) for _, _, url, stats in encoded], tipo_exame, prompt)
+            completion = await within_deadline(
+                complete(model, messages, observe=(tipo_exame, "describe_packed", len(encoded)), response_format={"type": "json_object"}),
+                "describe", description_timed_out,
+            )
+            if isinstance(completion, dict):
+                # Deadline passed: the images it carried fail instead of being retried one by one
+                for index, *_ in encoded:
+                    results[index] = {**completion, "costs": dict(completion["costs"])}
+                encoded = []
+            else:
+                output_text, metadata, _ = completion
+                descriptions = split_packed_output(output_text, len(encoded))
+
+    unbilled = None
+    if encoded:
+        costs_values = costs(metadata, model=model)
+        record_usage(model, tipo_exame, metadata, costs_values)
+        returned = sum(description is not None for description in descriptions)
+        # The whole request is billed even when the model leaves images out
+        share = {k: v / max(returned, 1) for k, v in costs_values.items()}
+        if not returned:
+            unbilled = costs_values
+        cacheable = use_cache and not metadata.get("truncated")
+
+        for position, ((index, key, _, preprocessing), description) in enumerate(zip(encoded, descriptions)):
+            if description is None:
+                continue
+            result = {
+                "output": description,
+                "metadata": metadata,
+                "costs": dict(share),
+                "preprocessing": preprocessing,
+                "packed": {"size": len(encoded), "position": position},
             }
-        ]
-    }
+            if cacheable:
+                await asyncio.to_thread(result_cache.put, "analyze_image", key, result)
+            results[index] = result
+            metadata = {}
+
+    # O modelo pode omitir alguma imagem: essas são descritas individualmente
+    missing = [i for i, r in enumerate(results) if r is None]
+    retried = await asyncio.gather(*(
+        within_deadline(
+            analyze_image_async(image_paths[i], tipo_exame, prompt, model=model, use_cache=use_cache),
+            "describe", description_timed_out,
+        )
+        for i in missing
+    ))
+    for index, result in zip(missing, retried):
+        results[index] = result
+    if unbilled is not None:
+        first = results[missing[0]]
+        charged = {**ZERO_COSTS, **first.get("costs", {})}
+        results[missing[0]] = {**first, "costs": {k: charged.get(k, 0.0) + unbilled.get(k, 0.0) for k in {**charged, **unbilled}}}
+    return results
+
+
+async def analyze_image_hedged_async(image_path: str, tipo_exame: str, prompt: str, model="gpt-4o", use_cache=True, on_delta=None, budget=None) -> dict:
+    """
+    analyze_image_async under the "describe" stage deadline, hedged when `budget` is given:
+    if the call is still running at the observed HEDGE_QUANTILE (p90) latency for this
+    model/exam_type, a duplicate is sent (while the report's budget lasts) and the first
+    answer wins. The duplicate is not streamed.
+    :param budget: hedging.HedgeBudget shared by one report, or None to disable hedging.
+    :return: analyze_image result; hedged ones carry "hedge": {"after_seconds", "winner"} and
+             costs["hedge_cost_estimate"] (included in total_cost): the losing attempt is not
+             streamed, so its tokens are unknown and it is assumed to cost as much as the winner.
+    """
+    delay = None
+    if budget is not None:
+        delay = latency_tracker.quantile(model, tipo_exame, get_setting("HEDGE_QUANTILE", 0.9))
+
+    def attempt(primary):
+        return analyze_image_async(image_path, tipo_exame, prompt, model=model, use_cache=use_cache,
+                                   on_delta=on_delta if primary else None)
+
+    async def run():
+        result, seconds, hedge = await hedged(attempt, delay, budget)
+        if "error" not in result and not result.get("cached"):
+            latency_tracker.observe(model, tipo_exame, seconds)
+        if hedge is not None:
+            # The losing duplicate is cancelled client-side but Azure may still bill it. Its usage is
+            # never reported, so this is an estimate: it is charged as the winner's cost
+            extra = result["costs"]["total_cost"] if "costs" in result else 0.0
+            result = {**result, "hedge": hedge, "costs": {**result.get("costs", ZERO_COSTS), "hedge_cost_estimate": extra}}
+            result["costs"]["total_cost"] += extra
+            telemetry.metrics.inc("redcheck_hedges_total", model=model, exam_type=tipo_exame, winner=hedge["winner"])
+        return result
 
-    messages = [system_message, user_message]
+    return await within_deadline(run(), "describe", description_timed_out)
 
-    # Configuração da API
-    endpoint = config.AZURE_ENDPOINT
-    deployment = model
-    subscription_key = config.AZURE_API_KEY
 
-    # Inicializa o cliente Azure OpenAI
-    client = AzureOpenAI(
-        azure_endpoint=endpoint,
-        api_key=subscription_key,
-        api_version="2024-05-01-preview",
-    )
+def analyze_image(image_path: str, tipo_exame: str, prompt: str, model="gpt-4o", use_cache=True) -> dict:
+    # Thin sync wrapper: runs on the shared scheduler loop
+    return scheduler.run(analyze_image_async(image_path, tipo_exame, prompt, model=model, use_cache=use_cache))
 
-    # Chama a API com as mensagens preparadas
-    completion = client.chat.completions.create(
-        model=deployment,
-        messages=messages,
-        max_tokens=800,
-        temperature=0.2,
-        top_p=0.95,
-        frequency_penalty=0,
-        presence_penalty=0,
-        stop=None,
-        stream=False,
-        response_format={"type": "json_object"}
+
+def analyze_image_stream(image_path: str, tipo_exame: str, prompt: str, model="gpt-4o", use_cache=True):
+    """
+    Streaming variant of analyze_image.
+    :return: Generator of {"delta": str} items, then one {"result": dict} with the same shape as analyze_image.
+    """
+    return iterate(
+        scheduler.submit,
+        lambda on_delta: analyze_image_async(
+            image_path, tipo_exame, prompt, model=model, use_cache=use_cache, on_delta=on_delta
+        ),
     )
 
-    # Processa a resposta
-    result_json = completion.to_json()
-    result_dict = json.loads(result_json)
+
+@telemetry.traced("synthesize_medical_report", model="model", exam_type="tipo_exame")
+async def synthesize_medical_report_async(output_texts: list, tipo_exame: str, prompt: str, model="o3-mini", estrutura=None, use_cache=True, on_delta=None) -> dict:
     
-    # Metadata
-    metadata = result_dict.get("usage", {})
-    costs_values = costs(metadata)
+    # Reaproveita o laudo se as mesmas entradas já foram sintetizadas
+    key = cache_key("synthesize_medical_report", output_texts, tipo_exame, prompt, model, estrutura, SAMPLING_PARAMS)
+    if use_cache:
+        with telemetry.span("cache_lookup") as span:
+            cached = await asyncio.to_thread(result_cache.get, "synthesize_medical_report", key)
+            span.set(hit=cached is not None)
+        if cached is not None:
+            return cached_result(cached, model)
 
-    try:
-        output_text = result_dict["choices"][0]["message"]["content"]
-    except (IndexError, KeyError):
-        output_text = ""
+    messages = report_messages(output_texts, prompt, estrutura)
+
+    # Chama a API com as mensagens preparadas
+    output_text, metadata, completion = await complete(
+        model, messages, on_delta, observe=(tipo_exame, "synthesize", 1), response_format={"type": "json_object"}
+    )
+    costs_values = costs(metadata, model=model)
+    record_usage(model, tipo_exame, metadata, costs_values)
 
     # Tenta converter a resposta para um dicionário JSON
     try:
@@ -236,10 +431,39 @@ def synthesize_medical_report(output_texts: list, tipo_exame: str, prompt: str,
     except json.JSONDecodeError:
         final_result = {"error": "Falha ao interpretar a resposta como JSON.", "raw_response": output_text}
 
-    return {"output": final_result, "metadata": metadata, "costs": costs_values}
+    result = {"output": final_result, "metadata": metadata, "costs": costs_values}
+    if on_delta is not None:
+        result["streaming"] = completion.timing()
+        record_latency(model, result["streaming"])
+    # Só guarda laudos válidos; respostas que falharam no parse devem ser refeitas
+    if use_cache and "error" not in final_result:
+        await asyncio.to_thread(result_cache.put, "synthesize_medical_report", key, result)
+    return result
+
+
+def synthesize_medical_report(output_texts: list, tipo_exame: str, prompt: str, model="o3-mini", estrutura=None, use_cache=True) -> dict:
+    # Wrapper síncrono: executa no loop compartilhado do scheduler
+    return scheduler.run(
+        synthesize_medical_report_async(output_texts, tipo_exame, prompt, model=model, estrutura=estrutura, use_cache=use_cache)
+    )
+
+
+def synthesize_medical_report_stream(output_texts: list, tipo_exame: str, prompt: str, model="o3-mini", estrutura=None, use_cache=True):
+    """
+    Variante em streaming de synthesize_medical_report.
+    :return: Gerador de itens {"delta": str} (JSON parcial), seguido de um {"result": dict}.
+    """
+    return iterate(
+        scheduler.submit,
+        lambda on_delta: synthesize_medical_report_async(
+            output_texts, tipo_exame, prompt, model=model, estrutura=estrutura, use_cache=use_cache, on_delta=on_delta
+        ),
+    )
 
 
 if __name__ == "__main__":
+    from icecream import ic
+
     # Example usage:
     image_path = "samples/sample.jpg"
     image_path_2 = "samples/sample_2.jpg"
@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# utils reads the Azure key at import time; tests never reach Azure (see stub_client)
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "stub")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def workdir(tmp_path_factory):
+    """
+    Run from a scratch directory laid out like the repository root: config files are read
+    through the same relative paths, while every .cache database is written to the scratch copy.
+    """
+    path = tmp_path_factory.mktemp("repo")
+    for name in ("streamlit", "samples"):
+        os.symlink(os.path.join(REPO_ROOT, name), path / name)
+    previous = os.getcwd()
+    os.chdir(path)
+    yield path
+    os.chdir(previous)
+
+
+@pytest.fixture(scope="session")
+def stub_client():
+    """Answer every model call with stub.StubAsyncClient instead of Azure."""
+    import utils
+    from clients import async_registry
+    from stub import StubAsyncClient
+
+    client = StubAsyncClient()
+    async_registry.register(utils.config.AZURE_ENDPOINT, utils.config.AZURE_API_KEY, client)
+    return client
+
+
+def sample(name: str):
+    from jobs import StoredImage
+
+    return StoredImage(os.path.join(REPO_ROOT, "samples", name), name)
@@ -0,0 +1,25 @@
+import json
+
+from batch import load_exams
+
+
+def test_default_exam_ids_are_unique_across_exam_dates(tmp_path):
+    manifest = tmp_path / "exams.jsonl"
+    rows = [
+        {"patient": "p1", "exam_type": "oct_macula", "eye": "right", "exam_date": "2024-01-10", "images": ["a.jpg"]},
+        {"patient": "p1", "exam_type": "oct_macula", "eye": "right", "exam_date": "2024-06-02", "images": ["b.jpg"]},
+        {"patient": "p1", "exam_type": "oct_macula", "eye": "right", "images": ["c.jpg"]},
+        {"patient": "p1", "exam_type": "oct_macula", "eye": "right", "images": ["d.jpg"]},
+        {"exam_id": "custom", "patient": "p1", "exam_type": "oct_macula", "eye": "left", "images": ["e.jpg"]},
+    ]
+    manifest.write_text("\n".join(json.dumps(row) for row in rows[:2]) + "\n\n" + "\n".join(json.dumps(row) for row in rows[2:]) + "\n")
+
+    exams = load_exams(str(manifest))
+    assert [exam["exam_id"] for exam in exams] == [
+        "p1/oct_macula/2024-01-10/right",
+        "p1/oct_macula/2024-06-02/right",
+        "p1/oct_macula/line4/right",
+        "p1/oct_macula/line5/right",
+        "custom",
+    ]
+    assert exams[0]["images"] == [str(tmp_path / "a.jpg")]
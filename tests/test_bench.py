@@ -0,0 +1,84 @@
+import json
+
+import httpx
+import pytest
+
+from bench import compare, percentile, sample_images
+from mock_azure import MockAzureServer, parse_distribution
+
+CHAT_PATH = "/openai/deployments/gpt-4o/chat/completions?api-version=2024-05-01-preview"
+
+
+def test_percentile_is_nearest_rank():
+    values = [0.4, 0.1, 0.3, 0.2]
+    assert percentile(values, 0.5) == 0.2
+    assert percentile(values, 0.95) == 0.4
+    assert percentile([], 0.95) == 0.0
+
+
+def test_compare_flags_only_regressions_past_the_tolerance():
+    base = {"p95_seconds": 1.0, "sessions_per_second": 10.0, "peak_heap_mb": 100.0}
+    results = {
+        "utils/images=1/sessions=1": {"p95_seconds": 1.1, "sessions_per_second": 9.0, "peak_heap_mb": 110.0},
+        "utils/images=4/sessions=1": {"p95_seconds": 1.3, "sessions_per_second": 7.0, "peak_heap_mb": 130.0},
+        "app/images=1/sessions=1": {"p95_seconds": 9.0, "sessions_per_second": 1.0, "peak_heap_mb": 900.0},
+    }
+    baseline = {"utils/images=1/sessions=1": base, "utils/images=4/sessions=1": base}
+    assert compare(results, baseline, 0.2) == [
+        "utils/images=4/sessions=1: p95_seconds 1.0 -> 1.3",
+        "utils/images=4/sessions=1: sessions_per_second 10.0 -> 7.0",
+        "utils/images=4/sessions=1: peak_heap_mb 100.0 -> 130.0",
+    ]
+
+
+def test_sample_images_cycle_through_the_samples():
+    images = sample_images(6)
+    assert len(images) == 6 and images[4] == images[0]
+
+
+def test_parse_distribution():
+    assert parse_distribution("fixed:0.5")() == 0.5
+    assert 0.2 <= parse_distribution("uniform:0.2,1.0")() <= 1.0
+    assert parse_distribution("normal:0.0,0.01")() >= 0.0
+    with pytest.raises(ValueError):
+        parse_distribution("weibull:1,2")
+
+
+def chat(stream=False, images=0):
+    content = [{"type": "text", "text": "Descreva."}]
+    content += [{"type": "image_url", "image_url": {"url": "data:image/png;base64,"}}] * images
+    return {
+        "messages": [{"role": "user", "content": content}],
+        "response_format": {"type": "json_object"} if images > 1 else None,
+        "stream": stream,
+        "stream_options": {"include_usage": True} if stream else None,
+    }
+
+
+def test_mock_server_answers_like_azure():
+    with MockAzureServer(completion_tokens=50) as mock:
+        response = httpx.post(mock.url + CHAT_PATH, json=chat(images=2))
+        assert response.status_code == 200
+        body = response.json()
+        assert body["model"] == "gpt-4o"
+        assert len(json.loads(body["choices"][0]["message"]["content"])["descriptions"]) == 2
+        assert body["usage"]["completion_tokens"] >= 40
+
+        response = httpx.post(mock.url + CHAT_PATH, json=chat(stream=True))
+        events = [line[len("data: "):] for line in response.text.splitlines() if line.startswith("data: ")]
+        assert events[-1] == "[DONE]"
+        chunks = [json.loads(event) for event in events[:-1]]
+        text = "".join(c["choices"][0]["delta"].get("content") or "" for c in chunks if c["choices"])
+        assert text.startswith("[stub]")
+        assert chunks[-1]["usage"]["completion_tokens"] > 0
+
+        assert httpx.post(mock.url + "/openai/other", json={}).status_code == 404
+        assert mock.stats["requests"] == 2 and mock.stats["streamed"] == 1 and mock.stats["in_flight"] == 0
+
+
+def test_mock_server_throttles_with_retry_after():
+    with MockAzureServer(rate_429=1.0, retry_after_ms=1500) as mock:
+        response = httpx.post(mock.url + CHAT_PATH, json=chat())
+    assert response.status_code == 429
+    assert response.headers["retry-after-ms"] == "1500" and response.headers["retry-after"] == "1"
+    assert mock.stats["throttled"] == 1
@@ -0,0 +1,51 @@
+import types
+
+import pytest
+
+import cache
+from cache import ResultCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, "time", types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def entry(size: int) -> str:
+    # Stored as JSON: the quotes add 2 bytes
+    return "x" * (size - 2)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    store = ResultCache(str(tmp_path / "cache.sqlite"), max_bytes=250, ttl_seconds=0)
+    for key in ("a", "b"):
+        store.put("ns", key, entry(100))
+        clock[0] += 1
+    assert store.get("ns", "a") is not None
+    clock[0] += 1
+    store.put("ns", "c", entry(100))
+
+    assert store.get("ns", "b") is None
+    assert store.get("ns", "a") is not None and store.get("ns", "c") is not None
+    stats = store.stats()
+    assert stats["entries"] == 2 and stats["bytes"] == 200
+    assert stats["namespaces"]["ns"]["evictions"] == 1
+
+
+def test_expired_entries_are_misses(tmp_path, clock):
+    store = ResultCache(str(tmp_path / "cache.sqlite"), ttl_seconds=60)
+    store.put("ns", "a", {"output": "ok"})
+    store.put("ns", "forever", {"output": "ok"}, ttl_seconds=0)
+    clock[0] += 61
+    assert store.get("ns", "a") is None
+    assert store.get("ns", "forever") == {"output": "ok"}
+    assert store.stats()["entries"] == 1
+
+
+def test_entries_are_per_namespace(tmp_path):
+    store = ResultCache(str(tmp_path / "cache.sqlite"))
+    store.put("analyze_image", "k", 1)
+    assert store.get("synthesize", "k") is None
+    assert store.get("analyze_image", "k") == 1
@@ -0,0 +1,51 @@
+import io
+import os
+
+from PIL import Image
+
+from conftest import REPO_ROOT
+from dedup import Deduplicator, hamming, perceptual_hash
+
+
+def read(name: str) -> bytes:
+    with open(os.path.join(REPO_ROOT, "samples", name), "rb") as f:
+        return f.read()
+
+
+def reencoded(data: bytes) -> bytes:
+    with Image.open(io.BytesIO(data)) as img:
+        buffer = io.BytesIO()
+        # Same pixels in another format, as when an export is saved as PNG
+        img.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def plan(images_by_group: dict, **kwargs) -> Deduplicator:
+    deduplicator = Deduplicator(**kwargs)
+    deduplicator.plan(images_by_group, read=lambda data: data)
+    return deduplicator
+
+
+def test_other_eye_of_same_patient_is_not_merged():
+    # OS and OD OCT of one patient: similar layout, different thickness maps and values
+    left, right = read("sample_2.jpg"), read("sample_right_2.jpg")
+    for kwargs in ({}, {"max_distance": 16}):
+        deduplicator = plan({"right": [right], "left": [left]}, across_groups=True, **kwargs)
+        assert deduplicator.matches == []
+        assert not deduplicator.is_duplicate("left", 0)
+    assert hamming(perceptual_hash(left), perceptual_hash(right)) > 2
+
+
+def test_exact_copies_merge_across_eyes():
+    data = read("sample.jpg")
+    deduplicator = plan({"right": [data], "left": [data]}, across_groups=True)
+    assert deduplicator.is_duplicate("left", 0)
+    assert deduplicator.matches[0]["match"] == "exact"
+
+
+def test_reencoded_copy_merges_only_within_an_eye_when_enabled():
+    data = read("sample_2.jpg")
+    copy = reencoded(data)
+    assert not plan({"left": [data, copy]}).is_duplicate("left", 1)
+    assert plan({"left": [data, copy]}, max_distance=2).is_duplicate("left", 1)
+    assert not plan({"right": [data], "left": [copy]}, max_distance=2, across_groups=True).is_duplicate("left", 0)
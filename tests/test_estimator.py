@@ -0,0 +1,103 @@
+import pytest
+
+import estimator
+import prompts
+import utils
+from conftest import sample
+from estimator import (
+    DEFAULT_MAX_TOKENS, MAX_TOKENS_CEILING, MIN_MAX_TOKENS, UsageStats, estimate_exam, max_tokens_for, over_budget,
+    token_cost,
+)
+from loaders import get_layouts
+from reports import DEFAULT_OPTIONS
+
+
+@pytest.fixture
+def usage(tmp_path, monkeypatch):
+    stats = UsageStats(str(tmp_path / "usage.sqlite"))
+    monkeypatch.setattr(estimator, "usage_stats", stats)
+    return stats
+
+
+def seed(stats, stage, completion_tokens, seconds=1.0, model="gpt-4o", exam_type="oct_macula"):
+    for tokens in completion_tokens:
+        stats.observe(model, exam_type, stage, tokens, seconds)
+
+
+def test_costs_and_token_cost_share_the_pricing():
+    metadata = {"prompt_tokens": 3000, "completion_tokens": 500, "prompt_tokens_details": {"cached_tokens": 1000}}
+    assert utils.costs(metadata, model="o3-mini") == token_cost("o3-mini", 3000, 500, 1000)
+    assert token_cost("gpt-4o-mini-2024-07-18", 1_000_000, 0)["total_cost"] == pytest.approx(0.15)
+    # Models missing from the table are priced like gpt-4o
+    assert token_cost("unknown", 0, 1_000_000)["output_cost"] == pytest.approx(10.0)
+    assert utils.costs(metadata, output_rate=20.0)["output_cost"] == pytest.approx(0.01)
+
+
+def test_max_tokens_is_p95_plus_headroom(usage):
+    seed(usage, "describe", range(100, 1100, 10))
+    # p95 of 100..1090 is 1050; 1050 x 1.3 = 1365
+    assert max_tokens_for("gpt-4o", "oct_macula", "describe") == 1365
+    # Packed requests scale per image, up to the ceiling
+    assert max_tokens_for("gpt-4o", "oct_macula", "describe", images=2) == 2730
+    assert max_tokens_for("gpt-4o", "oct_macula", "describe", images=4) == MAX_TOKENS_CEILING
+
+
+def test_max_tokens_is_clamped(usage):
+    seed(usage, "describe", [10] * 5)
+    seed(usage, "synthesize", [5000] * 5)
+    assert max_tokens_for("gpt-4o", "oct_macula", "describe") == MIN_MAX_TOKENS
+    assert max_tokens_for("gpt-4o", "oct_macula", "synthesize") == MAX_TOKENS_CEILING
+
+
+def test_max_tokens_defaults_until_enough_samples(usage):
+    seed(usage, "describe", [2000] * 4)
+    assert max_tokens_for("gpt-4o", "oct_macula", "describe") == DEFAULT_MAX_TOKENS
+    seed(usage, "describe", [2000])
+    assert max_tokens_for("gpt-4o", "oct_macula", "describe") == 2600
+
+
+def exam_options(**overrides):
+    return {
+        **DEFAULT_OPTIONS,
+        "prompts": {"right": prompts.DEFAULT_EYE_PROMPT, "left": prompts.DEFAULT_EYE_PROMPT},
+        "reasoning_prompt": prompts.COMBINED_PROMPT,
+        "layout": get_layouts()["oct_macula"],
+        **overrides,
+    }
+
+
+def test_estimate_exam(usage):
+    seed(usage, "describe", [300] * 10, seconds=4.0)
+    seed(usage, "synthesize", [600] * 10, seconds=8.0, model="o3-mini")
+    images = {"right": [sample("sample_right.jpg"), sample("sample_right_2.jpg")], "left": [sample("sample.jpg")], "extra": []}
+    estimate = estimate_exam(exam_options(), images)
+
+    describe, synthesize = estimate["stages"]["describe"], estimate["stages"]["synthesize"]
+    assert (describe["calls"], describe["completion_tokens"], describe["observed"]) == (3, 900, 10)
+    assert (synthesize["calls"], synthesize["completion_tokens"], synthesize["model"]) == (2, 1200, "o3-mini")
+    assert describe["cost"] == pytest.approx(token_cost("gpt-4o", describe["prompt_tokens"], 900)["total_cost"])
+    assert estimate["total_cost"] == pytest.approx(describe["cost"] + synthesize["cost"])
+    # Eyes run in parallel: p90 description plus median synthesis
+    assert estimate["seconds"] == 12.0
+
+    one_eye = estimate_exam(exam_options(), {"right": images["right"]})
+    assert 0 < one_eye["total_cost"] < estimate["total_cost"]
+    assert estimate_exam(exam_options(), {})["seconds"] == 0.0
+
+
+def test_estimate_exam_uses_defaults_without_observations(usage):
+    estimate = estimate_exam(exam_options(), {"right": [sample("sample_right.jpg")]})
+    assert estimate["stages"]["describe"]["completion_tokens"] == estimator.DEFAULT_OUTPUT_TOKENS["describe"]
+    assert estimate["stages"]["describe"]["max_tokens"] == DEFAULT_MAX_TOKENS
+    assert estimate["seconds"] == estimator.DEFAULT_SECONDS["describe"] + estimator.DEFAULT_SECONDS["synthesize"]
+
+
+@pytest.mark.parametrize("cost,max_cost,expected", [
+    (1.0, 0.0, False),
+    (1.0, None, False),
+    (1.0, 0.5, True),
+    (0.4, 0.5, False),
+    (0.5, 0.5, False),
+])
+def test_over_budget(cost, max_cost, expected):
+    assert over_budget(cost, max_cost) is expected
@@ -0,0 +1,78 @@
+import asyncio
+
+import utils
+from hedging import HedgeBudget, LatencyTracker, hedged
+
+
+def attempts(delays: dict, errors=()):
+    """attempt(primary) answering after delays["primary"/"hedge"] seconds; `errors` fail with an error result."""
+    started = []
+
+    async def attempt(primary):
+        name = "primary" if primary else "hedge"
+        started.append(name)
+        await asyncio.sleep(delays[name])
+        if name in errors:
+            return {"error": name}
+        return {"output": name}
+
+    return attempt, started
+
+
+def run(attempt, delay, budget):
+    return asyncio.run(hedged(attempt, delay, budget))
+
+
+def test_no_delay_never_hedges():
+    attempt, started = attempts({"primary": 0.01})
+    result, _, info = run(attempt, None, HedgeBudget(1))
+    assert result == {"output": "primary"} and info is None and started == ["primary"]
+
+
+def test_fast_primary_is_not_hedged():
+    attempt, started = attempts({"primary": 0.0, "hedge": 0.0})
+    budget = HedgeBudget(1)
+    result, _, info = run(attempt, 0.2, budget)
+    assert info is None and started == ["primary"] and budget.used == 0
+
+
+def test_slow_primary_loses_to_the_hedge():
+    attempt, started = attempts({"primary": 1.0, "hedge": 0.01})
+    budget = HedgeBudget(1)
+    result, seconds, info = run(attempt, 0.05, budget)
+    assert result == {"output": "hedge"}
+    assert info == {"after_seconds": 0.05, "winner": "hedge"}
+    # Timed from the primary's start, as the caller waited through the delay too
+    assert 0.06 <= seconds < 0.5 and budget.used == 1
+
+
+def test_exhausted_budget_waits_for_the_primary():
+    attempt, started = attempts({"primary": 0.1, "hedge": 0.0})
+    budget = HedgeBudget(0)
+    result, _, info = run(attempt, 0.01, budget)
+    assert result == {"output": "primary"} and info is None and started == ["primary"]
+
+
+def test_an_error_only_wins_when_both_attempts_fail():
+    attempt, _ = attempts({"primary": 0.1, "hedge": 0.01}, errors=("hedge",))
+    result, _, info = run(attempt, 0.05, HedgeBudget(1))
+    assert result == {"output": "primary"} and info["winner"] == "primary"
+
+    attempt, _ = attempts({"primary": 0.1, "hedge": 0.01}, errors=("primary", "hedge"))
+    result, _, info = run(attempt, 0.05, HedgeBudget(1))
+    assert "error" in result
+
+
+def test_hedged_description_charges_an_estimated_hedge_cost(monkeypatch):
+    monkeypatch.setattr(utils, "latency_tracker", LatencyTracker(min_samples=1))
+    utils.latency_tracker.observe("gpt-4o", "oct_macula", 0.05)
+    delays = iter([1.0, 0.01])
+
+    async def fake_analyze(image_path, tipo_exame, prompt, model="gpt-4o", use_cache=True, on_delta=None):
+        await asyncio.sleep(next(delays))
+        return {"output": "ok", "costs": {**utils.ZERO_COSTS, "total_cost": 0.02}}
+
+    monkeypatch.setattr(utils, "analyze_image_async", fake_analyze)
+    result = utils.scheduler.run(utils.analyze_image_hedged_async("img", "oct_macula", "", budget=HedgeBudget(1)))
+    assert result["hedge"]["winner"] == "hedge"
+    assert result["costs"]["hedge_cost_estimate"] == 0.02 and result["costs"]["total_cost"] == 0.04
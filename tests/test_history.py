@@ -0,0 +1,38 @@
+import pytest
+
+from history import ReportHistory, fts_query
+
+
+def record(**overrides):
+    return {
+        "patient": "Maria", "exam_type": "retinografia", "exam_date": "2025-01-10", "eye": "right",
+        "image_hashes": ["abc"], "descriptions": ["Disco óptico normal."],
+        "report": {"description": "Fundo de olho sem alterações.", "diagnosis": "normal"},
+        "costs": {"total_cost": 0.01},
+        **overrides,
+    }
+
+
+def test_failed_save_rolls_back_and_releases_the_write_lock(tmp_path):
+    history = ReportHistory(str(tmp_path / "history.sqlite"))
+    assert history.save(record())["version"] == 1
+    with pytest.raises(TypeError):
+        history.save(record(costs={"total_cost": object()}))
+    assert not history._conn.in_transaction
+    saved = history.save(record())
+    assert saved["version"] == 2
+    assert history.get(saved["id"])["version"] == 2
+
+
+def test_fts_query_matches_every_word_as_a_literal_prefix():
+    assert fts_query("retinopatia  diabética") == '"retinopatia"* "diabética"*'
+    assert fts_query('edema OR "papila') == '"edema"* "OR"* """papila"*'
+    assert fts_query("   ") == ""
+
+
+def test_search_uses_the_fts_query(tmp_path):
+    history = ReportHistory(str(tmp_path / "history.sqlite"))
+    history.save(record(report={"description": "Sinais de retinopatia diabética.", "diagnosis": "abnormal"}))
+    history.save(record(eye="left"))
+    assert [row["eye"] for row in history.search("retino diab")] == ["right"]
+    assert history.search("retino OR") == []
@@ -0,0 +1,140 @@
+import os
+import threading
+import types
+
+import pytest
+
+import jobs
+from jobs import CANCELLED, DONE, FAILED, QUEUED, RUNNING, JobStore
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(jobs, "time", types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def job_store(tmp_path, **kwargs) -> JobStore:
+    return JobStore(str(tmp_path / "jobs.sqlite"), str(tmp_path / "jobs"), **kwargs)
+
+
+def submit(store: JobStore, owner="ana") -> str:
+    return store.submit(owner, {"exam_type": "oct_macula"}, {"right": [("od.jpg", b"right eye")], "left": [("os.jpg", b"left eye")]})
+
+
+def test_claims_oldest_queued_job_first(tmp_path, clock):
+    store = job_store(tmp_path)
+    first = submit(store)
+    clock[0] += 1
+    second = submit(store)
+    assert store.position(second) == 1
+
+    job = store.claim("w1")
+    assert (job["id"], job["status"], job["worker"], job["attempts"]) == (first, RUNNING, "w1", 1)
+    assert store.claim("w2")["id"] == second
+    assert store.claim("w3") is None
+
+
+def test_stale_job_is_requeued_then_failed_after_max_attempts(tmp_path, clock):
+    store = job_store(tmp_path, stale_seconds=60, max_attempts=2)
+    job_id = submit(store)
+    store.claim("w1")
+    clock[0] += 30
+    store.heartbeat(job_id)
+    clock[0] += 59
+    assert store.claim("w2") is None
+
+    # w1 stopped heartbeating: the job goes to the next worker
+    clock[0] += 2
+    job = store.claim("w2")
+    assert (job["id"], job["worker"], job["attempts"]) == (job_id, "w2", 2)
+
+    clock[0] += 61
+    assert store.claim("w3") is None
+    job = store.get(job_id)
+    assert job["status"] == FAILED and job["error"] == "worker stopped responding"
+
+
+def test_concurrent_claims_take_each_job_once(tmp_path):
+    # Two stores on one file stand in for two worker processes
+    stores = [job_store(tmp_path), job_store(tmp_path)]
+    submitted = {submit(stores[0]) for _ in range(12)}
+    claimed = []
+
+    def work(store, worker):
+        while (job := store.claim(worker)) is not None:
+            claimed.append(job["id"])
+
+    threads = [threading.Thread(target=work, args=(store, f"w{i}")) for i, store in enumerate(stores * 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == sorted(submitted)
+
+
+def test_cancel_queued_and_running_jobs(tmp_path, clock):
+    store = job_store(tmp_path, stale_seconds=60)
+    queued = submit(store)
+    store.cancel(queued)
+    assert store.get(queued)["status"] == CANCELLED
+    assert store.claim("w1") is None
+
+    running = submit(store)
+    store.claim("w1")
+    assert store.heartbeat(running) is False
+    store.cancel(running)
+    # The worker sees the request on its next heartbeat and finishes the job itself
+    assert store.get(running)["status"] == RUNNING
+    assert store.heartbeat(running, progress={"done": 1}) is True
+    store.finish(running, CANCELLED)
+    assert store.get(running)["status"] == CANCELLED and store.get(running)["progress"] == {"done": 1}
+
+    # A cancelled job whose worker died is not requeued
+    orphan = submit(store)
+    store.claim("w2")
+    store.cancel(orphan)
+    clock[0] += 61
+    assert store.claim("w3") is None
+    assert store.get(orphan)["status"] == CANCELLED
+
+
+def test_retry_hard_links_images_and_carries_successful_results(tmp_path, clock):
+    store = job_store(tmp_path)
+    job_id = submit(store)
+    store.claim("w1")
+    with pytest.raises(ValueError):
+        store.retry(job_id)
+    result = {
+        "descriptions": {"right": [{"output": "ok"}], "left": [{"error": "timeout"}]},
+        "reports": {"right": {"diagnosis": "normal"}, "left": {"error": "skipped"}},
+    }
+    store.finish(job_id, FAILED, result=result, error="timeout")
+
+    new_id = store.retry(job_id)
+    old, new = store.get(job_id), store.get(new_id)
+    assert new["status"] == QUEUED and new["owner"] == "ana"
+    for group in ("right", "left"):
+        old_path, new_path = old["images"][group][0]["path"], new["images"][group][0]["path"]
+        assert os.path.dirname(new_path) == os.path.join(store.job_dir, new_id)
+        assert os.path.samefile(old_path, new_path)
+    assert new["options"]["previous"]["descriptions"] == {"right": [{"output": "ok"}], "left": [None]}
+    assert new["options"]["previous"]["reports"] == {"right": {"diagnosis": "normal"}}
+
+
+def test_purge_removes_expired_jobs_and_their_images(tmp_path, clock):
+    store = job_store(tmp_path, retention_seconds=100)
+    done = submit(store)
+    store.claim("w1")
+    store.finish(done, DONE, result={"descriptions": {}, "reports": {}})
+    retried = store.retry(done)
+    waiting = submit(store)
+    clock[0] += 101
+    store.purge()
+
+    assert store.get(done) is None
+    assert not os.path.exists(os.path.join(store.job_dir, done))
+    # Hard-linked images of the retry survive the original's purge
+    assert all(os.path.exists(item["path"]) for items in store.get(retried)["images"].values() for item in items)
+    assert store.get(waiting)["status"] == QUEUED
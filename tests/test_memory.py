@@ -0,0 +1,44 @@
+import asyncio
+
+from memory import MemoryBudget
+
+
+def test_reservation_waits_until_release():
+    budget = MemoryBudget(100)
+    order = []
+
+    async def hold(name, nbytes, seconds):
+        async with budget.reserve(nbytes):
+            order.append(f"{name} in")
+            await asyncio.sleep(seconds)
+            order.append(f"{name} out")
+
+    async def main():
+        first = asyncio.ensure_future(hold("a", 70, 0.05))
+        await asyncio.sleep(0)
+        await hold("b", 40, 0)
+        await first
+
+    asyncio.run(main())
+    # b does not fit next to a, so it only starts once a has released its bytes
+    assert order == ["a in", "a out", "b in", "b out"]
+    assert budget.in_use == 0 and budget.peak == 70 and budget.waits == 1
+    assert budget.stats()["wait_seconds"] > 0
+
+
+def test_oversize_reservation_goes_through_alone():
+    budget = MemoryBudget(100)
+    order = []
+
+    async def hold(name, nbytes):
+        async with budget.reserve(nbytes):
+            order.append((name, budget.in_use))
+            await asyncio.sleep(0.01)
+
+    async def main():
+        # Would deadlock if a reservation larger than the budget waited for room
+        await asyncio.wait_for(asyncio.gather(hold("big", 500), hold("small", 10), hold("big2", 300)), timeout=2)
+
+    asyncio.run(main())
+    assert order == [("big", 500), ("small", 10), ("big2", 300)]
+    assert budget.in_use == 0 and budget.peak == 500
@@ -0,0 +1,32 @@
+import messages
+from loaders import get_layouts
+from tokens import text_tokens
+
+
+def test_cache_padding_is_neutral_and_reaches_threshold(monkeypatch):
+    monkeypatch.setattr(messages, "get_setting", lambda name, default=None: "always" if name == "PROMPT_CACHE_PADDING" else default)
+    prompt = "Descreva a imagem."
+    padding = messages.cache_padding(prompt)
+    assert padding.startswith(messages.PADDING_START) and padding.endswith(messages.PADDING_END)
+    assert text_tokens(prompt + padding) >= messages.MIN_CACHEABLE_TOKENS
+    for layout in get_layouts().values():
+        text = layout if isinstance(layout, str) else str(layout)
+        assert text[:40] not in padding
+
+
+def test_cache_padding_never(monkeypatch):
+    monkeypatch.setattr(messages, "get_setting", lambda name, default=None: "never" if name == "PROMPT_CACHE_PADDING" else default)
+    assert messages.cache_padding("curto") == ""
+
+
+def test_cache_padding_is_off_by_default():
+    assert messages.cache_padding("curto") == ""
+
+
+def test_report_messages_keep_the_layout_before_the_instructions():
+    layout = get_layouts()["oct_macula"]
+    system, user = messages.report_messages(["descrição 1", "descrição 2"], "Prompt do laudo.", layout)
+    text = system["content"][0]["text"]
+    assert text == f"Prompt do laudo.\n\n{layout}\n\n{messages.REPORT_INSTRUCTIONS}"
+    # The descriptions are the only per-call content, at the end
+    assert user["content"][0]["text"] == "descrição 1\n\ndescrição 2"
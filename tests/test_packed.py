@@ -0,0 +1,74 @@
+import asyncio
+import json
+
+import hedging
+import utils
+from conftest import sample
+
+PACKED_USAGE = {"prompt_tokens": 2000, "completion_tokens": 300}
+PROMPT = "Descreva a imagem."
+
+
+def fake_packed(monkeypatch, descriptions, metadata=None, delay=0.0):
+    """Answer packed requests with `descriptions`; single-image requests still go to the stub client."""
+    calls = []
+    real_complete = utils.complete
+
+    async def complete(model, messages, on_delta=None, observe=None, **params):
+        if observe and observe[1] == "describe_packed":
+            calls.append(observe)
+            await asyncio.sleep(delay)
+            entries = [{"image": n, "description": text} for n, text in descriptions.items()]
+            return json.dumps({"descriptions": entries}), {**PACKED_USAGE, **(metadata or {})}, None
+        return await real_complete(model, messages, on_delta=on_delta, observe=observe, **params)
+
+    monkeypatch.setattr(utils, "complete", complete)
+    return calls
+
+
+def describe(use_cache=False):
+    images = [sample("sample.jpg"), sample("sample_2.jpg")]
+    return utils.scheduler.run(utils.analyze_images_packed_async(images, "retinografia", PROMPT, use_cache=use_cache))
+
+
+def test_omitted_image_still_pays_the_full_packed_request(monkeypatch, stub_client):
+    fake_packed(monkeypatch, {1: "Disco óptico normal."})
+    results = describe()
+    full = utils.costs(PACKED_USAGE)["total_cost"]
+    assert results[0]["output"] == "Disco óptico normal."
+    assert results[0]["costs"]["total_cost"] == full
+    assert "packed" not in results[1] and results[1]["costs"]["total_cost"] > 0
+
+
+def test_packed_request_with_no_descriptions_is_charged_to_the_retry(monkeypatch, stub_client):
+    fake_packed(monkeypatch, {})
+    results = describe()
+    retry_only = utils.scheduler.run(utils.analyze_image_async(sample("sample.jpg"), "retinografia", PROMPT, use_cache=False))
+    full = utils.costs(PACKED_USAGE)["total_cost"]
+    assert abs(results[0]["costs"]["total_cost"] - (full + retry_only["costs"]["total_cost"])) < 1e-9
+    assert results[1]["costs"]["total_cost"] == retry_only["costs"]["total_cost"]
+
+
+def test_truncated_packed_results_are_not_cached(monkeypatch, stub_client):
+    calls = fake_packed(monkeypatch, {1: "Primeira.", 2: "Segunda."}, metadata={"truncated": True})
+    describe(use_cache=True)
+    results = describe(use_cache=True)
+    assert len(calls) == 2
+    assert not any(result.get("cached") for result in results)
+
+
+def test_packed_request_respects_the_describe_deadline(monkeypatch, stub_client):
+    fake_packed(monkeypatch, {1: "Primeira.", 2: "Segunda."}, delay=5)
+    monkeypatch.setattr(hedging, "stage_deadline", lambda stage: 0.05)
+    results = describe()
+    assert all("deadline" in result["error"] for result in results)
+
+
+def test_single_uncached_image_respects_the_describe_deadline(monkeypatch, stub_client):
+    async def slow_analyze(*args, **kwargs):
+        await asyncio.sleep(5)
+
+    monkeypatch.setattr(utils, "analyze_image_async", slow_analyze)
+    monkeypatch.setattr(hedging, "stage_deadline", lambda stage: 0.05)
+    results = utils.scheduler.run(utils.analyze_images_packed_async([sample("sample.jpg")], "retinografia", PROMPT, use_cache=False))
+    assert "deadline" in results[0]["error"]
@@ -0,0 +1,55 @@
+import json
+
+from packing import PackingPolicy, split_packed_output
+
+
+def packed(*entries) -> str:
+    return json.dumps({"descriptions": list(entries)})
+
+
+def test_split_by_image_number():
+    output = packed({"image": 2, "description": "Segunda."}, {"image": 1, "description": "Primeira."})
+    assert split_packed_output(output, 2) == ["Primeira.", "Segunda."]
+
+
+def test_skipped_and_empty_images_are_none():
+    output = packed({"image": 1, "description": "Primeira."}, {"image": 3, "description": ""})
+    assert split_packed_output(output, 3) == ["Primeira.", None, None]
+
+
+def test_falls_back_to_response_order():
+    output = packed("Primeira.", {"description": "Segunda."}, {"image": 9, "description": "Terceira."})
+    assert split_packed_output(output, 3) == ["Primeira.", "Segunda.", "Terceira."]
+
+
+def test_extra_and_duplicate_entries_are_ignored():
+    output = packed({"image": 1, "description": "Primeira."}, {"image": 1, "description": "Repetida."}, "Sobra.")
+    assert split_packed_output(output, 1) == ["Primeira."]
+
+
+def test_invalid_output_describes_nothing():
+    assert split_packed_output('{"descriptions": [', 2) == [None, None]
+    assert split_packed_output("[]", 2) == [None, None]
+
+
+def test_pack_latency_is_compared_per_image():
+    policy = PackingPolicy(min_images=3, max_images=4, latency_tolerance=1.5, exam_types=("retinografia",))
+    assert policy.should_pack(4, "retinografia", "gpt-4o")
+    policy.observe("fanout", "retinografia", "gpt-4o", 10.0)
+    # 4 images in 12s: 3s per image, so a pack of 4 takes about as long as one fan-out request
+    policy.observe("pack", "retinografia", "gpt-4o", 12.0, images=4)
+    assert policy.stats()["pack / retinografia / gpt-4o"] == 3.0
+    assert policy.should_pack(4, "retinografia", "gpt-4o")
+    # A pack of 6 would take 18s, past 1.5x the fan-out wall time
+    assert not policy.should_pack(6, "retinografia", "gpt-4o", pack_size=6)
+    assert policy.should_pack(6, "retinografia", "gpt-4o", pack_size=3)
+
+
+def test_plan_checks_the_latency_of_the_planned_pack_size():
+    policy = PackingPolicy(min_images=3, max_images=3, latency_tolerance=1.0, exam_types=("retinografia",))
+    policy.observe("fanout", "retinografia", "gpt-4o", 10.0)
+    policy.observe("pack", "retinografia", "gpt-4o", 9.0, images=3)
+    assert policy.plan([1000] * 5, "retinografia", "gpt-4o") == [[0, 1, 2], [3, 4]]
+    policy.observe("pack", "retinografia", "gpt-4o", 40.0, images=3)
+    assert policy.plan([1000] * 5, "retinografia", "gpt-4o") == [[0], [1], [2], [3], [4]]
+    assert policy.plan([], "retinografia", "gpt-4o") == []
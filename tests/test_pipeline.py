@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+import pytest
+
+from pipeline import CancelToken, ExamPipeline
+
+DESCRIBE_SECONDS = {"right": [0.005, 0.01], "left": [0.05, 0.4]}
+SYNTHESIS_SECONDS = {"right": 0.3, "left": 0.05}
+
+
+async def describe(group, index, item, on_delta):
+    await asyncio.sleep(DESCRIBE_SECONDS[group][index])
+    if item == "broken":
+        raise ValueError("unreadable image")
+    return {"output": item}
+
+
+async def synthesize(group, results, on_delta):
+    await asyncio.sleep(SYNTHESIS_SECONDS[group])
+    return {"output": [r.get("output") for r in results]}
+
+
+def test_each_eye_is_synthesized_once_its_own_images_are_described():
+    pipeline = ExamPipeline(describe, synthesize)
+    events = list(pipeline.run({"right": ["r1", "r2"], "left": ["l1", "broken"]}))
+
+    order = [(e["stage"], e["group"], e.get("index")) for e in events]
+    assert order == [
+        ("describe", "right", 0), ("describe", "right", 1), ("describe", "left", 0),
+        # The right report does not wait for the slow left image
+        ("synthesize", "right", None), ("describe", "left", 1), ("synthesize", "left", None),
+    ]
+    # A stage that raises becomes an error result and the run goes on
+    assert pipeline.results["left"] == [{"output": "l1"}, {"error": "ValueError: unreadable image"}]
+    assert pipeline.reports == {"right": {"output": ["r1", "r2"]}, "left": {"output": ["l1", None]}}
+
+    path = pipeline.critical_path()
+    right, left = path["groups"]["right"], path["groups"]["left"]
+    assert right["report_ready_at"] - right["synthesis_seconds"] < left["descriptions_done_at"]
+    assert path["critical_group"] == "left" and path["wall_seconds"] == left["report_ready_at"]
+    # Behind a barrier the slow right synthesis would only start after the last left image
+    assert path["barrier_wall_seconds"] == pytest.approx(left["descriptions_done_at"] + right["synthesis_seconds"], abs=0.002)
+    assert path["saved_vs_barrier_seconds"] > 0.15
+
+
+def test_cancel_token_cancels_stages_and_tracked_shared_tasks():
+    token = CancelToken()
+    shared = {}
+
+    async def pack_request():
+        await asyncio.sleep(10)
+        return [{"output": "packed"}] * 2
+
+    async def describe_packed(group, index, item, on_delta):
+        if index == 0:
+            # Answers once the shared request is under way
+            await asyncio.sleep(0.05)
+            return {"output": item}
+        # Like PackedDescriber: images await one shared request, shielded and tracked by the token
+        if "task" not in shared:
+            shared["task"] = asyncio.ensure_future(pack_request())
+            token.track(shared["task"])
+        return (await asyncio.shield(shared["task"]))[index - 1]
+
+    pipeline = ExamPipeline(describe_packed, synthesize, token=token)
+    events = []
+    for event in pipeline.run({"right": ["r1", "r2", "r3"]}):
+        events.append(event)
+        assert token.cancel("budget", "over U$0.10")
+
+    assert [(e["stage"], e["index"]) for e in events] == [("describe", 0)]
+    assert pipeline.cancelled and pipeline.results["right"] == [{"output": "r1"}, None, None]
+    assert "synthesis" not in pipeline.timings["right"]
+    # The shield kept the stage's cancellation from reaching the shared request; the token did not
+    deadline = time.monotonic() + 2
+    while not shared["task"].done() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert shared["task"].cancelled()
+
+
+def test_only_the_first_cancel_counts():
+    token = CancelToken()
+    called = []
+    token.on_cancel(lambda: called.append("early"))
+    assert token.cancel("budget", "over U$0.10")
+    assert not token.cancel("error")
+    assert (token.cancelled, token.reason, token.detail) == (True, "budget", "over U$0.10")
+    # Callbacks registered after the cancel run right away
+    token.on_cancel(lambda: called.append("late"))
+    assert called == ["early", "late"]
@@ -0,0 +1,120 @@
+import asyncio
+import time
+import types
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import httpx
+import openai
+import pytest
+
+import ratelimit
+from ratelimit import RateLimiter, backoff_seconds, retry_after_seconds
+
+REQUEST = httpx.Request("POST", "https://example.openai.azure.com/openai/deployments/gpt-4o/chat/completions")
+
+
+def throttled(headers=None) -> openai.RateLimitError:
+    response = httpx.Response(429, headers=headers or {}, request=REQUEST)
+    return openai.RateLimitError("Rate limit exceeded", response=response, body=None)
+
+
+def completion(total_tokens: int):
+    return types.SimpleNamespace(usage=types.SimpleNamespace(total_tokens=total_tokens))
+
+
+def limiter(max_retries=5) -> RateLimiter:
+    return RateLimiter({"gpt-4o": {"rpm": 600, "tpm": 6000}}, headroom=1.0, max_retries=max_retries)
+
+
+@pytest.mark.parametrize("headers,expected", [
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"retry-after": "7"}, 7.0),
+    # A malformed retry-after-ms falls back to Retry-After
+    ({"retry-after-ms": "soon", "retry-after": "2"}, 2.0),
+    ({"retry-after": "whenever"}, None),
+    ({}, None),
+])
+def test_retry_after_seconds(headers, expected):
+    assert retry_after_seconds(httpx.Response(429, headers=headers)) == expected
+
+
+def test_retry_after_http_date():
+    when = datetime.now(timezone.utc) + timedelta(seconds=30)
+    seconds = retry_after_seconds(httpx.Response(429, headers={"retry-after": format_datetime(when, usegmt=True)}))
+    assert 28 <= seconds <= 30
+    past = datetime.now(timezone.utc) - timedelta(minutes=5)
+    assert retry_after_seconds(httpx.Response(429, headers={"retry-after": format_datetime(past, usegmt=True)})) == 0.0
+    assert retry_after_seconds(None) is None
+
+
+def test_backoff_is_capped_full_jitter(monkeypatch):
+    monkeypatch.setattr(ratelimit.random, "uniform", lambda low, high: (low, high))
+    assert backoff_seconds(0) == (0, 1.0)
+    assert backoff_seconds(3) == (0, 8.0)
+    assert backoff_seconds(10) == (0, 30.0)
+    assert backoff_seconds(2, base=0.5, cap=1.5) == (0, 1.5)
+
+
+def test_throttled_request_refunds_its_token_estimate():
+    rate_limiter = limiter(max_retries=0)
+    calls = []
+
+    async def send():
+        calls.append(time.monotonic())
+        raise throttled({"retry-after-ms": "0"})
+
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(rate_limiter.call("gpt-4o", 1000, send))
+    deployment = rate_limiter.for_deployment("gpt-4o")
+    assert deployment.tokens.available == pytest.approx(6000)
+    assert deployment.stats["throttled"] == 1 and len(calls) == 1
+
+
+def test_retry_after_a_429_then_reconcile_actual_usage():
+    rate_limiter = limiter()
+    answers = [throttled({"retry-after-ms": "10"}), completion(400)]
+
+    async def send():
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    assert asyncio.run(rate_limiter.call("gpt-4o", 1000, send)).usage.total_tokens == 400
+    stats = rate_limiter.for_deployment("gpt-4o").stats
+    assert stats["throttled"] == 1 and stats["retries"] == 1 and stats["requests"] == 2
+    # Only the 400 tokens actually used stay charged (plus the refill since)
+    assert rate_limiter.for_deployment("gpt-4o").tokens.available == pytest.approx(5600, abs=5)
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(ratelimit, "backoff_seconds", lambda attempt: 0.0)
+    rate_limiter = limiter(max_retries=2)
+    attempts = []
+
+    async def send():
+        attempts.append(1)
+        raise openai.APIConnectionError(request=REQUEST)
+
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(rate_limiter.call("gpt-4o", 100, send))
+    assert len(attempts) == 3
+    assert rate_limiter.for_deployment("gpt-4o").stats["retries"] == 2
+    # A per-call override of 0 leaves retrying to the caller
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(rate_limiter.call("gpt-4o", 100, send, max_retries=0))
+    assert len(attempts) == 4
+
+
+def test_unretryable_errors_are_raised_at_once():
+    rate_limiter = limiter()
+    attempts = []
+
+    async def send():
+        attempts.append(1)
+        raise openai.BadRequestError("bad", response=httpx.Response(400, request=REQUEST), body=None)
+
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(rate_limiter.call("gpt-4o", 100, send))
+    assert len(attempts) == 1
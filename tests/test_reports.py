@@ -0,0 +1,46 @@
+import prompts
+from conftest import sample
+from loaders import get_layouts
+from reports import ReportRun
+
+
+def report_options(**overrides):
+    return {
+        "prompts": {"right": prompts.DEFAULT_EYE_PROMPT, "left": prompts.DEFAULT_EYE_PROMPT},
+        "reasoning_prompt": prompts.COMBINED_PROMPT,
+        "layout": get_layouts()["oct_macula"],
+        "use_cache": False,
+        **overrides,
+    }
+
+
+def exam_images():
+    return {
+        "right": [sample("sample_right.jpg"), sample("sample_right_2.jpg")],
+        "left": [sample("sample.jpg"), sample("sample_2.jpg")],
+    }
+
+
+def test_report_run_end_to_end(stub_client):
+    result = ReportRun(report_options(), exam_images()).run()
+
+    assert not result["cancelled"] and result["aborted"] is None
+    assert set(result["reports"]) == {"right", "left"}
+    for eye in ("right", "left"):
+        assert "error" not in result["reports"][eye]
+        assert all(r and r["output"] for r in result["descriptions"][eye])
+    assert result["total_costs"]["total_cost"] > 0
+    assert len(result["preprocessing"]["images"]) >= 3
+
+
+def test_retry_reuses_previous_results(stub_client):
+    first = ReportRun(report_options(), exam_images()).run()
+    calls = stub_client.calls
+    previous = {"descriptions": first["descriptions"], "reports": first["reports"]}
+
+    result = ReportRun(report_options(previous=previous), exam_images()).run()
+
+    assert stub_client.calls == calls
+    assert result["reports"] == first["reports"]
+    assert result["total_costs"]["total_cost"] == 0
+    assert result["reused"] == {"right": 2, "left": 2}
@@ -0,0 +1,108 @@
+import asyncio
+import types
+
+import httpx
+import openai
+import pytest
+
+import router as router_module
+from clients import async_registry
+from ratelimit import RateLimiter
+from router import EWMA_ALPHA, Deployment, DeploymentRouter
+from stub import StubAsyncClient
+
+REQUEST = httpx.Request("POST", "https://example.openai.azure.com/openai/deployments/gpt-4o/chat/completions")
+
+
+class FailingClient(StubAsyncClient):
+    """Stub client whose every call raises `error`."""
+
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    async def create(self, **request):
+        self.calls += 1
+        raise self.error
+
+
+def pool_router(name: str, east, west) -> DeploymentRouter:
+    """A gpt-4o pool of two deployments served by the given clients."""
+    entries = []
+    for region, client in (("east", east), ("west", west)):
+        endpoint = f"https://{name}-{region}.openai.azure.com/"
+        async_registry.register(endpoint, "key", client)
+        entries.append({"name": f"gpt-4o@{region}", "endpoint": endpoint, "api_key": "key"})
+    limiter = RateLimiter({"default": {"rpm": 6000, "tpm": 1_000_000}}, headroom=1.0)
+    return DeploymentRouter({"gpt-4o": entries}, limiter=limiter)
+
+
+async def send(deployment):
+    return await deployment.client().chat.completions.create(
+        model=deployment.deployment, messages=[{"role": "user", "content": "Descreva."}]
+    )
+
+
+def call(router):
+    return asyncio.run(router.call("gpt-4o", 100, send))
+
+
+def throttled(retry_after_ms: str) -> openai.RateLimitError:
+    response = httpx.Response(429, headers={"retry-after-ms": retry_after_ms}, request=REQUEST)
+    return openai.RateLimitError("Rate limit exceeded", response=response, body=None)
+
+
+def test_ewma_and_score(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(router_module, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    deployment = Deployment("gpt-4o@east", "gpt-4o", "https://east", "key", "gpt-4o", weight=2.0)
+    for seconds in (1.0, 2.0):
+        with deployment.track():
+            assert deployment.in_flight == 1
+            now[0] += seconds
+    assert deployment.ewma_seconds == pytest.approx(EWMA_ALPHA * 2.0 + (1 - EWMA_ALPHA) * 1.0)
+
+    deployment.in_flight = 1
+    deployment.throttles.extend([now[0] - 10, now[0] - 120])
+    # latency x (in flight + 1) x (1 + 0.5 per 429 in the last minute) / weight
+    assert deployment.score(now[0], fallback_seconds=9.0) == pytest.approx(1.3 * 2 * 1.5 / 2.0)
+    assert Deployment("new", "gpt-4o", "https://new", "key", "gpt-4o").score(now[0], 0.7) == pytest.approx(0.7)
+
+
+def test_throttled_deployment_cools_down_and_the_other_serves():
+    east, west = FailingClient(throttled("5000")), StubAsyncClient()
+    router = pool_router("throttle", east, west)
+
+    assert call(router).model_dump()["choices"][0]["finish_reason"] == "stop"
+    stats = router.stats()["gpt-4o"]
+    assert stats["gpt-4o@east"]["throttled"] == 1 and not stats["gpt-4o@east"]["healthy"]
+    assert 4.5 < stats["gpt-4o@east"]["cooldown_seconds"] <= 5.0
+    assert [d["outcome"] for d in router.recent_decisions()] == ["RateLimitError", "ok"]
+
+    # While east cools down every request goes to west
+    call(router)
+    assert east.calls == 1 and west.calls == 2
+    assert router.recent_decisions(1)[0]["deployment"] == "gpt-4o@west"
+
+
+def test_failover_to_the_next_deployment_on_connection_errors(monkeypatch):
+    monkeypatch.setattr(router_module, "backoff_seconds", lambda attempt, base=1.0: 30.0)
+    east, west = FailingClient(openai.APIConnectionError(request=REQUEST)), StubAsyncClient()
+    router = pool_router("failover", east, west)
+
+    assert call(router).model_dump()["choices"][0]["message"]["content"]
+    decisions = router.recent_decisions()
+    assert [(d["deployment"], d["outcome"]) for d in decisions] == [("gpt-4o@east", "APIConnectionError"), ("gpt-4o@west", "ok")]
+    assert decisions[1]["excluded"] == ["gpt-4o@east"]
+    east_stats = router.stats()["gpt-4o"]["gpt-4o@east"]
+    assert east_stats["failures"] == 1 and east_stats["cooldown_seconds"] > 29
+
+
+def test_gives_up_when_every_deployment_fails(monkeypatch):
+    monkeypatch.setattr(router_module, "backoff_seconds", lambda attempt, base=1.0: 0.0)
+    error = openai.APIConnectionError(request=REQUEST)
+    router = pool_router("down", FailingClient(error), FailingClient(error))
+    router.max_attempts = 3
+    with pytest.raises(openai.APIConnectionError):
+        call(router)
+    assert len(router.recent_decisions()) == 3
@@ -0,0 +1,48 @@
+import asyncio
+
+from scheduler import Scheduler
+
+
+def test_slot_caps_requests_in_flight():
+    scheduler = Scheduler(max_in_flight=2)
+    peak = [0]
+    waits = []
+
+    async def request():
+        async with scheduler.slot() as wait:
+            waits.append(wait)
+            peak[0] = max(peak[0], scheduler.stats()["in_flight"])
+            await asyncio.sleep(0.05)
+
+    async def main():
+        await asyncio.gather(*(request() for _ in range(5)))
+
+    scheduler.run(main(), timeout=5)
+    stats = scheduler.stats()
+    assert peak[0] == 2
+    assert stats["completed"] == 5 and stats["in_flight"] == 0 and stats["queue_depth"] == 0
+    # Three requests queued behind the first two, the last one for two rounds
+    assert stats["peak_queue_depth"] == 3
+    waits.sort()
+    assert waits[1] < 0.01 and waits[2] >= 0.04 and waits[-1] >= 0.09
+    assert stats["max_wait_seconds"] == round(waits[-1], 3)
+
+
+def test_slot_is_released_when_the_request_fails():
+    scheduler = Scheduler(max_in_flight=1)
+
+    async def failing():
+        async with scheduler.slot():
+            raise RuntimeError("boom")
+
+    async def main():
+        for _ in range(3):
+            try:
+                await failing()
+            except RuntimeError:
+                pass
+        async with scheduler.slot() as wait:
+            return wait
+
+    assert scheduler.run(main(), timeout=2) < 0.01
+    assert scheduler.stats()["completed"] == 4
@@ -0,0 +1,22 @@
+import pytest
+
+from streaming import partial_json_string
+
+
+@pytest.mark.parametrize("text,expected", [
+    ('{"description": "Disco óptico', "Disco óptico"),
+    ('{"description": "Mácula normal.", "diagnosis": "normal"}', "Mácula normal."),
+    ('{"description": "linha 1\\nlinha 2 \\"aspas\\" \\u00e9', 'linha 1\nlinha 2 "aspas" é'),
+    # An escape cut off mid-stream is held back until the rest arrives
+    ('{"description": "fim\\', "fim"),
+    ('{"description": "fim\\u00', "fim"),
+    ('{"diagnosis": "normal"', ""),
+    ('{"descrip', ""),
+])
+def test_partial_json_string(text, expected):
+    assert partial_json_string(text, "description") == expected
+
+
+def test_partial_json_string_matches_the_key_exactly():
+    text = '{"diagnosis_description": "outra", "diagnosis": "abnormal"}'
+    assert partial_json_string(text, "diagnosis") == "abnormal"
@@ -0,0 +1,34 @@
+import telemetry
+
+
+def test_rows_and_summary_cover_only_this_trace():
+    with telemetry.span("other run"):
+        pass
+    root = telemetry.start_trace("report", eye="right")
+    token = telemetry._current.set(root)
+    try:
+        with telemetry.span("describe", image=1):
+            telemetry.record("queue_wait", 0.2)
+        with telemetry.span("synthesize"):
+            pass
+    finally:
+        telemetry._current.reset(token)
+    root.finish()
+
+    rows = root.rows()
+    assert [row["span"].strip() for row in rows] == ["report", "describe", "queue_wait", "synthesize"]
+    # Spans without an image get None, never "", so the column keeps one type
+    assert [row["image"] for row in rows] == [None, 1, 1, None]
+    summary = root.summary()
+    assert set(summary) == {"report", "describe", "queue_wait", "synthesize"}
+    assert summary["queue_wait"] == {"count": 1, "total_seconds": 0.2, "max_seconds": 0.2}
+    # Slowest first: the recorded 0.2s wait outlasts the rest of the trace
+    assert list(summary)[0] == "queue_wait"
+
+
+def test_write_and_read_metrics(tmp_path):
+    telemetry.metrics.inc("redcheck_requests_total", model="gpt-4o", outcome="ok")
+    path = str(tmp_path / "metrics" / "redcheck.prom")
+    assert telemetry.read_metrics(path) is None
+    assert telemetry.write_metrics(path) == path
+    assert 'redcheck_requests_total{model="gpt-4o",outcome="ok"}' in telemetry.read_metrics(path)
@@ -0,0 +1,30 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from conftest import REPO_ROOT
+from tokens import image_dimensions
+
+
+def encoded(fmt: str, size=(37, 21), **save) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (120, 30, 30)).save(buffer, fmt, **save)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("fmt,save", [("PNG", {}), ("GIF", {}), ("JPEG", {}), ("JPEG", {"progressive": True})])
+def test_image_dimensions_from_header(fmt, save):
+    assert image_dimensions(encoded(fmt, **save)) == (37, 21)
+
+
+def test_image_dimensions_of_a_sample_match_pillow():
+    with open(os.path.join(REPO_ROOT, "samples", "sample.jpg"), "rb") as f:
+        data = f.read()
+    assert image_dimensions(data) == Image.open(io.BytesIO(data)).size
+
+
+@pytest.mark.parametrize("data", [b"", b"not an image", encoded("BMP"), encoded("JPEG")[:20]])
+def test_image_dimensions_unknown_or_truncated(data):
+    assert image_dimensions(data) is None